@@ -0,0 +1,110 @@
+#===============================================================================
+# Copyright 2014 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#===============================================================================
+"""
+    commits/sec with 1..n worker processes committing concurrently to one mongod.
+
+    python benchmarks/commit_throughput.py --processes 1,2,4,8 --commits 200
+    python benchmarks/commit_throughput.py --same-branch
+    python benchmarks/commit_throughput.py --group-commit 50
+
+    each worker commits one blob per commit with ``commit_blobs``. by default every
+    worker has its own branch, with --same-branch they all commit to master and
+    lose the compare and swap races to each other. the result is checked after
+    each run: every commit must be on its branch. --group-commit n buffers up to n
+    commits per worker and writes them with ``flush``
+"""
+#============= enthought library imports =======================
+#============= standard library imports ========================
+import argparse
+import time
+from multiprocessing import Process, Event
+#============= local library imports  ==========================
+from nogit.git_engine import GitEngine
+from nogit.mongo_adapter import MongoAdapter
+
+
+def make_engine(args):
+    return GitEngine(adapter=MongoAdapter(host=args.host, port=args.port,
+                                          database_name=args.database))
+
+
+def worker(args, i, start):
+    engine = make_engine(args)
+    if args.group_commit:
+        engine.group_commit = True
+        engine.flush_size = args.group_commit
+
+    branch = 'master' if args.same_branch else 'worker{}'.format(i)
+    start.wait()
+    for j in range(args.commits):
+        engine.commit_blobs([('/bench/worker{}'.format(i), 'blob{}'.format(j),
+                              {'worker': i, 'n': j})], 'commit {}'.format(j), branch)
+    engine.flush()
+
+
+def run(args, n):
+    engine = make_engine(args)
+    engine.drop_database()
+    engine.init()
+    base = engine.commit_blobs([('/bench', 'base', {'n': 0})], 'base')
+    for i in range(n):
+        engine.add_ref('worker{}'.format(i), base)
+
+    start = Event()
+    ps = [Process(target=worker, args=(args, i, start)) for i in range(n)]
+    for p in ps:
+        p.start()
+
+    st = time.time()
+    start.set()
+    for p in ps:
+        p.join()
+    et = time.time() - st
+
+    total = n * args.commits
+    if args.same_branch:
+        ok = engine.ahead_behind('master', base) == (total, 0)
+    else:
+        ok = all(engine.ahead_behind('worker{}'.format(i), base) == (args.commits, 0)
+                 for i in range(n))
+    return total, et, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nogit commit throughput')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--database', default='nogit_benchmark')
+    parser.add_argument('--processes', default='1,2,4,8')
+    parser.add_argument('--commits', type=int, default=200, help='commits per process')
+    parser.add_argument('--same-branch', action='store_true')
+    parser.add_argument('--group-commit', type=int, default=0,
+                        help='buffer up to n commits per flush. 0 disables group commit')
+    args = parser.parse_args()
+
+    print '{:>9} {:>8} {:>9} {:>11} {:>8}'.format('processes', 'commits', 'seconds',
+                                                 'commits/s', 'correct')
+    for n in [int(x) for x in args.processes.split(',')]:
+        total, et, ok = run(args, n)
+        print '{:>9} {:>8} {:>9.2f} {:>11.1f} {:>8}'.format(n, total, et, total / et, ok)
+
+    make_engine(args).drop_database()
+
+
+if __name__ == '__main__':
+    main()
+
+#============= EOF =============================================
@@ -0,0 +1,213 @@
+#===============================================================================
+# Copyright 2014 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#===============================================================================
+"""
+    coroutine adapters for the asyncio front end. python 2 has no asyncio so the
+    trollius port is used: coroutines ``yield From(...)`` and ``raise Return(...)``
+    and streams are read with ``fetch_next``/``next_object`` instead of ``async for``
+
+        cursor = adapter.get_collection('objects').find({'kind': 'blob'})
+        while (yield From(cursor.fetch_next)):
+            doc = cursor.next_object()
+"""
+
+#============= enthought library imports =======================
+import trollius as asyncio
+from concurrent.futures import ThreadPoolExecutor
+from traits.api import HasTraits, Any, Int, Str
+from trollius import From, Return
+#============= standard library imports ========================
+from collections import deque
+from functools import partial
+from itertools import islice
+#============= local library imports  ==========================
+from nogit.memory_adapter import MemoryAdapter
+from nogit.mongo_adapter import MongoAdapter
+
+
+class AsyncStream(object):
+    """
+        results fetched in batches by the coroutine ``next_batch``. it returns a
+        list, possibly empty, or None when there are no more results
+    """
+
+    def __init__(self, next_batch):
+        self._next_batch = next_batch
+        self._buffer = deque()
+        self._done = False
+
+    @property
+    def fetch_next(self):
+        """
+            a coroutine. True if a result is available from ``next_object``
+        """
+        return self._fetch_next()
+
+    def next_object(self):
+        return self._buffer.popleft()
+
+    @asyncio.coroutine
+    def to_list(self, length=None):
+        """
+            return the next ``length`` results, all of them if None
+        """
+        results = []
+        while length is None or len(results) < length:
+            if not (yield From(self.fetch_next)):
+                break
+            results.append(self.next_object())
+        raise Return(results)
+
+    @asyncio.coroutine
+    def _fetch_next(self):
+        while not self._buffer and not self._done:
+            batch = yield From(self._next_batch())
+            if batch is None:
+                self._done = True
+            else:
+                self._buffer.extend(batch)
+        raise Return(bool(self._buffer))
+
+
+class AsyncCursor(AsyncStream):
+    """
+        a collection cursor read ``batch_size`` documents per call
+    """
+
+    def __init__(self, collection, cursor):
+        super(AsyncCursor, self).__init__(self._read_batch)
+        self._collection = collection
+        self._cursor = cursor
+        self._docs = None
+        self._batch_size = 100
+
+    def sort(self, key, direction=1):
+        self._cursor = self._cursor.sort(key, direction)
+        return self
+
+    def skip(self, n):
+        self._cursor = self._cursor.skip(n)
+        return self
+
+    def limit(self, n):
+        self._cursor = self._cursor.limit(n)
+        return self
+
+    def batch_size(self, n):
+        self._batch_size = n
+        return self
+
+    @asyncio.coroutine
+    def _read_batch(self):
+        docs = yield From(self._collection.call(self._read))
+        raise Return(docs or None)
+
+    def _read(self):
+        if self._docs is None:
+            self._docs = iter(self._cursor)
+        return list(islice(self._docs, self._batch_size))
+
+
+class AsyncCollection(object):
+    """
+        coroutine versions of the collection methods used by the engine
+    """
+
+    def __init__(self, collection, executor=None):
+        self.collection = collection
+        self._executor = executor
+
+    def find(self, spec=None, fields=None, **kw):
+        return AsyncCursor(self, self.collection.find(spec, fields, **kw))
+
+    @asyncio.coroutine
+    def find_one(self, spec=None, fields=None):
+        doc = yield From(self.call(self.collection.find_one, spec, fields))
+        raise Return(doc)
+
+    @asyncio.coroutine
+    def insert(self, doc_or_docs):
+        r = yield From(self.call(self.collection.insert, doc_or_docs))
+        raise Return(r)
+
+    @asyncio.coroutine
+    def update(self, spec, document, upsert=False, multi=False):
+        r = yield From(self.call(self.collection.update, spec, document,
+                                 upsert=upsert, multi=multi))
+        raise Return(r)
+
+    @asyncio.coroutine
+    def remove(self, spec=None):
+        r = yield From(self.call(self.collection.remove, spec))
+        raise Return(r)
+
+    @asyncio.coroutine
+    def count(self):
+        n = yield From(self.call(self.collection.count))
+        raise Return(n)
+
+    @asyncio.coroutine
+    def call(self, func, *args, **kw):
+        """
+            run ``func`` on the executor. without one it runs on the event loop
+            after giving the other coroutines a turn
+        """
+        if self._executor is None:
+            yield From(asyncio.sleep(0))
+            raise Return(func(*args, **kw))
+
+        loop = asyncio.get_event_loop()
+        r = yield From(loop.run_in_executor(self._executor, partial(func, *args, **kw)))
+        raise Return(r)
+
+
+class AsyncAdapter(HasTraits):
+    #the synchronous adapter whose collections are wrapped
+    adapter = Any
+    #concurrent.futures executor the blocking calls run on. None runs them on the loop
+    executor = Any
+
+    def get_collection(self, name):
+        return AsyncCollection(self.adapter.get_collection(name), self.executor)
+
+
+class AsyncMemoryAdapter(AsyncAdapter):
+    """
+        the in-memory database never blocks so its calls run on the event loop
+    """
+    database_name = Str('nogit')
+
+    def _adapter_default(self):
+        return MemoryAdapter(database_name=self.database_name)
+
+
+class AsyncMongoAdapter(AsyncAdapter):
+    """
+        pymongo blocks so its calls run on a pool of ``max_workers`` threads shared
+        by all coroutines
+    """
+    host = Str('localhost')
+    port = Int(27017)
+    database_name = Str('nogit')
+    max_workers = Int(8)
+
+    def _adapter_default(self):
+        return MongoAdapter(host=self.host, port=self.port,
+                            database_name=self.database_name)
+
+    def _executor_default(self):
+        return ThreadPoolExecutor(self.max_workers)
+
+#============= EOF =============================================
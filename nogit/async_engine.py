@@ -0,0 +1,669 @@
+#===============================================================================
+# Copyright 2014 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#===============================================================================
+
+#============= enthought library imports =======================
+import trollius as asyncio
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from traits.api import HasTraits, Any, Instance, Int
+from trollius import From, Return
+#============= standard library imports ========================
+from collections import OrderedDict
+#============= local library imports  ==========================
+from nogit.async_adapter import AsyncStream
+from nogit.cache import LRUCache
+from nogit.differ import Differ
+from nogit.errors import NoBranchError, UnsupportedQueryError
+from nogit.git_engine import GitEngine
+from nogit.graph import blob_content, path_names, path_levels, level_ids, reachable_query, \
+    delta_bases, expand_deltas, tree_pair_ids, diff_tree_pair, subtree_change, next_skip
+from nogit.query import match, project, unsupported_operators
+
+
+class AsyncGitEngine(HasTraits):
+    """
+        coroutine front end to a database written by GitEngine. ``adapter`` is an
+        AsyncAdapter. streaming calls return an AsyncStream.
+
+        there is no working tree. ``add`` stages blobs in memory and ``commit``
+        commits them straight to a branch like GitEngine.commit_blobs. blobs are
+        stored whole
+    """
+    adapter = Any
+    #max number of ids in a single ``$in`` query
+    batch_size = Int(1000)
+    commit_cache_size = Int(10000)
+    commit_cache = Any
+    #tree id: reachable blob ids
+    reachable_cache = Any
+    #max total number of blob ids held by ``reachable_cache``
+    reachable_cache_size = Int(1000000)
+    version_cache_size = Int(1000)
+    #blob id: reconstructed content of delta encoded versions
+    version_cache = Any
+
+    #engine used for the blob, tree and commit document helpers that do no io.
+    #the walks share their io free steps with GitEngine through nogit.graph
+    _plumbing = Instance(GitEngine, ())
+    #staged blobs. path: (parent, blob)
+    _staged = Instance(OrderedDict, ())
+
+    @asyncio.coroutine
+    def add(self, parent, name, doc):
+        """
+            store a blob and stage it for the next commit
+        """
+        yield From(self.add_many([(parent, name, doc)]))
+
+    @asyncio.coroutine
+    def add_many(self, items):
+        """
+            store and stage an iterable of (parent, name, doc) blobs
+        """
+        blobs = self._create_blobs(items)
+        yield From(self._put_objects([blob for _, blob in blobs.itervalues()]))
+        self._staged.update(blobs)
+
+    @asyncio.coroutine
+    def commit(self, msg, ref=None):
+        """
+            commit the staged blobs to the branch ``ref``, default HEAD's. return the
+            commit id or None if nothing is staged
+        """
+        staged = OrderedDict(self._staged)
+        if not staged:
+            return
+
+        cid = yield From(self._commit(ref, msg, staged))
+        for path, item in staged.iteritems():
+            if self._staged.get(path) is item:
+                del self._staged[path]
+        raise Return(cid)
+
+    @asyncio.coroutine
+    def commit_blobs(self, items, msg, ref=None):
+        """
+            commit an iterable of (parent, name, doc) blobs to the branch ``ref``
+            without staging them. return the commit id
+        """
+        blobs = self._create_blobs(items)
+        yield From(self._put_objects([blob for _, blob in blobs.itervalues()]))
+        cid = yield From(self._commit(ref, msg, blobs))
+        raise Return(cid)
+
+    @asyncio.coroutine
+    def get_object(self, path, ref):
+        """
+            return the object at ``path`` in ``ref``, a branch name or commit id
+        """
+        commit = yield From(self._resolve_commit(ref))
+        tree = yield From(self._get_object(commit['tid']))
+        obj = yield From(self._resolve_path(tree, path))
+        if obj and 'delta' in obj:
+            objs = yield From(self._expand_blobs([obj]))
+            obj = objs[0]
+        raise Return(obj)
+
+    @asyncio.coroutine
+    def diff(self, path, c1, c2):
+        """
+            return the key level Changes of the blob at ``path`` between ``c1`` and
+            ``c2`` or, for a tree, the Changes of ``GitEngine.diff_trees``
+        """
+        a, b = yield From(asyncio.gather(self.get_object(path, c1),
+                                         self.get_object(path, c2)))
+        if (a or b)['kind'] != 'blob':
+            changes = yield From(self._diff_trees(a, b))
+            raise Return([c for c, _ in changes])
+
+        a = blob_content(a) if a else {}
+        b = blob_content(b) if b else {}
+        raise Return(list(Differ(a, b).diff()))
+
+    def log(self, ref=None, limit=None, skip=0, since=None, until=None, start=None):
+        """
+            stream the formatted commit messages of ``ref`` newest first. the
+            arguments are those of GitEngine.log
+        """
+        p = self._plumbing
+        since = p._utc(since)
+        until = p._utc(until)
+        commits = self.walk_commits(ref, start=start)
+        state = {'n': 0, 'started': start is None}
+
+        @asyncio.coroutine
+        def next_batch():
+            n = state['n']
+            if limit and n - skip >= limit or not (yield From(commits.fetch_next)):
+                raise Return(None)
+
+            c = commits.next_object()
+            if not state['started']:
+                state['started'] = True
+                raise Return([])
+
+            t = p._commit_time(c)
+            if since and t < since:
+                raise Return(None)
+            if until and t > until:
+                raise Return([])
+
+            state['n'] = n + 1
+            if n < skip:
+                raise Return([])
+            raise Return([p._format_log(c)])
+
+        return AsyncStream(next_batch)
+
+    def walk_commits(self, ref=None, start=None):
+        """
+            stream the commits of ``ref`` newest first following the first parent,
+            one query per ``ancestry_depth`` commits
+        """
+        state = {}
+
+        @asyncio.coroutine
+        def next_batch():
+            if 'commit' not in state:
+                if start is not None:
+                    commit = yield From(self._get_commit(start))
+                else:
+                    commit = yield From(self._resolve_commit(ref))
+                state['commit'] = commit
+
+            commit = state['commit']
+            if not commit:
+                raise Return(None)
+
+            ancestors = commit.get('ancestors')
+            if not ancestors:
+                state['commit'] = yield From(self._get_commit(commit['pid']))
+                raise Return([commit])
+
+            commits = yield From(self._get_commits(ancestors))
+            state['commit'] = commits[ancestors[-1]]
+            raise Return([commit] + [commits[aid] for aid in ancestors[:-1]])
+
+        return AsyncStream(next_batch)
+
+    def walk_tree(self, root=None, return_object=False, blobs_only=False, fields=None):
+        """
+            stream a depth first walk of ``root``, a tree document, branch name or
+            commit id, default HEAD. the arguments are those of GitEngine.walk_tree.
+
+            the children of all sibling trees are fetched concurrently as soon as
+            their parent is expanded
+        """
+        if not return_object:
+            fields = {'name': 1, 'trees': 1, 'blobs': 1}
+        elif fields:
+            fields = dict(fields, name=1, trees=1, blobs=1, delta=1)
+
+        def expand(tree):
+            return asyncio.ensure_future(self._get_objects(tree['trees'] + tree['blobs'], fields))
+
+        state = {}
+
+        @asyncio.coroutine
+        def next_batch():
+            stack = state.get('stack')
+            if stack is None:
+                tree = root
+                if not isinstance(tree, dict):
+                    commit = yield From(self._resolve_commit(tree))
+                    tree = yield From(self._get_object(commit['tid']))
+                stack = state['stack'] = [(False, tree, expand(tree))]
+
+            items = []
+            while stack:
+                emit, obj, children = stack.pop()
+                if emit:
+                    items.append(obj if return_object else obj['name'])
+                    continue
+                elif items:
+                    stack.append((emit, obj, children))
+                    break
+
+                children = yield From(children)
+                key = lambda o: o['name']
+                blobs = [children[bid] for bid in obj['blobs'] if bid in children]
+                if return_object:
+                    blobs = yield From(self._expand_blobs(blobs, fields))
+                blobs = sorted(blobs, key=key)
+                trees = sorted((children[tid] for tid in obj['trees'] if tid in children), key=key)
+
+                for blob in reversed(blobs):
+                    stack.append((True, blob, None))
+
+                for tree in reversed(trees):
+                    stack.append((False, tree, expand(tree)))
+                    if not blobs_only:
+                        stack.append((True, tree, None))
+
+            raise Return(items or None)
+
+        return AsyncStream(next_batch)
+
+    def find(self, query, ref=None, path_prefix=None, fields=None):
+        """
+            stream the blobs reachable from ``ref`` that match the mongo style
+            ``query``. the arguments are those of GitEngine.find
+        """
+        objects = self.adapter.get_collection('objects')
+        full = {'delta': {'$exists': False}}
+        state = {}
+
+        @asyncio.coroutine
+        def next_batch():
+            if 'cursor' not in state:
+                state['cursor'] = None
+                commit = yield From(self._resolve_commit(ref))
+                root = None
+                if commit:
+                    root = yield From(self._get_object(commit['tid']))
+                if root and path_prefix and path_prefix != '/':
+                    root = yield From(self._resolve_path(root, path_prefix))
+                if not root:
+                    raise Return(None)
+
+                bids = yield From(self._reachable_blobs(root))
+                deltas = yield From(self._reachable_deltas(root, bids))
+                if deltas:
+                    ops = unsupported_operators(query)
+                    if ops:
+                        raise UnsupportedQueryError(ops)
+
+                state['bids'] = bids
+                state['deltas'] = deltas
+                state['cursor'] = objects.find(reachable_query(root, bids, self.batch_size,
+                                                               query, full), fields)
+
+            cursor = state['cursor']
+            if cursor is None:
+                raise Return(None)
+
+            bids = state['bids']
+            if (yield From(cursor.fetch_next)):
+                bi = cursor.next_object()
+                raise Return([bi] if bi['_id'] in bids else [])
+
+            state['cursor'] = None
+            deltas = yield From(self._expand_blobs(state['deltas']))
+            raise Return([project(bi, fields) if fields else bi
+                          for bi in deltas if match(query, bi)])
+
+        return AsyncStream(next_batch)
+
+    #private
+    def _create_blobs(self, items):
+        blobs = OrderedDict()
+        for parent, name, doc in items:
+            blob = self._plumbing._create_blob(parent, name, doc)
+            blobs[blob['name']] = (parent, blob)
+        return blobs
+
+    @asyncio.coroutine
+    def _commit(self, ref, msg, blobs):
+        """
+            commit ``blobs`` on the tip of ``ref`` and move it with compare and swap.
+            if another writer moved it first the blobs are applied to its new tip
+        """
+        if ref is None:
+            head = yield From(self._get_head())
+            ref = head['ref']
+
+        commits = self.adapter.get_collection('commits')
+        refs = self.adapter.get_collection('refs')
+        tip = yield From(self._resolve_commit(ref))
+        while True:
+            tid = yield From(self._apply_blobs(tip['tid'] if tip else None, blobs))
+            if tip and tid == tip['tid']:
+                raise Return(tip['_id'])
+
+            skips = yield From(self._skips(tip))
+            commit = self._plumbing._commit_doc(msg, tid, tip, [], skips)
+            cid = yield From(commits.insert(commit))
+            r = yield From(refs.update({'name': ref, 'kind': 'head',
+                                        'cid': tip['_id'] if tip else None},
+                                       {'$set': {'cid': cid}}))
+            if r['n']:
+                break
+
+            yield From(commits.remove({'_id': cid}))
+            tip = yield From(self._resolve_commit(ref))
+
+        yield From(self._record_history(commit, tip['tid'] if tip else None))
+        raise Return(cid)
+
+    @asyncio.coroutine
+    def _apply_blobs(self, root_tid, blobs):
+        """
+            return the id of the committed tree ``root_tid`` with ``blobs``, a dict of
+            path: (parent, blob), added
+        """
+        root = None
+        if root_tid:
+            root = yield From(self._get_object(root_tid))
+        if root is None:
+            root = {'_id': None, 'name': '/', 'kind': 'tree', 'trees': [], 'blobs': []}
+
+        found = yield From(self._resolve_paths(root, blobs.keys()))
+        changes = []
+        for path, (parent, blob) in blobs.iteritems():
+            old = found.get(path)
+            oid = old['_id'] if old and old['kind'] == 'blob' else None
+            if oid != blob['_id']:
+                changes.append((parent, oid, blob['_id']))
+
+        if not changes:
+            raise Return(root['_id'])
+
+        ntrees, _, root = self._plumbing._new_trees(changes, found)
+        rid = self._plumbing._tree_id(root)
+        yield From(self._put_objects(ntrees + [root]))
+        raise Return(rid)
+
+    @asyncio.coroutine
+    def _record_history(self, commit, ptid):
+        a = None
+        if ptid:
+            a = yield From(self._get_object(ptid))
+        b = yield From(self._get_object(commit['tid']))
+        changes = yield From(self._diff_trees(a, b))
+
+        records = [self._plumbing._history_record(commit, c)
+                   for c, kind in changes if kind == 'blob']
+        history = self.adapter.get_collection('history')
+        n = self.batch_size
+        yield From(asyncio.gather(*[history.insert(records[i:i + n])
+                                    for i in range(0, len(records), n)]))
+
+    @asyncio.coroutine
+    def _diff_trees(self, a, b):
+        """
+            return the (Change, object kind) list of GitEngine._diff_trees. all the
+            changed tree pairs of a level are fetched concurrently
+        """
+        empty = {'_id': None, 'trees': [], 'blobs': []}
+        fields = {'name': 1, 'kind': 1, 'trees': 1, 'blobs': 1}
+
+        changes = []
+        subtrees = []
+        level = [(a or empty, b or empty)]
+        while level:
+            level = [(ta, tb) for ta, tb in level if ta['_id'] != tb['_id']]
+            fetched = yield From(asyncio.gather(*[self._get_objects(tree_pair_ids(ta, tb), fields)
+                                                  for ta, tb in level]))
+            nlevel = []
+            for (ta, tb), objs in zip(level, fetched):
+                for item in diff_tree_pair(ta, tb, objs):
+                    if item[0] == 'pair':
+                        nlevel.append(item[1:])
+                    elif item[0] == 'change':
+                        changes.append(item[1])
+                    else:
+                        subtrees.append(item[1:])
+            level = nlevel
+
+        walked = yield From(asyncio.gather(*[self._subtree(t) for t, _ in subtrees]))
+        for (_, kind), objs in zip(subtrees, walked):
+            changes.extend(subtree_change(o, kind) for o in objs)
+
+        changes.sort(key=lambda c: c[0].path.split('/'))
+        raise Return(changes)
+
+    @asyncio.coroutine
+    def _subtree(self, tree):
+        """
+            return every object below ``tree`` with its name and kind. each level
+            is fetched at once
+        """
+        objs = []
+        level = tree['trees'] + tree['blobs']
+        while level:
+            fetched = yield From(self._get_objects(level, {'name': 1, 'kind': 1,
+                                                           'trees': 1, 'blobs': 1}))
+            objs.extend(fetched.itervalues())
+            level = [i for o in fetched.itervalues() if o['kind'] != 'blob'
+                     for i in o['trees'] + o['blobs']]
+        raise Return(objs)
+
+    @asyncio.coroutine
+    def _reachable_deltas(self, root, bids):
+        """
+            return the delta encoded blobs among ``bids``. see GitEngine._reachable_deltas
+        """
+        objects = self.adapter.get_collection('objects')
+        q = reachable_query(root, bids, self.batch_size, {'delta': {'$exists': True}})
+        found = yield From(objects.find(q, {'_id': 1}).to_list())
+        ids = [o['_id'] for o in found if o['_id'] in bids]
+        objs = yield From(self._get_objects(ids))
+        raise Return([objs[oid] for oid in ids if oid in objs])
+
+    @asyncio.coroutine
+    def _reachable_blobs(self, root):
+        bids = self.reachable_cache.get(root['_id'])
+        if bids is None:
+            bids = set(root['blobs'])
+            level = root['trees']
+            while level:
+                trees = yield From(self._get_objects(level, {'trees': 1, 'blobs': 1}))
+                level = []
+                for t in trees.itervalues():
+                    bids.update(t['blobs'])
+                    level.extend(t['trees'])
+
+            bids = frozenset(bids)
+            self.reachable_cache[root['_id']] = bids
+        raise Return(bids)
+
+    @asyncio.coroutine
+    def _resolve_path(self, root, path):
+        """
+            descend from ``root`` to ``path`` one level per query
+        """
+        if not root or path == '/':
+            raise Return(root)
+
+        obj = root
+        for name, last in path_names(path):
+            ids = obj['trees'] + obj['blobs'] if last else obj['trees']
+            obj = yield From(self._find_child(ids, name))
+            if obj is None:
+                break
+        raise Return(obj)
+
+    @asyncio.coroutine
+    def _find_child(self, oids, name):
+        m = self.adapter.get_collection('objects')
+        n = self.batch_size
+        objs = yield From(asyncio.gather(*[m.find_one({'_id': {'$in': oids[i:i + n]}, 'name': name})
+                                           for i in range(0, len(oids), n)]))
+        raise Return(next((o for o in objs if o), None))
+
+    @asyncio.coroutine
+    def _resolve_paths(self, root, paths):
+        """
+            resolve many ``paths`` below ``root``, one level at a time. return a dict
+            of path: object with only name, kind, trees and blobs
+        """
+        fields = {'name': 1, 'kind': 1, 'trees': 1, 'blobs': 1}
+        found = {'/': root}
+
+        m = self.adapter.get_collection('objects')
+        n = self.batch_size
+        for names in path_levels(paths):
+            ids = list(level_ids(names, found))
+            objs = yield From(asyncio.gather(*[m.find({'_id': {'$in': ids[i:i + n]},
+                                                      'name': {'$in': names}}, fields).to_list()
+                                               for i in range(0, len(ids), n)]))
+            for obj in (o for os in objs for o in os):
+                found[obj['name']] = obj
+
+        raise Return(found)
+
+    @asyncio.coroutine
+    def _expand_blobs(self, blobs, fields=None):
+        """
+            return ``blobs`` with the delta encoded ones replaced by their full
+            documents. see GitEngine._expand_blobs
+        """
+        if not any('delta' in b for b in blobs):
+            raise Return(blobs)
+
+        objs = dict((b['_id'], b) for b in blobs if 'delta' in b)
+        level = delta_bases(blobs, objs, self.version_cache)
+        while level:
+            fetched = yield From(self._get_objects(level))
+            objs.update(fetched)
+            level = delta_bases(fetched.itervalues(), objs, self.version_cache)
+        raise Return(expand_deltas(blobs, objs, self.version_cache, fields))
+
+    @asyncio.coroutine
+    def _put_objects(self, objs):
+        """
+            insert content addressed objects skipping those that already exist
+        """
+        if not objs:
+            return
+
+        objects = self.adapter.get_collection('objects')
+        existing = yield From(self._get_objects([o['_id'] for o in objs], {'_id': 1}))
+        objs = [o for o in objs if o['_id'] not in existing]
+        if objs:
+            try:
+                yield From(objects.insert(objs))
+            except (DuplicateKeyError, BulkWriteError):
+                #inserted concurrently. fall back to one at a time
+                for o in objs:
+                    yield From(self._put_object(o))
+
+    @asyncio.coroutine
+    def _put_object(self, obj):
+        """
+            insert a content addressed object. see GitEngine._put_object
+        """
+        objects = self.adapter.get_collection('objects')
+        try:
+            yield From(objects.insert(obj))
+        except DuplicateKeyError:
+            existing = yield From(objects.find_one({'_id': obj['_id']}, {'_id': 1}))
+            if not existing:
+                raise
+
+    @asyncio.coroutine
+    def _get_object(self, oid, fields=None):
+        m = self.adapter.get_collection('objects')
+        obj = yield From(m.find_one({'_id': oid}, fields))
+        raise Return(obj)
+
+    @asyncio.coroutine
+    def _get_objects(self, oids, fields=None):
+        """
+            fetch many objects with concurrent ``$in`` queries of at most
+            ``batch_size`` ids. return a dict keyed by _id
+        """
+        m = self.adapter.get_collection('objects')
+        n = self.batch_size
+        batches = yield From(asyncio.gather(*[m.find({'_id': {'$in': oids[i:i + n]}}, fields).to_list()
+                                              for i in range(0, len(oids), n)]))
+        raise Return(dict((o['_id'], o) for objs in batches for o in objs))
+
+    @asyncio.coroutine
+    def _get_commit(self, cid):
+        if cid is None:
+            return
+
+        commit = self.commit_cache.get(cid)
+        if commit is None:
+            commit = yield From(self.adapter.get_collection('commits').find_one({'_id': cid}))
+            if commit:
+                self.commit_cache[cid] = commit
+        raise Return(commit)
+
+    @asyncio.coroutine
+    def _get_commits(self, cids):
+        cache = self.commit_cache
+        commits = {}
+        missing = []
+        for cid in cids:
+            commit = cache.get(cid)
+            if commit is None:
+                missing.append(cid)
+            else:
+                commits[cid] = commit
+
+        if missing:
+            ts = self.adapter.get_collection('commits')
+            fetched = yield From(ts.find({'_id': {'$in': missing}}).to_list())
+            for commit in fetched:
+                cache[commit['_id']] = commit
+                commits[commit['_id']] = commit
+        raise Return(commits)
+
+    @asyncio.coroutine
+    def _skips(self, parent):
+        """
+            return the skip list of a child of ``parent``. see GitEngine._skips
+        """
+        if parent is None:
+            raise Return([])
+
+        skips = [[parent['_id'], parent['generation']]]
+        c = parent
+        while True:
+            s = next_skip(skips, c)
+            if s is None:
+                raise Return(skips)
+
+            skips.append(s)
+            c = yield From(self._get_commit(s[0]))
+
+    @asyncio.coroutine
+    def _get_head(self):
+        head = yield From(self.adapter.get_collection('HEAD').find_one({'name': 'HEAD'}))
+        raise Return(head)
+
+    @asyncio.coroutine
+    def _resolve_commit(self, ref):
+        """
+            return the commit for a branch or remote ref name or commit id. None is HEAD
+        """
+        if ref is None:
+            head = yield From(self._get_head())
+            ref = head['ref']
+
+        if isinstance(ref, (str, unicode)):
+            refs = self.adapter.get_collection('refs')
+            r = yield From(refs.find_one({'name': ref, 'kind': 'head'}))
+            if r is None:
+                r = yield From(refs.find_one({'name': ref, 'kind': 'remote'}))
+            if r is None:
+                raise NoBranchError(ref)
+            ref = r['cid']
+
+        commit = yield From(self._get_commit(ref))
+        raise Return(commit)
+
+    def _commit_cache_default(self):
+        return LRUCache(self.commit_cache_size)
+
+    def _reachable_cache_default(self):
+        return LRUCache(self.reachable_cache_size, sizeof=len)
+
+    def _version_cache_default(self):
+        return LRUCache(self.version_cache_size)
+
+#============= EOF =============================================
@@ -0,0 +1,151 @@
+#===============================================================================
+# Copyright 2014 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#===============================================================================
+
+#============= enthought library imports =======================
+from bson import BSON
+
+#============= standard library imports ========================
+import mmap
+import struct
+import zlib
+#============= local library imports  ==========================
+from nogit.errors import BundleError
+
+#bundle file format
+#
+#magic      8 bytes 'NOGITBDL'
+#records    4 byte little endian length + zlib compressed bson {'kind': kind, 'doc': doc}.
+#           the first record is the header
+#index      one record {'ids': [...], 'offsets': [...]} of the commits and objects
+#trailer    8 byte offset of the index, 4 byte record count, 'NOGITEND'
+
+MAGIC = 'NOGITBDL'
+END = 'NOGITEND'
+TRAILER = struct.Struct('<QI8s')
+LENGTH = struct.Struct('<I')
+
+HEADER = 'header'
+OBJECT = 'object'
+COMMIT = 'commit'
+REF = 'ref'
+
+
+class BundleWriter(object):
+    """
+        stream records to a bundle file. records are written as they are added,
+        only the ids and offsets for the index are held in memory
+    """
+
+    def __init__(self, path, header):
+        self._fp = open(path, 'wb')
+        self._fp.write(MAGIC)
+        self._ids = []
+        self._offsets = []
+        self._count = 0
+        self.write(HEADER, header)
+
+    def write(self, kind, doc):
+        offset = self._write_record({'kind': kind, 'doc': doc})
+        if kind in (OBJECT, COMMIT):
+            self._ids.append(doc['_id'])
+            self._offsets.append(offset)
+        return offset
+
+    def close(self):
+        offset = self._write_record({'ids': self._ids, 'offsets': self._offsets})
+        self._fp.write(TRAILER.pack(offset, self._count, END))
+        self._fp.close()
+
+    def _write_record(self, record):
+        offset = self._fp.tell()
+        data = zlib.compress(BSON.encode(record))
+        self._fp.write(LENGTH.pack(len(data)))
+        self._fp.write(data)
+        self._count += 1
+        return offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BundleReader(object):
+    """
+        memory map a bundle file. iterate it for the (kind, doc) records in the
+        order they were written or use ``get`` for random access by id
+    """
+
+    def __init__(self, path):
+        self._fp = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise BundleError('{} is empty'.format(path))
+
+        size = len(self._map)
+        if self._map[:len(MAGIC)] != MAGIC or size < len(MAGIC) + TRAILER.size:
+            raise BundleError('{} is not a bundle'.format(path))
+
+        self._index_offset, self.count, end = TRAILER.unpack(self._map[size - TRAILER.size:])
+        if end != END:
+            raise BundleError('{} is truncated'.format(path))
+
+        index, _ = self._read_record(self._index_offset)
+        self._offsets = dict(zip(index['ids'], index['offsets']))
+        self.header = self._read_record(len(MAGIC))[0]['doc']
+
+    def get(self, oid):
+        """
+            return the commit or object ``oid`` or None
+        """
+        offset = self._offsets.get(oid)
+        if offset is not None:
+            return self._read_record(offset)[0]['doc']
+
+    def close(self):
+        self._map.close()
+        self._fp.close()
+
+    def _read_record(self, offset):
+        """
+            return the record at ``offset`` and the offset of the next record
+        """
+        n, = LENGTH.unpack(self._map[offset:offset + LENGTH.size])
+        offset += LENGTH.size
+        return BSON(zlib.decompress(self._map[offset:offset + n])).decode(), offset + n
+
+    def __iter__(self):
+        offset = len(MAGIC)
+        while offset < self._index_offset:
+            record, offset = self._read_record(offset)
+            if record['kind'] != HEADER:
+                yield record['kind'], record['doc']
+
+    def __contains__(self, oid):
+        return oid in self._offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#============= EOF =============================================
@@ -0,0 +1,81 @@
+#===============================================================================
+# Copyright 2014 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#===============================================================================
+
+#============= enthought library imports =======================
+#============= standard library imports ========================
+from collections import OrderedDict
+#============= local library imports  ==========================
+
+
+class LRUCache(object):
+    """
+        dict like cache that holds at most ``maxsize`` items and evicts the
+        least recently used. only use it for immutable values, e.g. commits.
+
+        if ``sizeof`` is given ``maxsize`` bounds the total ``sizeof`` of the values
+        instead of their number. a value larger than ``maxsize`` is not cached
+    """
+
+    def __init__(self, maxsize=1000, sizeof=None):
+        self.maxsize = maxsize
+        self.size = 0
+        self._sizeof = sizeof
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            v = self._items.pop(key)
+        except KeyError:
+            return default
+
+        self._items[key] = v
+        return v
+
+    def pop(self, key, default=None):
+        if key not in self._items:
+            return default
+
+        v = self._items.pop(key)
+        self.size -= self._size(v)
+        return v
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        n = self._size(value)
+        if n > self.maxsize:
+            return
+
+        items = self._items
+        items[key] = value
+        self.size += n
+        while self.size > self.maxsize:
+            _, v = items.popitem(last=False)
+            self.size -= self._size(v)
+
+    def _size(self, value):
+        return self._sizeof(value) if self._sizeof else 1
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+#============= EOF =============================================
@@ -16,28 +16,110 @@
 
 #============= enthought library imports =======================
 from difflib import ndiff
-from bson.json_util import dumps
 from traits.api import HasTraits
 from traitsui.api import View, Item
 
 #============= standard library imports ========================
+from collections import namedtuple
+from copy import deepcopy
 #============= local library imports  ==========================
 
+#a single key level difference between two documents. ``kind`` is
+#'added', 'removed' or 'changed'. ``path`` is dotted for nested keys
+Change = namedtuple('Change', ['path', 'kind', 'old', 'new'])
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+
+def diff_documents(left, right, prefix=''):
+    """
+        walk two dicts once and yield a Change for every key that differs.
+        nested dicts are descended, any other value (including lists) is compared whole
+    """
+    for key in sorted(set(left) | set(right)):
+        path = '{}{}'.format(prefix, key)
+        if key not in right:
+            yield Change(path, REMOVED, left[key], None)
+        elif key not in left:
+            yield Change(path, ADDED, None, right[key])
+        else:
+            a, b = left[key], right[key]
+            if isinstance(a, dict) and isinstance(b, dict):
+                for c in diff_documents(a, b, '{}.'.format(path)):
+                    yield c
+            elif a != b or type(a) != type(b):
+                yield Change(path, CHANGED, a, b)
+
+
+def patch_document(doc, changes):
+    """
+        return a copy of ``doc`` with ``changes``, (path, kind, new) triples as
+        yielded by diff_documents, applied
+    """
+    doc = deepcopy(doc)
+    for path, kind, new in changes:
+        keys = path.split('.')
+        d = doc
+        for k in keys[:-1]:
+            d = d.setdefault(k, {})
+
+        if kind == REMOVED:
+            d.pop(keys[-1], None)
+        else:
+            d[keys[-1]] = deepcopy(new)
+    return doc
+
+
+def merge_documents(base, ours, theirs, prefix=''):
+    """
+        three way merge of dicts key by key. a key changed on one side only takes
+        that side's value, nested dicts changed on both sides are merged recursively.
+        return the merged dict and a list of the dotted keys changed differently on
+        both sides. conflicting keys keep ``ours``
+    """
+    merged = {}
+    conflicts = []
+    for key in sorted(set(base) | set(ours) | set(theirs)):
+        b = base.get(key, _missing)
+        o = ours.get(key, _missing)
+        t = theirs.get(key, _missing)
+        if o == t or b == t:
+            v = o
+        elif b == o:
+            v = t
+        elif isinstance(o, dict) and isinstance(t, dict):
+            v, cs = merge_documents(b if isinstance(b, dict) else {}, o, t,
+                                    '{}{}.'.format(prefix, key))
+            conflicts.extend(cs)
+        else:
+            v = o
+            conflicts.append('{}{}'.format(prefix, key))
+
+        if v is not _missing:
+            merged[key] = v
+    return merged, conflicts
+
+
+_missing = object()
+
+
 class Differ(HasTraits):
     def __init__(self, left, right, *args, **kw):
         super(Differ, self).__init__(*args, **kw)
 
-        if isinstance(left, dict):
-            left=dumps(left, indent=4).split('\n')
-        if isinstance(right, dict):
-            right = dumps(right, indent=4).split('\n')
-
         self._left=left
         self._right=right
 
     def diff(self):
+        """
+            structural diff (Change records) for two dicts, ndiff for sequences of lines
+        """
+        if isinstance(self._left, dict) and isinstance(self._right, dict):
+            return diff_documents(self._left, self._right)
+
         return ndiff(self._left, self._right)
 
 
 #============= EOF =============================================
-
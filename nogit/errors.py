@@ -27,5 +27,59 @@ class NoBranchError(BaseException):
 
     def __repr__(self):
         return 'No branch named "{}"'.format(self._name)
+
+
+class NonFastForwardError(BaseException):
+    def __init__(self, name):
+        super(NonFastForwardError, self).__init__()
+        self._name = name
+
+    def __repr__(self):
+        return 'Branch "{}" has diverged and cannot be fast forwarded'.format(self._name)
+
+
+class UncommittedChangesError(BaseException):
+    def __repr__(self):
+        return 'The staging area has uncommitted changes'
+
+
+class MergeConflictError(BaseException):
+    def __init__(self, conflicts):
+        super(MergeConflictError, self).__init__()
+        #list of (path, dotted key). key is None if the whole object conflicts
+        self.conflicts = conflicts
+
+    def __repr__(self):
+        return 'Merge conflict in {}'.format(', '.join('{} {}'.format(p, k) if k else p
+                                                       for p, k in self.conflicts))
+
+
+class BundleError(BaseException):
+    def __init__(self, msg):
+        super(BundleError, self).__init__()
+        self._msg = msg
+
+    def __repr__(self):
+        return 'Invalid bundle. {}'.format(self._msg)
+
+
+class UniqueIndexError(BaseException):
+    def __init__(self, key):
+        super(UniqueIndexError, self).__init__()
+        self._key = key
+
+    def __repr__(self):
+        return 'Objects cannot have a unique index on "{}". Blob versions and trees ' \
+               'share field values'.format(self._key)
+
+
+class UnsupportedQueryError(BaseException):
+    def __init__(self, operators):
+        super(UnsupportedQueryError, self).__init__()
+        self.operators = operators
+
+    def __repr__(self):
+        return 'Delta encoded blobs are matched in python, which does not support ' \
+               '{}'.format(', '.join(self.operators))
 #============= EOF =============================================
 
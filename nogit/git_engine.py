@@ -16,14 +16,44 @@
 
 #============= enthought library imports =======================
 import hashlib
-from pymongo.errors import CollectionInvalid
-from traits.api import HasTraits, Any
+import heapq
+import json
+import time
+from datetime import datetime
+from bson import BSON
+from bson.objectid import ObjectId
+from bson.json_util import default
+from bson.tz_util import utc
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+from traits.api import HasTraits, Any, Bool, Float, Int
 
 
 #============= standard library imports ========================
+from collections import OrderedDict
+from copy import deepcopy
+from itertools import dropwhile, islice, takewhile
 #============= local library imports  ==========================
-from nogit.differ import Differ
-from nogit.errors import NoBranchError
+from nogit.bundle import BundleReader, BundleWriter, OBJECT, COMMIT, REF
+from nogit.cache import LRUCache
+from nogit.differ import Differ, ADDED, REMOVED, diff_documents, merge_documents
+from nogit.errors import NoBranchError, BundleError, NonFastForwardError, \
+    UncommittedChangesError, MergeConflictError, UniqueIndexError, UnsupportedQueryError
+from nogit.graph import BLOB_KEYS, blob_content, parent_path, tree_paths, path_names, \
+    path_levels, level_ids, reachable_query, delta_bases, expand_deltas, tree_pair_ids, \
+    diff_tree_pair, subtree_change, next_skip
+from nogit.query import match, project, unsupported_operators
+
+#(collection, key, unique) indexes used by the engine's own queries.
+#blob sha1 is the _id so it needs no extra index. staged entries are read by _id
+#and every one has kind entry, so the index collection needs none either
+REQUIRED_INDEXES = (('objects', 'name', False),
+                    ('objects', 'kind', False),
+                    ('commits', 'timestamp', False),
+                    ('refs', 'name', False),
+                    ('history', 'path_sha1', False))
+
+#``expected`` default of update_ref. the ref is updated unconditionally
+_unchecked = object()
 
 
 class GitObject(object):
@@ -55,6 +85,32 @@ class Blob(GitObject):
 
 class GitEngine(HasTraits):
     adapter = Any
+    #max number of ids in a single ``$in`` query
+    batch_size = Int(1000)
+    #number of first parent ancestor ids stored on each commit
+    ancestry_depth = Int(32)
+    commit_cache_size = Int(10000)
+    commit_cache = Any
+    #tree id: reachable blob ids. trees are immutable so entries never go stale
+    reachable_cache = Any
+    #max total number of blob ids held by ``reachable_cache``
+    reachable_cache_size = Int(1000000)
+    #store a modified blob as a delta against its previous version. every
+    #``delta_interval``th version is stored whole. 0 disables delta storage
+    delta_interval = Int(0)
+    version_cache_size = Int(1000)
+    #blob id: reconstructed content of delta encoded versions
+    version_cache = Any
+    #buffer ``commit_blobs`` commits in memory and write them in bulk. buffered
+    #commits are lost if the process dies before they are flushed, at most
+    #``flush_size`` commits or ``flush_interval`` seconds of work. see ``flush``
+    group_commit = Bool(False)
+    flush_size = Int(100)
+    flush_interval = Float(0.5)
+    #buffered writes. objects, commits and branch: {base, tip, changes}
+    _pending = Any
+    #route ``_put_objects`` into the buffer while building buffered commits
+    _buffering = Bool(False)
 
     #print porcelain
     def pdiff(self, a,b):
@@ -72,49 +128,70 @@ class GitEngine(HasTraits):
 
     #porcelain
     def status(self):
-        idx = self.get_index()
         template = '''# On branch "{}"
     # Changes to be committed:
 
     {}
     '''
-        def assemble_object(tree, oi, action):
-            blob = self._get_object(oi)
-            if tree == '/':
-                tree = ''
-            else:
-                tree = '{}/'.format(tree[1:])
-
-            return '#        {}:    {}{}'.format(action, tree, blob['name'])
+        def assemble_object(entry):
+            return '#        {}:    {}'.format(entry['action'], entry['path'][1:])
 
         head = self._get_head()
         branch = head['ref']
-        changes = '\n'.join([assemble_object(*o) for o in idx['objects']])
+        changes = '\n'.join(assemble_object(e) for e in self.get_index())
         txt = template.format(branch, changes)
         return txt.split('\n')
 
-    def log(self):
+    def log(self, ref=None, limit=None, skip=0, since=None, until=None, start=None,
+            path=None):
         """
-            return a list of formatted commit messages
+            yield formatted commit messages newest first
             author, date
             sha1
 
                 message
+
+            if ``path`` is given only the commits that changed it are included.
+            ``limit`` and ``skip`` page the log. ``start`` is a cursor, the id of
+            the last commit of the previous page. ``since`` and ``until`` restrict
+            the log to a (utc) time range. the walk starts at the newest commit
+            at or before ``until``, found with the timestamp index, and stops at the
+            first commit older than ``since``
         """
-        template = '''commit {}
-Author: {}
-Date: {}
+        since = self._utc(since)
+        until = self._utc(until)
 
-    {}\n'''
+        def gen():
+            n = 0
+            if path:
+                commits = (self._get_commit(h['cid']) for h in self.history(path, ref))
+                if start is not None:
+                    commits = dropwhile(lambda c: c['_id'] != start, commits)
+            elif until and start is None:
+                c = self._seek_until(ref, until)
+                commits = self.walk_commits(ref, start=c['_id']) if c else iter([])
+            else:
+                commits = self.walk_commits(ref, start=start)
 
-        def assemble_log(commit):
-            a = commit['author']
-            d = commit['_id'].generation_time
-            s = commit['_id']
-            m = commit['msg']
-            return template.format(s, a, d.strftime('%a %b %d %H:%M %Y'), m)
+            if start is not None:
+                next(commits, None)
 
-        return [assemble_log(c) for c in self.walk_commits()]
+            for c in commits:
+                t = self._commit_time(c)
+                if since and t < since:
+                    break
+                if until and t > until:
+                    continue
+                if n < skip:
+                    n += 1
+                    continue
+
+                yield self._format_log(c)
+                n += 1
+                if limit and n - skip >= limit:
+                    break
+
+        return gen()
 
     def diff(self, path, c1, c2):
 
@@ -124,15 +201,91 @@ Date: {}
         b=self.get_object(path, c2)
         # print 'commit',c2, 'blob',b
 
-        if a['kind'] == 'tree':
-            a=list(self.walk_tree(a))
-            b=list(self.walk_tree(b))
+        if (a or b)['kind'] != 'blob':
+            return self.diff_trees(a, b)
+        else:
+            #blobs are diffed key by key, ignoring the engine's keys
+            a=blob_content(a) if a else {}
+            b=blob_content(b) if b else {}
 
         d=Differ(a,b)
         return d.diff()
 
+    def diff_trees(self, a, b):
+        """
+            yield a Change(path, kind, old id, new id) for every tree and blob that was
+            added, removed or changed between the trees ``a`` and ``b``, in path order.
+
+            the trees are descended in lockstep. children with the same id on both
+            sides are identical and are never fetched, so the cost is proportional
+            to the size of the change
+        """
+        return (c for c, _ in self._diff_trees(a, b))
+
+    def diff_paths(self, paths, c1, c2):
+        """
+            yield (path, changes) for each of ``paths`` between commits ``c1`` and ``c2``.
+            blob changes are key level Change records, tree changes are those of
+            ``diff_trees``. unchanged paths yield an empty list. a path that changed
+            between tree and blob yields the changes of removing the old object
+            followed by those of adding the new one.
+
+            all paths are resolved together one tree level per query and the
+            blobs that differ are fetched in bulk
+        """
+        paths = list(paths)
+        ra = self._get_object(self._get_commit(c1)['tid'])
+        rb = self._get_object(self._get_commit(c2)['tid'])
+        oa = self._resolve_paths(ra, paths)
+        ob = self._resolve_paths(rb, paths)
+
+        #trees are diffed from their documents, blobs are fetched by id
+        side = lambda o: o if o is None or o['kind'] != 'blob' else o['_id']
+
+        def gen():
+            pairs = []
+            for path in paths:
+                a = oa.get(path)
+                b = ob.get(path)
+                if (a or b) is None:
+                    continue
+                elif a and b and a['_id'] == b['_id']:
+                    pairs.append((path, None, None))
+                else:
+                    pairs.append((path, side(a), side(b)))
+
+            for item in self._diff_blob_pairs(pairs):
+                yield item
+
+        return gen()
+
+    def diff_prefix(self, prefix, c1, c2):
+        """
+            yield (path, changes) for every blob under ``prefix`` that differs
+            between commits ``c1`` and ``c2``
+        """
+        a = self.get_object(prefix, c1)
+        b = self.get_object(prefix, c2)
+        if (a or b) is None:
+            return iter([])
+
+        if (a or b)['kind'] == 'blob':
+            return self.diff_paths([prefix], c1, c2)
+
+        def gen():
+            changes = self._diff_trees(a, b)
+            pairs = ((c.path, c.old, c.new) for c, kind in changes if kind == 'blob')
+            for item in self._diff_blob_pairs(pairs):
+                yield item
+
+        return gen()
+
     def drop_database(self):
         self.adapter.drop_database()
+        self.commit_cache.clear()
+        self.reachable_cache.clear()
+        self.version_cache.clear()
+        self._pending = None
 
     def init(self):
         """
@@ -153,29 +306,90 @@ Date: {}
             self.add_ref('master', None)
 
         m = self.adapter.get_collection('index')
-        if not m.find_one({'kind': 'index'}):
-            m.insert({'kind': 'index',
-                      'trees': [], 'blobs': [], 'objects': []})
+        idx = m.find_one({'kind': 'index'})
+        if idx:
+            self._migrate_index(idx)
+
+        self.ensure_indexes()
+
+        if self._get_path_id('/') is None and self._get_working_tree():
+            self.rebuild_path_index()
 
         self.add_root()
 
+    def create_index(self, key, collection='objects', unique=False):
+        """
+            declare an index on ``key`` of ``collection``. use a dotted key for
+            nested blob fields e.g. 'isotopes.Ar40'. the definition is stored in the
+            config collection and reapplied by ``ensure_indexes``.
+
+            ``unique`` is refused on objects. every version of a blob and every tree
+            would collide and the colliding objects would not be stored
+        """
+        if unique and collection == 'objects':
+            raise UniqueIndexError(key)
+
+        config = self.adapter.get_collection('config')
+        config.update({'_id': self._index_key(collection, key)},
+                      {'$set': {'kind': 'index', 'collection': collection,
+                                'key': key, 'unique': unique}}, upsert=True)
+        self._create_index(collection, key, unique)
+
+    def drop_index(self, key, collection='objects'):
+        config = self.adapter.get_collection('config')
+        config.remove({'_id': self._index_key(collection, key)})
+
+        #a missing index is ignored, as by the memory adapter
+        col = self.adapter.get_collection(collection)
+        name = '{}_1'.format(key)
+        try:
+            col.drop_index(name)
+        except OperationFailure:
+            if name in col.index_information():
+                raise
+
+    def get_indexes(self):
+        """
+            return the declared index definitions
+        """
+        config = self.adapter.get_collection('config')
+        return config.find({'kind': 'index'})
+
+    def ensure_indexes(self):
+        """
+            create the indexes the engine needs for its own lookups and all declared indexes
+        """
+        for collection, key, unique in REQUIRED_INDEXES:
+            self._create_index(collection, key, unique)
+
+        for idx in self.get_indexes():
+            unique = idx['unique'] and idx['collection'] != 'objects'
+            self._create_index(idx['collection'], idx['key'], unique)
+
     def checkout(self, name):
         """
             checkout a ref. (branch or tag)
-
+            the working tree is reset to the ref's commit. the staging area must be empty
         """
         ref = self._get_ref(name)
         if ref is None:
             raise NoBranchError(name)
         else:
+            idx = self.adapter.get_collection('index')
+            if idx.find_one({'kind': 'entry'}):
+                raise UncommittedChangesError()
+
+            commit = self._get_commit(ref['cid'])
+            if commit:
+                self._reset_working_tree(commit['tid'], commit['_id'])
             self._update_head(ref['name'], ref['kind'])
 
     def branch(self, name, commit_id=None):
         """
-            add a branch named ``name``. if commit_id is None use the latest commit
+            add a branch named ``name``. if commit_id is None use the current branch's commit
         """
         if not commit_id:
-            commit_id = self.adapter.get_last('commits')['_id']
+            commit_id = self._get_ref(self.get_head_ref())['cid']
 
         b = self.add_ref(name, commit_id)
 
@@ -187,95 +401,24 @@ Date: {}
         """
             add a blob to the staging area
         """
-        col = self.adapter.get_collection('index')
-        objects_col = self.adapter.get_collection('objects')
-
-        idx = self.get_index()
-
-        blobs = idx['blobs']
-        objects = idx['objects']
-
-        sha = self._digest(parent, name, doc)
-
-        blob = objects_col.find_one({'sha1': sha})
-        if not blob:
-            blob = objects_col.find_one({'path_sha1': self._digest(parent, name)})
-            if not blob:
-                nbid = objects_col.insert(self._create_blob(parent, name, doc))
-                blobs.append(nbid)
-                objects.append((parent, nbid, 'new file'))
-                col.update({'_id': idx['_id']}, {'$set': {'blobs': blobs, 'objects': objects}})
-
-                tree = self._get_tree(parent)
-                if not tree:
-                    ntid = self.add_tree(parent, kind='tree', blobs=[nbid])
-
-                    ptree = self._get_parent_tree(parent)
-                    trees = ptree['trees']
-                    for tid in trees:
-                        tt = objects_col.find_one({'_id': tid})
-                        if tt['name'] == parent:
-                            trees.remove(tid)
-                            break
+        self.add_many([(parent, name, doc)])
 
-                    trees.append(ntid)
-                    objects_col.update({'_id': ptree['_id']}, {'$set': {'trees': trees}})
-                else:
-                    blobs = tree['blobs']
-                    blobs.append(nbid)
-                    objects_col.update({'_id': tree['_id']}, {'$set': {'blobs': blobs}})
+    def add_many(self, items):
+        """
+            add an iterable of (parent, name, doc) blobs to the staging area.
 
-            else:
-                # if blob is already in staging area
-                if self._is_staged(blob):
-                    print 'staged'
-                    doc['sha']=sha
-                    objects_col.update({'_id': blob['_id']},
-                                       {'$set': doc})
-                else:
-                    nbid = objects_col.insert(self._create_blob(parent, name, doc))
-                    blobs.append(nbid)
-                    objects.append((parent, nbid, 'modified'))
-                    col.update({'_id': idx['_id']}, {'$set': {'blobs': blobs, 'objects': objects}})
-
-                    #make new tree
-                    args=parent.split('/')
-                    n=len(args)
-                    for i in range(n):
-                        d=n-i
-                        p='/'.join(args[:d])
-                        if not p:
-                            p='/'
-
-                        t=self._get_tree(p)
-                        pid=t['_id']
-                        t.pop('_id')
-                        if i==0:
-                            blobs = t['blobs']
-                            for bid in blobs:
-                                bi = objects_col.find_one({'_id': bid})
-                                if bi['path_sha1'] == self._digest(parent, name):
-                                    blobs.remove(bid)
-                            blobs.append(nbid)
-                            t['blobs'] = blobs
-                            ntid = objects_col.insert(t)
-                            ppath = p
-
-                        else:
-                            trees=t['trees']
-                            for tid in t['trees']:
-                                ti=objects_col.find_one({'_id':tid})
-                                if ti['name']==ppath:
-                                    trees.remove(tid)
-
-                            trees.append(ntid)
-                            t['trees']=trees
-                            if p=='/':
-                                objects_col.update({'_id':pid},{'$set':{'trees':trees}})
-                                break
-                            else:
-                                ntid=objects_col.insert(t)
-                                ppath = p
+            items are processed in batches of ``batch_size``. each batch looks up
+            and inserts its blobs in bulk and rewrites every affected tree once
+        """
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                self._add_batch(batch)
+                batch = []
+
+        if batch:
+            self._add_batch(batch)
 
     def commit(self, msg):
         """
@@ -286,6 +429,9 @@ Date: {}
 
     #plumbing
     def extract_diff(self, d):
+        """
+            split a text (ndiff) diff into its removed and added lines
+        """
         lefts=[]
         rights=[]
         def make_l(ll):
@@ -305,62 +451,482 @@ Date: {}
         return lefts, rights
 
     def get_object(self, path, commit):
-        commit=self._get_commit(commit)
-        objects=self.adapter.get_collection('objects')
-        tree=objects.find_one({'_id':commit['tid']})
-        # print 'ffff', commit['_id'], tree['_id']
-        for bi in self.walk_tree(tree, return_object=True):
-            # print bi['name'], bi['_id']
-            if bi['name']==path:
-                return bi
+        """
+            return the object at ``path`` in ``commit``. the committed tree is
+            descended one path component at a time
+        """
+        commit = self._get_commit(commit)
+        tree = self._get_object(commit['tid'])
+        obj = self._resolve_path(tree, path)
+        if obj and 'delta' in obj:
+            obj = self._expand_blobs([obj])[0]
+        return obj
+
+    def find(self, query, ref=None, path_prefix=None, fields=None):
+        """
+            yield the blobs reachable from ``ref`` that match the mongo style ``query``
+            e.g. find({'age': {'$gt': 10}}).
+
+            ``ref`` is a branch name or a commit id, defaults to HEAD. ``path_prefix``
+            restricts the search to a subtree. the predicate is evaluated by the
+            database. if few blobs are reachable the query is limited to their ids,
+            otherwise the predicate runs first and the matches are filtered by the
+            reachable id set. delta encoded blobs are reconstructed and matched
+            in python. if any are reachable and the query uses an operator python
+            cannot evaluate UnsupportedQueryError is raised before any result
+        """
+        commit = self._resolve_commit(ref)
+        if not commit:
+            return iter([])
+
+        root = self._get_object(commit['tid'])
+        if path_prefix and path_prefix != '/':
+            root = self._resolve_path(root, path_prefix)
+            if not root:
+                return iter([])
+
+        bids = self._reachable_blobs(root)
+        objects = self.adapter.get_collection('objects')
+
+        full = {'delta': {'$exists': False}}
+        n = self.batch_size
+
+        def gen():
+            deltas = self._reachable_deltas(root, bids)
+            if deltas:
+                ops = unsupported_operators(query)
+                if ops:
+                    raise UnsupportedQueryError(ops)
+
+            for bi in objects.find(reachable_query(root, bids, n, query, full), fields):
+                if bi['_id'] in bids:
+                    yield bi
+
+            for bi in self._expand_blobs(deltas):
+                if match(query, bi):
+                    yield project(bi, fields) if fields else bi
+
+        return gen()
+
+    def history(self, path, ref=None, blobs=False):
+        """
+            yield the history records of ``path`` newest first. a record has the
+            commit ``cid``, its ``generation`` and ``timestamp``, the ``action``
+            and the blob id ``oid`` (None if removed). if ``blobs`` the blob
+            documents are included as ``blob``.
+
+            records come from the per path history index written by commit_tree.
+            only commits on the first parent history of ``ref``, default HEAD, are
+            included
+        """
+        tip = self._resolve_commit(ref)
+        if tip is None:
+            return iter([])
+
+        col = self.adapter.get_collection('history')
+        records = list(col.find({'path_sha1': self._path_digest(path)}).sort('generation', -1))
+        on = self._first_parent_ids(tip, [r['generation'] for r in records])
+        records = [r for r in records if on.get(r['generation']) == r['cid']]
+
+        if blobs:
+            objs = self._get_objects([r['oid'] for r in records if r['oid']])
+            objs = dict((o['_id'], o) for o in self._expand_blobs(objs.values()))
+            for r in records:
+                r['blob'] = objs.get(r['oid'])
+
+        return iter(records)
+
+    def field_history(self, path, field, ref=None, as_array=False):
+        """
+            return the values of ``field`` (dotted for nested keys e.g. 'isotopes.Ar40')
+            in every version of the blob at ``path``, oldest first, as columns
+            {'cid': [...], 'timestamp': [...], 'value': [...]}.
+
+            the versions come from the history index and are fetched in one query
+            projected to ``field``. if ``as_array`` the columns are numpy arrays
+        """
+        records = [r for r in self.history(path, ref) if r['oid']]
+        records.reverse()
+
+        objs = self._get_objects([r['oid'] for r in records], {field: 1, 'delta': 1})
+        objs = dict((o['_id'], o) for o in self._expand_blobs(objs.values(), {field: 1}))
+        cols = {'cid': [r['cid'] for r in records],
+                'timestamp': [r['timestamp'] for r in records],
+                'value': [self._get_field(objs.get(r['oid']), field) for r in records]}
+
+        if as_array:
+            import numpy as np
+
+            cols = {'cid': np.array(cols['cid'], dtype=object),
+                    'timestamp': np.array(cols['timestamp'], dtype='datetime64[ms]'),
+                    'value': np.array(cols['value'])}
+        return cols
+
+    def rebuild_history(self):
+        """
+            rebuild the per path history index from all commits
+        """
+        col = self.adapter.get_collection('history')
+        col.remove({})
+        for commit in self.adapter.get_collection('commits').find():
+            parent = self._get_commit(commit['pid'])
+            self._record_history(commit, parent['tid'] if parent else None)
+
+    def gc(self, dry_run=False):
+        """
+            remove the objects that are not reachable from a ref, the staging area or
+            the working tree. return {'reachable', 'unreachable', 'bytes'}, the
+            number of objects kept and removed and the bson size of the removed
+            objects. if ``dry_run`` nothing is removed.
+
+            reachable ids are marked in the ``gc`` collection, which also holds the
+            commits and objects still to be walked, ``batch_size`` ids at a time. then
+            the objects collection is swept ``batch_size`` ids at a time so no full id
+            list is held in memory.
+            do not run while other processes are writing
+        """
+        marks = self.adapter.get_collection('gc')
+        marks.drop()
+        try:
+            marks.create_index('todo')
+            refs = self.adapter.get_collection('refs')
+            self._mark_commits([r['cid'] for r in refs.find({}, {'cid': 1}) if r.get('cid')])
+
+            wtree = self._get_working_tree()
+            idx = self.adapter.get_collection('index')
+            self._mark_objects([e['oid'] for e in idx.find({'kind': 'entry'}, {'oid': 1})] +
+                               ([wtree['_id']] if wtree else []))
+            return self._sweep(dry_run)
+        finally:
+            marks.drop()
+
+    def bundle(self, ref, path, since=None):
+        """
+            write the commits of ``ref`` after the commit ``since`` and the objects
+            they need to the bundle file ``path``, see nogit.bundle. with ``since``
+            each commit's tree is compared with its first parent's by id, so
+            subtrees the receiver has are skipped without being read and the cost
+            follows the size of the change. return the number of commits written
+        """
+        tip = self._resolve_commit(ref)
+        base = self._resolve_commit(since) if since is not None else None
+
+        if base:
+            known = lambda cids: set(c for c in cids if self._is_ancestor(c, base))
+        else:
+            known = lambda cids: set()
+        commits = self._missing_commits(tip, known)
+
+        seen = set()
+        header = {'tip': tip['_id'], 'since': base['_id'] if base else None}
+        with BundleWriter(path, header) as writer:
+            for c in commits:
+                if base:
+                    p = self._get_commit(c['pid'])
+                    objs = self._changed_objects(p['tid'] if p else None, c['tid'], seen)
+                else:
+                    objs = self._new_objects([c['tid']], seen)
+
+                for obj in objs:
+                    writer.write(OBJECT, obj)
+
+            for c in commits:
+                writer.write(COMMIT, c)
+
+            if isinstance(ref, basestring):
+                writer.write(REF, {'name': ref, 'cid': tip['_id']})
+
+        return len(commits)
+
+    def unbundle(self, path):
+        """
+            import the bundle file ``path``. objects and commits are inserted in bulk
+            and those that already exist are skipped. a branch in the bundle is
+            created or fast forwarded, a branch that has diverged is left unchanged.
+            return {'commits': number of new commits, 'tip', 'refs': updated branch names}
+        """
+        with BundleReader(path) as reader:
+            since = reader.header['since']
+            if since is not None and not self._get_commit(since):
+                raise BundleError('missing prerequisite commit {}'.format(since))
+
+            objs = []
+            commits = []
+            refs = []
+            for kind, doc in reader:
+                if kind == OBJECT:
+                    objs.append(doc)
+                    if len(objs) == self.batch_size:
+                        self._put_objects(objs)
+                        objs = []
+                elif kind == COMMIT:
+                    commits.append(doc)
+                elif kind == REF:
+                    refs.append(doc)
+            self._put_objects(objs)
+
+            existing = self._get_commits([c['_id'] for c in commits])
+            new = [c for c in commits if c['_id'] not in existing]
+            self._put_commits(new)
+
+            updated = []
+            cids = set(c['_id'] for c in commits)
+            cids.add(since)
+            for r in refs:
+                current = self._get_ref(r['name'])
+                cid = current['cid'] if current else None
+                if (cid is None or cid in cids) and \
+                        self.update_ref(r['name'], r['cid'], expected=cid):
+                    updated.append(r['name'])
+
+            return {'commits': len(new), 'tip': reader.header['tip'], 'refs': updated}
+
+    def fetch(self, remote, name='origin', branch=None):
+        """
+            copy the commits of ``branch``, default all branches, of ``remote``, another
+            GitEngine, and the objects they need that this engine is missing. the
+            remote refs '{name}/{branch}' are set to the fetched commits.
+            return a dict of remote ref: commit id
+        """
+        if branch is None:
+            branches = [b['name'] for b in remote.get_branches()]
+        else:
+            branches = [branch]
+
+        fetched = {}
+        for b in branches:
+            tip = remote._resolve_commit(b)
+            if tip:
+                remote._transfer(self, tip)
+                rname = '{}/{}'.format(name, b)
+                self._set_remote_ref(rname, tip['_id'])
+                fetched[rname] = tip['_id']
+        return fetched
+
+    def push(self, remote, name='origin', branch=None):
+        """
+            copy ``branch``, default the current branch, to ``remote`` and fast forward
+            its branch. only the commits and objects ``remote`` is missing are sent.
+            raise NonFastForwardError if the remote branch has commits ``branch`` does
+            not. return the number of commits sent
+        """
+        if branch is None:
+            branch = self.get_head_ref()
+
+        tip = self._resolve_commit(branch)
+        r = remote._get_ref(branch)
+        if r and r['cid'] and not self._is_ancestor(r['cid'], tip):
+            raise NonFastForwardError(branch)
+
+        n = self._transfer(remote, tip)
+        if not remote.update_ref(branch, tip['_id'], expected=r['cid'] if r else None):
+            raise NonFastForwardError(branch)
+        self._set_remote_ref('{}/{}'.format(name, branch), tip['_id'])
+        return n
+
+    def pull(self, remote, name='origin', branch=None):
+        """
+            fetch ``branch``, default the current branch, from ``remote`` and merge
+            it into the current branch. see ``merge``
+        """
+        if branch is None:
+            branch = self.get_head_ref()
+
+        rname = '{}/{}'.format(name, branch)
+        if rname in self.fetch(remote, name, branch):
+            return self.merge(rname)
+
+    def merge(self, ref, msg=None):
+        """
+            merge the branch, remote ref or commit ``ref`` into the current branch.
+            the working tree is updated and the staging area must be empty.
+
+            the merge base is the common ancestor with the highest generation. trees
+            changed on one side only are taken whole and blobs changed on both sides
+            are merged key by key. raise MergeConflictError, leaving everything
+            unchanged, if a key or path was changed differently on both sides.
+            return the merge commit id, the commit fast forwarded to or None if
+            ``ref`` is already merged
+        """
+        idx = self.adapter.get_collection('index')
+        if idx.find_one({'kind': 'entry'}):
+            raise UncommittedChangesError()
+
+        branch = self.get_head_ref()
+        ours = self._resolve_commit(branch)
+        theirs = self._resolve_commit(ref)
+        if theirs is None:
+            return
+
+        base = self._merge_base(ours, theirs) if ours else None
+        if base and base['_id'] == theirs['_id']:
+            return
+
+        if ours is None or (base and base['_id'] == ours['_id']):
+            if not self.update_ref(branch, theirs['_id'], expected=ours['_id'] if ours else None):
+                #the branch moved, merge again
+                return self.merge(ref, msg)
+
+            self._reset_working_tree(theirs['tid'], theirs['_id'])
+            return theirs['_id']
+
+        conflicts = []
+        tid = self._merge_tree('/', base['tid'] if base else None,
+                               ours['tid'], theirs['tid'], conflicts)
+        if conflicts:
+            raise MergeConflictError(conflicts)
+
+        if msg is None:
+            msg = 'Merge {} into {}'.format(ref, branch)
+        cid = self.commit_tree(msg, tid, parents=[ours['_id'], theirs['_id']])
+        self._reset_working_tree(self._get_commit(cid)['tid'], cid)
+        return cid
+
+    def is_ancestor(self, a, b):
+        """
+            is ``a`` an ancestor of, or the same commit as, ``b``. ``a`` and ``b`` are
+            branch or remote ref names or commit ids
+        """
+        return self._is_ancestor(self._resolve_commit(a)['_id'], self._resolve_commit(b))
+
+    def ahead_behind(self, a, b):
+        """
+            return (ahead, behind), the number of commits in ``a`` that are not in
+            ``b`` and in ``b`` that are not in ``a``
+        """
+        return self._ahead_behind(self._resolve_commit(a), self._resolve_commit(b))
+
+    def branches_containing(self, ref):
+        """
+            return the names of the branches that contain the commit ``ref``.
+            branches whose commit has a lower generation are skipped without a walk
+        """
+        commit = self._resolve_commit(ref)
+        refs = list(self.get_branches())
+        tips = self._get_commits([r['cid'] for r in refs if r['cid']])
+        names = []
+        for r in refs:
+            tip = tips.get(r['cid'])
+            if tip and tip['generation'] >= commit['generation'] and \
+                    self._is_ancestor(commit['_id'], tip):
+                names.append(r['name'])
+        return names
+
+    def get_remote_refs(self):
+        col = self.adapter.get_collection('refs')
+        return col.find({'kind': 'remote'})
 
     def get_branches(self):
         col = self.adapter.get_collection('refs')
         return col.find({'kind': 'head'})
 
-    def walk_tree(self, root=None, return_object=False, blobs_only=False):
-        objects = self.adapter.get_collection('objects')
+    def walk_tree(self, root=None, return_object=False, blobs_only=False, fields=None):
+        """
+            depth first walk of ``root``. yields the name of each tree and blob
+            or the full document if ``return_object``. siblings are yielded in name order.
+            ``fields`` limits the keys of the returned documents
+
+            the trees are fetched one level at a time, one ``$in`` query per
+            ``batch_size`` trees of a level. blobs are fetched in walk order,
+            ``batch_size`` at a time
+        """
         if root is None:
             root = self._get_working_tree()
         elif isinstance(root, str):
+            objects = self.adapter.get_collection('objects')
             ref = self._get_ref(root)
             commits = self.adapter.get_collection('commits')
             commit = commits.find_one({'_id': ref['cid']})
             root = objects.find_one({'_id': commit['tid']})
 
-        def gen():
-            for tree in root['trees']:
-                tree = objects.find_one({'_id': tree})
-                if not blobs_only:
-                    ret=tree
-                    if not return_object:
-                        ret=ret['name']
-                    yield ret
+        if not return_object:
+            fields = {'name': 1, 'trees': 1, 'blobs': 1}
+        elif fields:
+            fields = dict(fields, name=1, trees=1, blobs=1, delta=1)
 
-                for di in self.walk_tree(tree, return_object, blobs_only):
-                    yield di
+        key = lambda o: o['name']
 
-            for blob in root['blobs']:
-                blob = objects.find_one({'_id': blob})
+        def get_blobs(bids):
+            blobs = self._get_objects(bids, fields)
+            if return_object:
+                blobs = dict((b['_id'], b) for b in self._expand_blobs(blobs.values(), fields))
+            return blobs
 
-                if not return_object:
-                    blob=blob['name']
+        def flush(events, bids):
+            blobs = get_blobs(bids)
+            for kind, v in events:
+                if kind == 'tree':
+                    yield v if return_object else v['name']
+                else:
+                    for blob in sorted((blobs[bid] for bid in v if bid in blobs), key=key):
+                        yield blob if return_object else blob['name']
 
-                yield blob
+        def gen():
+            trees = self._get_tree_levels(root, fields)
+
+            #stack of (kind, value). a tree is expanded into its subtrees, each
+            #followed by its walk, and then its own blobs
+            stack = [('expand', root)]
+            events, bids = [], []
+            while stack:
+                kind, v = stack.pop()
+                if kind == 'expand':
+                    stack.append(('blobs', v['blobs']))
+                    subtrees = sorted((trees[tid] for tid in v['trees'] if tid in trees), key=key)
+                    for tree in reversed(subtrees):
+                        stack.append(('expand', tree))
+                        if not blobs_only:
+                            stack.append(('tree', tree))
+                    continue
+
+                events.append((kind, v))
+                if kind == 'blobs':
+                    bids.extend(v)
+                    if len(bids) >= self.batch_size:
+                        for r in flush(events, bids):
+                            yield r
+                        events, bids = [], []
+
+            for r in flush(events, bids):
+                yield r
 
         return gen()
 
+    def _get_tree_levels(self, root, fields=None):
+        """
+            return all trees below ``root`` keyed by _id. each level is fetched
+            with ``$in`` queries of at most ``batch_size`` ids
+        """
+        trees = {}
+        level = [root]
+        while level:
+            tids = [tid for tree in level for tid in tree['trees'] if tid not in trees]
+            if not tids:
+                break
+            children = self._get_objects(tids, fields)
+            trees.update(children)
+            level = children.values()
+        return trees
+
     def add_root(self):
         self.add_tree('/')
 
-    def add_tree(self, name, kind='wtree', blobs=None):
+    def add_tree(self, name, kind='wtree', blobs=None, trees=None):
         if blobs is None:
             blobs = []
+        if trees is None:
+            trees = []
 
         if not self._get_tree(name):
-            objects = self.adapter.get_collection('objects')
-            oid = objects.insert({'name': name, 'kind': kind,
-                                  'blobs': blobs, 'trees': []})
+            tree = {'name': name, 'kind': kind,
+                    'blobs': blobs, 'trees': trees}
+            if kind == 'wtree':
+                objects = self.adapter.get_collection('objects')
+                oid = objects.insert(tree)
+            else:
+                oid = self._put_tree(tree)
+
+            self._set_path_id(name, oid, 'tree')
             return oid
 
     def add_ref(self, name, commit_id, kind='head'):
@@ -369,159 +935,625 @@ Date: {}
                            'kind': kind,
                            'name': name})
 
-    def update_ref(self, name, commit_id):
-        ref = self._get_ref(name)
-        if ref is None:
+    def update_ref(self, name, commit_id, expected=_unchecked):
+        """
+            point the branch ``name`` at ``commit_id``. if ``expected`` is given the
+            branch is only updated if it still points at ``expected``, a single
+            conditional update. return True if the branch was updated
+        """
+        col = self.adapter.get_collection('refs')
+        if expected is _unchecked:
+            ref = self._get_ref(name)
+            if ref is None:
+                self.add_ref(name, commit_id)
+            else:
+                col.update(ref, {'$set': {'cid': commit_id}})
+            return True
+
+        r = col.update({'name': name, 'kind': 'head', 'cid': expected},
+                       {'$set': {'cid': commit_id}})
+        if r['n']:
+            return True
+
+        if expected is None and self._get_ref(name) is None:
             self.add_ref(name, commit_id)
-        else:
-            col = self.adapter.get_collection('refs')
-            col.update(ref, {'$set': {'cid': commit_id}})
+            return True
+        return False
 
     def get_ref(self, name):
         self._get_ref(name)
 
     def get_index(self):
+        """
+            return a cursor over the staged entries. one document per staged path
+            keyed by path_sha1 with the staged blob ``oid`` and the ``action``
+        """
         col = self.adapter.get_collection('index')
-        return col.find_one({'kind': 'index'})
+        return col.find({'kind': 'entry'})
 
     def get_working_tree(self):
         return self._get_working_tree()
 
-    def commit_tree(self, msg, tree_id):
-        if not tree_id:
-            return
+    def rebuild_path_index(self):
+        """
+            rebuild the path index from the working tree
+        """
+        paths = self.adapter.get_collection('paths')
+        paths.remove({})
 
-        author = 'foo'
+        wtree = self._get_working_tree()
+        if wtree:
+            self._set_path_id('/', wtree['_id'], 'tree')
+            for obj in self.walk_tree(wtree, return_object=True):
+                kind = 'blob' if obj['kind'] == 'blob' else 'tree'
+                self._set_path_id(obj['name'], obj['_id'], kind)
 
-        commits = self.adapter.get_collection('commits')
-        p = self.adapter.get_last('commits')
+    def commit_tree(self, msg, tree_id, parents=None):
+        """
+            commit the tree ``tree_id`` to the current branch. ``parents`` is a list of
+            commit ids, default the commit the working tree is based on or the branch's
+            commit. the first is the parent followed by ``walk_commits`` and history.
+            a merge commit stores all of them as ``pids``.
+
+            the branch is moved with compare and swap. if another writer moved it
+            first the tree is three way merged onto the new branch commit and the
+            commit retried. raise MergeConflictError if that merge conflicts
+        """
+        if not tree_id:
+            return
 
+        head = self._get_head()
         tree = self._get_tree(tree_id)
+        wtree = tree['kind'] == 'wtree'
+        if wtree:
+            #snapshot the working tree. unchanged trees hash to an existing object
+            tid = self._put_tree({'name': tree['name'], 'kind': 'tree',
+                                  'trees': tree['trees'], 'blobs': tree['blobs']})
+        else:
+            tid = tree['_id']
 
-        cid = commits.insert({
-            'pid': p['_id'] if p else None,
-            'tid': tree['_id'],
-            'msg': msg,
-            'author': author})
-
-        #update the current head to point to latest reference
-        head = self._get_head()
-        self.update_ref(head['ref'], cid)
+        if parents is None:
+            if wtree and 'cid' in tree:
+                cid = tree['cid']
+            else:
+                ref = self._get_ref(head['ref'])
+                cid = ref['cid'] if ref else None
+            parents = [cid] if cid else []
+
+        def rebase(p, tip, tid):
+            conflicts = []
+            tid = self._merge_tree('/', p['tid'] if p else None, tid, tip['tid'], conflicts)
+            if conflicts:
+                raise MergeConflictError(conflicts)
+            return tid
+
+        cid, tid = self._commit(head['ref'], msg, tid, parents, rebase)
+        if wtree:
+            self._reset_working_tree(tid, cid)
 
         #clear staging area
         self._clean_stage()
+        return cid
 
-        #make new working tree
-        objects = self.adapter.get_collection('objects')
+    def commit_blobs(self, items, msg, ref=None):
+        """
+            commit an iterable of (parent, name, doc) blobs straight to the branch
+            ``ref``, default the current branch, without the working tree or staging
+            area. only the trees above the blobs are read and rewritten.
 
-        objects.update({'_id': tree['_id']}, {'$set': {'kind': 'tree'}})
+            the branch is moved with compare and swap and if another writer moved it
+            first the blobs are reapplied to its new commit, so concurrent writers
+            never lose commits. the working tree is not updated. return the commit id
 
-        tree.pop('_id')
-        objects.insert(tree)
+            with ``group_commit`` the commit is buffered and written by ``flush``
+        """
+        if ref is None:
+            ref = self.get_head_ref()
+
+        blobs = OrderedDict()
+        for parent, name, doc in items:
+            blob = self._create_blob(parent, name, doc)
+            blobs[blob['name']] = (parent, blob)
+
+        if self.group_commit:
+            return self._buffer_commit(ref, msg, blobs)
+
+        tip = self._resolve_commit(ref)
+        tid = self._apply_blobs(tip['tid'] if tip else None, blobs)
+        if tip and tid == tip['tid']:
+            return tip['_id']
+
+        rebase = lambda p, tip, tid: self._apply_blobs(tip['tid'], blobs)
+        cid, _ = self._commit(ref, msg, tid, [tip['_id']] if tip else [], rebase)
         return cid
 
+    def flush(self):
+        """
+            write the commits buffered by ``group_commit``. objects, commits and
+            history are each written in ordered bulk inserts and every branch is
+            moved with a single compare and swap. a branch moved by another writer
+            has its buffered commits rebuilt on the new tip, keeping their ids.
+            return the number of commits written
+
+            a buffered commit is durable once flush returns. until then it is only
+            in memory and only visible to this engine
+        """
+        pending = self._pending
+        if not pending:
+            return 0
+
+        commits = self.adapter.get_collection('commits')
+        n = self.batch_size
+        written = []
+        self._insert_pending()
+        for branch, b in pending['branches'].iteritems():
+            while True:
+                docs = [pending['commits'][cid] for cid, _, _ in b['changes']]
+                for i in range(0, len(docs), n):
+                    commits.insert(docs[i:i + n])
+
+                if self.update_ref(branch, b['tip'], expected=b['base']):
+                    break
+
+                ids = [c['_id'] for c in docs]
+                for i in range(0, len(ids), n):
+                    commits.remove({'_id': {'$in': ids[i:i + n]}})
+
+                tip = self._resolve_commit(branch)
+                b['base'] = b['tip'] = tip['_id']
+                self._build_pending(b, b['changes'])
+                self._insert_pending()
+
+            written.extend(docs)
+
+        records = []
+        for commit in written:
+            p = self._get_commit(commit['pid'])
+            records.extend(self._history_records(commit, p['tid'] if p else None))
+        history = self.adapter.get_collection('history')
+        for i in range(0, len(records), n):
+            history.insert(records[i:i + n])
+
+        self._pending = None
+        return len(written)
+
     def get_commits(self):
         return list(self.walk_commits())
 
     def get_head_ref(self):
         return self._get_head()['ref']
 
-    def walk_commits(self, ref=None):
+    def walk_commits(self, ref=None, start=None):
         """
+            yield the commits of ``ref`` newest first following the first parent.
+            if ``start``, a commit id, is given the walk begins there instead.
+
+            each commit stores the ids of its next ``ancestry_depth`` ancestors so
+            they are fetched with a single query
         """
         if ref is None:
             head = self._get_head()
             ref = head['ref']
 
         def gen():
-            cid = self._get_ref(ref)['cid']
-            while 1:
-                commit = self._get_commit(cid)
+            if start is not None:
+                commit = self._get_commit(start)
+            else:
+                commit = self._get_commit(self._get_ref(ref)['cid'])
+
+            while commit:
                 yield commit
-                cid = commit['pid']
-                if not cid:
-                    break
 
-        return gen()
+                ancestors = commit.get('ancestors')
+                if not ancestors:
+                    commit = self._get_commit(commit['pid'])
+                    continue
 
-    #private
-    def _get_parent_tree(self, path):
-        wtree = self._get_working_tree()
-        if path == '/':
-            return wtree
-        else:
-            args = path.split('/')
-            if len(args) > 2:
-                name = '/'.join(args[:-1])
-            else:
-                name = '/'
-
-            r = self._get_tree(name)
-            return r
+                commits = self._get_commits(ancestors)
+                for aid in ancestors[:-1]:
+                    yield commits[aid]
+                commit = commits[ancestors[-1]]
 
-    def _is_staged(self, blob):
-        idx = self.get_index()
-        # print idx['objects']
-        for _, oi, _ in idx['objects']:
-            # print oi, blob['_id']
-            if oi == blob['_id']:
-                return True
+        return gen()
 
+    #private
     def _clean_stage(self):
         idx = self.adapter.get_collection('index')
-        idx.update({'kind': 'index'}, {'$set': {'objects': [],
-                                                'trees': [],
-                                                'blobs': []}})
+        idx.remove({'kind': 'entry'})
+
+    def _migrate_index(self, idx):
+        """
+            convert a single document index into one entry per staged path
+        """
+        col = self.adapter.get_collection('index')
+        blobs = self._get_objects([o[1] for o in idx['objects']])
+        entries = []
+        for parent, oid, action in idx['objects']:
+            blob = blobs.get(oid)
+            if blob:
+                entries.append({'_id': blob['path_sha1'], 'kind': 'entry',
+                                'path': blob['name'], 'parent': parent,
+                                'oid': oid, 'action': action})
+        if entries:
+            col.insert(entries)
+        col.remove({'_id': idx['_id']})
 
     def _get_commit(self, cid):
-        ts = self.adapter.get_collection('commits')
-        q = {'_id': cid}
-        return ts.find_one(q)
+        if cid is None:
+            return
+
+        if self._pending and cid in self._pending['commits']:
+            return self._pending['commits'][cid]
+
+        commit = self.commit_cache.get(cid)
+        if commit is None:
+            ts = self.adapter.get_collection('commits')
+            q = {'_id': cid}
+            commit = ts.find_one(q)
+            if commit:
+                self.commit_cache[cid] = commit
+        return commit
+
+    def _get_commits(self, cids):
+        """
+            return a dict of commits keyed by id. commits not in the cache are
+            fetched with a single query
+        """
+        cache = self.commit_cache
+        buffered = self._pending['commits'] if self._pending else {}
+        commits = {}
+        missing = []
+        for cid in cids:
+            commit = buffered.get(cid) or cache.get(cid)
+            if commit is None:
+                missing.append(cid)
+            else:
+                commits[cid] = commit
+
+        if missing:
+            ts = self.adapter.get_collection('commits')
+            for commit in ts.find({'_id': {'$in': missing}}):
+                cache[commit['_id']] = commit
+                commits[commit['_id']] = commit
+        return commits
 
     def _get_tree(self, name):
-        if isinstance(name, (str, unicode)):
+        if isinstance(name, (str, unicode)) and name.startswith('/'):
             return self._get_tree_path(name)
         else:
             objects = self.adapter.get_collection('objects')
             return objects.find_one({'_id': name})
 
     def _get_tree_path(self, name):
-        wtree = self._get_working_tree()
-        if wtree:
-            return self.find_tree(wtree, name)
+        oid = self._get_path_id(name)
+        if oid is not None:
+            objects = self.adapter.get_collection('objects')
+            return objects.find_one({'_id': oid})
+
+    def _get_path_id(self, path):
+        """
+            return the id of the working tree object at ``path`` using the path index
+        """
+        paths = self.adapter.get_collection('paths')
+        p = paths.find_one({'_id': path})
+        if p:
+            return p['oid']
+
+    def _set_path_id(self, path, oid, kind):
+        paths = self.adapter.get_collection('paths')
+        paths.update({'_id': path}, {'$set': {'oid': oid, 'kind': kind}}, upsert=True)
 
-    def find_tree(self, root, name):
-        if not root:
+    def _get_path_ids(self, paths):
+        """
+            return a dict of path: object id for ``paths`` that are in the working tree
+        """
+        col = self.adapter.get_collection('paths')
+        paths = list(paths)
+        n = self.batch_size
+        ids = {}
+        for i in range(0, len(paths), n):
+            for p in col.find({'_id': {'$in': paths[i:i + n]}}):
+                ids[p['_id']] = p['oid']
+        return ids
+
+    def _set_path_ids(self, entries):
+        """
+            bulk replace the path index entries for a list of (path, oid, kind)
+        """
+        if not entries:
             return
-        elif root['name'] == name:
-            return root
+
+        col = self.adapter.get_collection('paths')
+        n = self.batch_size
+        for i in range(0, len(entries), n):
+            es = entries[i:i + n]
+            col.remove({'_id': {'$in': [e[0] for e in es]}})
+            col.insert([{'_id': p, 'oid': oid, 'kind': kind} for p, oid, kind in es])
+
+    def _add_batch(self, items):
+        #the last version of a path in the batch wins
+        blobs = OrderedDict()
+        for parent, name, doc in items:
+            blob = self._create_blob(parent, name, doc)
+            blobs[blob['name']] = (parent, blob)
+
+        current = self._get_path_ids(blobs.keys())
+        changed = []
+        for path, (parent, blob) in blobs.iteritems():
+            oid = current.get(path)
+            if oid != blob['_id']:
+                changed.append((parent, blob, oid))
+
+        if not changed:
+            return
+
+        self._put_blobs(changed)
+        self._set_path_ids([(blob['name'], blob['_id'], 'blob') for _, blob, _ in changed])
+
+        self._stage(changed)
+
+        #make new trees for each ancestor. the working tree is updated in place
+        self._rewrite_trees([(parent, oid, blob['_id']) for parent, blob, oid in changed])
+
+    def _put_blobs(self, changed):
+        """
+            store the blobs of ``changed``, (parent, blob, previous blob id), delta
+            encoded if ``delta_interval`` is set
+        """
+        if self.delta_interval:
+            self._put_objects(self._encode_deltas(changed))
         else:
-            col = self.adapter.get_collection('objects')
+            self._put_objects([blob for _, blob, _ in changed])
+
+    def _encode_deltas(self, changed):
+        """
+            return the documents to store for ``changed``, (parent, blob, previous
+            blob id). a blob with a previous version is stored as the changes to it
+            unless the chain would reach ``delta_interval`` or the delta is not smaller
+        """
+        prev = self._get_objects([oid for _, _, oid in changed if oid is not None])
+        prev = dict((o['_id'], o) for o in prev.itervalues())
+        depths = dict((oid, o['delta']['depth'] if 'delta' in o else 0)
+                      for oid, o in prev.iteritems())
+        prev = dict((o['_id'], o) for o in self._expand_blobs(prev.values()))
+
+        docs = []
+        for _, blob, oid in changed:
+            content = blob_content(blob)
+            depth = depths.get(oid, 0) + 1
+            if oid not in prev or depth >= self.delta_interval:
+                docs.append(blob)
+                continue
+
+            changes = [(c.path, c.kind, c.new)
+                       for c in diff_documents(blob_content(prev[oid]), content)]
+            if len(self._encode(changes)) >= len(self._encode(content)):
+                docs.append(blob)
+                continue
+
+            doc = dict((k, blob[k]) for k in BLOB_KEYS if k in blob)
+            doc['delta'] = {'base': oid, 'depth': depth, 'changes': changes}
+            docs.append(doc)
+            self.version_cache[blob['_id']] = deepcopy(content)
+        return docs
+
+    def _expand_blobs(self, blobs, fields=None):
+        """
+            return ``blobs`` with the delta encoded ones replaced by their full
+            documents, limited to ``fields`` if given. the bases of a chain are
+            fetched one level at a time and reconstructed versions are cached
+        """
+        if not any('delta' in b for b in blobs):
+            return blobs
+
+        #other blobs may be projected so only the delta encoded ones are reused
+        objs = dict((b['_id'], b) for b in blobs if 'delta' in b)
+        level = delta_bases(blobs, objs, self.version_cache)
+        while level:
+            fetched = self._get_objects(level)
+            objs.update(fetched)
+            level = delta_bases(fetched.itervalues(), objs, self.version_cache)
+        return expand_deltas(blobs, objs, self.version_cache, fields)
+
+    def _stage(self, changed):
+        """
+            stage a list of (parent, blob, previous blob id). entries are keyed by
+            path_sha1 so only the staged entries for these paths are read
+        """
+        col = self.adapter.get_collection('index')
+        keys = [blob['path_sha1'] for _, blob, _ in changed]
+        staged = set(e['_id'] for e in col.find({'_id': {'$in': keys}}, {'_id': 1}))
+
+        entries = []
+        for parent, blob, oid in changed:
+            key = blob['path_sha1']
+            if key in staged:
+                # if blob is already in staging area replace the staged version
+                col.update({'_id': key}, {'$set': {'oid': blob['_id']}})
+            else:
+                entries.append({'_id': key, 'kind': 'entry',
+                                'path': blob['name'], 'parent': parent,
+                                'oid': blob['_id'],
+                                'action': 'new file' if oid is None else 'modified'})
+        if entries:
+            col.insert(entries)
+
+    def _rewrite_trees(self, changes, trees=None):
+        """
+            apply ``changes``, a list of (tree path, old blob id, new blob id), to the
+            working tree. trees are immutable so a new tree is stored for each affected
+            path and its ancestors. trees are rewritten deepest first and each only once.
+            missing trees are created and the working tree is updated in place.
+
+            if ``trees``, a dict of path: tree of a committed tree, the changes are
+            applied to it instead and the id of the new root tree is returned
+        """
+        working = trees is None
+        if working:
+            trees = self._get_trees(tree_paths(p for p, _, _ in changes))
+
+        ntrees, npaths, root = self._new_trees(changes, trees)
+        rid = None
+        if root and working:
+            objects = self.adapter.get_collection('objects')
+            objects.update({'_id': root['_id']}, {'$set': {'blobs': root['blobs'],
+                                                           'trees': root['trees']}})
+        elif root:
+            rid = self._tree_id(root)
+            ntrees.append(root)
+
+        self._put_objects(ntrees)
+        if working:
+            self._set_path_ids(npaths)
+        return rid
+
+    def _new_trees(self, changes, trees):
+        """
+            rewrite the trees of ``trees``, a dict of path: tree, affected by ``changes``.
+            return the new trees deepest first, their (path, id, kind) entries and the
+            root. the root is modified in place and not hashed. it is None if no
+            tree changed
+        """
+        pending = {}
+        for path, oid, noid in changes:
+            pending.setdefault(path, ([], []))[0].append((oid, noid))
+
+        ntrees = []
+        npaths = []
+        for path in sorted(tree_paths(pending), key=lambda p: (p == '/', -p.count('/'))):
+            if path not in pending:
+                continue
+
+            t = trees.get(path)
+            if t is None:
+                t = {'_id': None, 'name': path, 'kind': 'tree', 'trees': [], 'blobs': []}
+
+            for key, cs in zip(('blobs', 'trees'), pending[path]):
+                if cs:
+                    children = set(t[key])
+                    for oid, noid in cs:
+                        children.discard(oid)
+                        children.add(noid)
+                    t[key] = sorted(children)
+
+            if path == '/':
+                return ntrees, npaths, t
+
+            tid = t.get('_id')
+            ntid = self._tree_id(t)
+            if ntid != tid:
+                ntrees.append(t)
+                npaths.append((path, ntid, 'tree'))
+                pending.setdefault(parent_path(path), ([], []))[1].append((tid, ntid))
+
+        return ntrees, npaths, None
+
+    def _get_trees(self, paths):
+        """
+            return the working tree trees at ``paths`` keyed by path
+        """
+        ids = self._get_path_ids(paths)
+        objs = self._get_objects(ids.values())
+        return dict((p, objs[oid]) for p, oid in ids.iteritems() if oid in objs)
+
+    def _put_tree(self, tree):
+        """
+            store ``tree`` keyed by the digest of its name and sorted children
+        """
+        tree['trees'] = sorted(tree['trees'])
+        tree['blobs'] = sorted(tree['blobs'])
+        self._tree_id(tree)
+        return self._put_object(tree)
+
+    def _tree_id(self, tree):
+        """
+            set and return the id of ``tree``. children must be sorted
+        """
+        tree['_id'] = self._digest(tree['name'],
+                                   *([str(ti) for ti in tree['trees']] + ['|'] +
+                                     [str(bi) for bi in tree['blobs']]))
+        return tree['_id']
+
+    def _put_object(self, obj):
+        """
+            insert a content addressed object. objects that already exist are shared.
+            a duplicate key on any other index is raised
+        """
+        objects = self.adapter.get_collection('objects')
+        try:
+            objects.insert(obj)
+        except DuplicateKeyError:
+            if not objects.find_one({'_id': obj['_id']}, {'_id': 1}):
+                raise
+        return obj['_id']
+
+    def _put_objects(self, objs):
+        """
+            bulk insert content addressed objects skipping those that already exist
+        """
+        if not objs:
+            return
+
+        objects = self.adapter.get_collection('objects')
+        existing = self._get_objects([o['_id'] for o in objs], {'_id': 1})
+        objs = [o for o in objs if o['_id'] not in existing]
+        if objs and self._buffering:
+            for o in objs:
+                self._pending['objects'][o['_id']] = o
+        elif objs:
+            try:
+                objects.insert(objs)
+            except (DuplicateKeyError, BulkWriteError):
+                #inserted concurrently. fall back to one at a time
+                for o in objs:
+                    self._put_object(o)
+
+    def _resolve_path(self, root, path):
+        """
+            descend from ``root`` to ``path``. each level is a single query for the
+            child of the current tree with the matching name
+        """
+        if not root or path == '/':
+            return root
+
+        obj = root
+        for name, last in path_names(path):
+            ids = obj['trees'] + obj['blobs'] if last else obj['trees']
+            obj = self._find_child(ids, name)
+            if obj is None:
+                break
+        return obj
 
-            basename = name.split('/')[1:-1]
-            basename = '/{}'.format('/'.join(basename))
-            nroot = None
-            for ti in root['trees']:
-                tt = col.find_one({'_id': ti})
-                if tt['name'] in (name, basename):
-                    nroot = tt
+    def _find_child(self, oids, name):
+        m = self.adapter.get_collection('objects')
+        n = self.batch_size
+        for i in range(0, len(oids), n):
+            obj = m.find_one({'_id': {'$in': oids[i:i + n]}, 'name': name})
+            if obj:
+                return obj
 
-            return self.find_tree(nroot, name)
+    def _join_path(self, parent, name):
+        if parent == '/':
+            return '/{}'.format(name)
+        return '{}/{}'.format(parent, name)
 
     def _get_working_tree(self):
         objects = self.adapter.get_collection('objects')
         return objects.find_one({'kind': 'wtree'})
 
     def _create_blob(self, parent, name, doc):
-        sha = self._digest(parent, name, doc)
-        if parent == '/':
-            pname = '/{}'.format(name)
-        else:
-            pname = '{}/{}'.format(parent, name)
+        """
+            return a new blob document for ``doc``. ``doc`` is not modified and any
+            engine keys it carries, e.g. from a fetched blob, are ignored
+        """
+        doc = blob_content(doc)
+        pname = self._join_path(parent, name)
+        sha = self._digest(pname, doc)
 
-        doc.update({'name': pname,
+        doc.update({'_id': sha,
+                    'name': pname,
                     'kind':'blob',
-                    'path_sha1': self._digest(parent, name),
+                    'path_sha1': self._path_digest(pname),
                     'sha1': sha})
         return doc
 
@@ -544,18 +1576,972 @@ Date: {}
         m = self.adapter.get_collection('HEAD')
         return m.find_one({'name': 'HEAD'})
 
-    def _get_object(self, value, key='_id'):
+    def _get_object(self, value, key='_id', fields=None):
+        if key == '_id' and self._pending and value in self._pending['objects']:
+            return project(self._pending['objects'][value], fields)
+
         m = self.adapter.get_collection('objects')
-        return m.find_one({key: value})
+        return m.find_one({key: value}, fields)
+
+    def _get_objects(self, oids, fields=None):
+        """
+            fetch many objects using ``$in`` queries of at most ``batch_size`` ids.
+            return a dict keyed by _id
+        """
+        objs = {}
+        if self._pending and self._pending['objects']:
+            buffered = self._pending['objects']
+            for oid in oids:
+                if oid in buffered:
+                    objs[oid] = project(buffered[oid], fields)
+            oids = [oid for oid in oids if oid not in objs]
+
+        m = self.adapter.get_collection('objects')
+        n = self.batch_size
+        for i in range(0, len(oids), n):
+            q = {'_id': {'$in': oids[i:i + n]}}
+            if fields:
+                cursor = m.find(q, fields)
+            else:
+                cursor = m.find(q)
+
+            for obj in cursor:
+                objs[obj['_id']] = obj
+        return objs
 
     def _digest(self, *args):
+        """
+            sha1 of ``args``. each part is prefixed with its length so the parts
+            cannot run into each other, e.g. '/a', 'bc' and '/ab', 'c'
+        """
         sha = hashlib.sha1()
         for ai in args:
             if isinstance(ai, dict):
-                ai=hashlib.sha1(repr(sorted(ai.items()))).hexdigest()
+                ai=hashlib.sha1(self._encode(ai)).hexdigest()
+            sha.update('{}:'.format(len(ai)))
             sha.update(ai)
         return sha.hexdigest()
 
+    def _encode(self, obj):
+        #canonical encoding. keys are sorted at every level
+        return json.dumps(obj, sort_keys=True, default=default)
+
+    def _diff_blob_pairs(self, pairs):
+        """
+            yield (path, changes) for an iterable of (path, old blob id, new blob id).
+            tree pairs are passed as documents and diffed with ``diff_trees``.
+            blobs are fetched in bulk ``batch_size`` pairs at a time
+        """
+        batch = []
+        for pair in pairs:
+            batch.append(pair)
+            if len(batch) == self.batch_size:
+                for item in self._diff_blob_batch(batch):
+                    yield item
+                batch = []
+
+        for item in self._diff_blob_batch(batch):
+            yield item
+
+    def _diff_blob_batch(self, batch):
+        ids = [i for _, a, b in batch for i in (a, b)
+               if i is not None and not isinstance(i, dict)]
+        blobs = self._get_objects(ids)
+        blobs = dict((o['_id'], o) for o in self._expand_blobs(blobs.values()))
+
+        def changes(a, b):
+            if a is None and b is None:
+                return []
+            elif isinstance(a, dict) or isinstance(b, dict):
+                return list(self.diff_trees(a, b))
+            a = blob_content(blobs[a]) if a else {}
+            b = blob_content(blobs[b]) if b else {}
+            return list(diff_documents(a, b))
+
+        for path, a, b in batch:
+            if a is not None and b is not None and isinstance(a, dict) != isinstance(b, dict):
+                #a tree replaced by a blob or the reverse is a delete plus an add
+                yield path, changes(a, None) + changes(None, b)
+            else:
+                yield path, changes(a, b)
+
+    def _diff_trees(self, a, b):
+        """
+            the lockstep tree diff. yields (Change, object kind)
+        """
+        empty = {'_id': None, 'trees': [], 'blobs': []}
+        a = a or empty
+        b = b or empty
+        fields = {'name': 1, 'kind': 1, 'trees': 1, 'blobs': 1}
+
+        #stack of ('pair', left tree, right tree), ('change', (change, kind))
+        #and ('subtree', tree, kind)
+        stack = [('pair', a, b)]
+        while stack:
+            item = stack.pop()
+            tag = item[0]
+            if tag == 'change':
+                yield item[1]
+                continue
+            elif tag == 'subtree':
+                #everything below an added or removed tree
+                _, tree, kind = item
+                for o in self.walk_tree(tree, return_object=True, fields={'kind': 1}):
+                    yield subtree_change(o, kind)
+                continue
+
+            _, ta, tb = item
+            if ta['_id'] == tb['_id']:
+                continue
+
+            objs = self._get_objects(tree_pair_ids(ta, tb), fields)
+            stack.extend(reversed(diff_tree_pair(ta, tb, objs)))
+
+    def _resolve_paths(self, root, paths):
+        """
+            resolve many ``paths`` below ``root`` sharing the work. each tree level
+            is a single query (per ``batch_size`` ids) for all paths at that depth.
+            return a dict of path: object with only name, kind, trees and blobs
+        """
+        fields = {'name': 1, 'kind': 1, 'trees': 1, 'blobs': 1}
+        found = {'/': root}
+
+        m = self.adapter.get_collection('objects')
+        n = self.batch_size
+        for names in path_levels(paths):
+            ids = level_ids(names, found)
+            if self._pending and self._pending['objects']:
+                buffered = self._pending['objects']
+                for oid in ids & set(buffered):
+                    obj = buffered[oid]
+                    if obj['name'] in names:
+                        found[obj['name']] = project(obj, fields)
+                ids -= set(buffered)
+
+            ids = list(ids)
+            for i in range(0, len(ids), n):
+                q = {'_id': {'$in': ids[i:i + n]}, 'name': {'$in': names}}
+                for obj in m.find(q, fields):
+                    found[obj['name']] = obj
+
+        return found
+
+    def _record_history(self, commit, ptid):
+        """
+            add a history record for every blob changed by ``commit`` relative to the
+            parent tree ``ptid``
+        """
+        history = self.adapter.get_collection('history')
+        records = []
+        for r in self._history_records(commit, ptid):
+            records.append(r)
+            if len(records) == self.batch_size:
+                history.insert(records)
+                records = []
+
+        if records:
+            history.insert(records)
+
+    def _history_records(self, commit, ptid):
+        """
+            yield the history records of ``commit``. the tree diff skips unchanged
+            subtrees
+        """
+        a = self._get_object(ptid) if ptid else None
+        b = self._get_object(commit['tid'])
+
+        for c, kind in self._diff_trees(a, b):
+            if kind == 'blob':
+                yield self._history_record(commit, c)
+
+    def _history_record(self, commit, change):
+        return {'path_sha1': self._path_digest(change.path),
+                'path': change.path,
+                'cid': commit['_id'],
+                'oid': change.new,
+                'action': change.kind,
+                'generation': commit.get('generation'),
+                'timestamp': commit.get('timestamp')}
+
+    def _first_parent_ids(self, tip, generations):
+        """
+            return a dict of generation: id of the commit at that generation on the
+            first parent chain of ``tip``. the chain is jumped along with the skip
+            lists, only the commits jumped to are fetched
+        """
+        ids = {}
+        commit = tip
+        for g in sorted(set(generations), reverse=True):
+            while commit and commit['generation'] > g:
+                if 'skips' in commit:
+                    #the farthest skip that does not pass g
+                    skip = None
+                    for sid, sg in reversed(commit['skips']):
+                        if sg >= g:
+                            skip = sid
+                            break
+                    if skip is None:
+                        #g is not on the chain
+                        break
+                    commit = self._get_commit(skip)
+                    continue
+
+                #commits without skip lists have no merges below them
+                ancestors = commit.get('ancestors') or [commit['pid']]
+                d = commit['generation'] - g
+                if d <= len(ancestors):
+                    ids[g] = ancestors[d - 1]
+                    break
+                commit = self._get_commit(ancestors[-1])
+            else:
+                if commit and commit['generation'] == g:
+                    ids[g] = commit['_id']
+        return ids
+
+    def _seek_until(self, ref, until):
+        """
+            return the newest commit on the first parent history of ``ref`` made at or
+            before ``until``. candidates come newest first from the timestamp index
+            and are checked against the chain ``batch_size`` at a time. return None
+            if there is none
+        """
+        tip = self._resolve_commit(ref)
+        if tip is None:
+            return
+
+        commits = self.adapter.get_collection('commits')
+        q = {'timestamp': {'$lte': until}, 'generation': {'$lte': tip['generation']}}
+        cursor = commits.find(q, {'generation': 1}).sort('timestamp', -1)
+        while True:
+            batch = list(islice(cursor, self.batch_size))
+            if not batch:
+                break
+
+            on = self._first_parent_ids(tip, [c['generation'] for c in batch])
+            for c in batch:
+                if on.get(c['generation']) == c['_id']:
+                    return self._get_commit(c['_id'])
+
+        #commits written without a timestamp are only found by walking
+        if commits.find_one({'timestamp': {'$exists': False}}, {'_id': 1}):
+            return tip
+
+    def _get_field(self, doc, field):
+        for key in field.split('.'):
+            if not isinstance(doc, dict):
+                return
+            doc = doc.get(key)
+        return doc
+
+    def _mark_commits(self, cids):
+        """
+            mark the trees of the commits reachable from ``cids``. the frontier is
+            kept in the ``gc`` collection and walked ``batch_size`` commits at a time.
+            marked commits are not walked again so shared history is visited once
+        """
+        self._mark(cids, 'commit')
+        for chunk in self._pending_marks('commit'):
+            commits = self._get_commits(chunk).values()
+            self._mark_objects([c['tid'] for c in commits])
+            self._mark([pid for c in commits for pid in self._parent_ids(c)], 'commit')
+
+    def _mark_objects(self, oids):
+        """
+            mark ``oids`` and every object they reference, trees, blobs and the bases
+            of delta encoded blobs. the frontier is kept in the ``gc`` collection and
+            walked ``batch_size`` objects at a time. marked trees are not descended
+        """
+        self._mark(oids, 'object')
+        for chunk in self._pending_marks('object'):
+            children = []
+            for obj in self._get_objects(chunk, {'trees': 1, 'blobs': 1, 'delta.base': 1}).itervalues():
+                children.extend(obj.get('trees', []))
+                children.extend(obj.get('blobs', []))
+                if 'delta' in obj:
+                    children.append(obj['delta']['base'])
+            self._mark(children, 'object')
+
+    def _mark(self, ids, kind):
+        """
+            mark the unmarked ``ids`` as ``kind``, 'commit' or 'object', still to be walked
+        """
+        marks = self.adapter.get_collection('gc')
+        ids = list(set(ids))
+        n = self.batch_size
+        for i in range(0, len(ids), n):
+            chunk = ids[i:i + n]
+            marked = set(m['_id'] for m in marks.find({'_id': {'$in': chunk}}, {'_id': 1}))
+            new = [{'_id': o, 'todo': kind} for o in chunk if o not in marked]
+            if new:
+                marks.insert(new)
+
+    def _pending_marks(self, kind):
+        """
+            yield the ids marked as ``kind`` still to be walked, at most ``batch_size``
+            at a time. yielded ids are marked as walked
+        """
+        marks = self.adapter.get_collection('gc')
+        while True:
+            chunk = [m['_id'] for m in marks.find({'todo': kind}, {'_id': 1}).limit(self.batch_size)]
+            if not chunk:
+                break
+
+            marks.update({'_id': {'$in': chunk}}, {'$unset': {'todo': 1}}, multi=True)
+            yield chunk
+
+    def _new_objects(self, oids, seen, fields=None, target=None):
+        """
+            yield the objects reachable from ``oids`` that are not in ``seen``, level by
+            level, and add them to ``seen``. trees in ``seen`` are not descended.
+            the bases of delta encoded blobs are included. if ``target``, another
+            engine, the objects it already has are skipped and not descended
+        """
+        level = oids
+        while level:
+            level = [o for o in set(level) if o not in seen]
+            seen.update(level)
+
+            nlevel = []
+            for i in range(0, len(level), self.batch_size):
+                chunk = level[i:i + self.batch_size]
+                if target is not None:
+                    have = target._get_objects(chunk, {'_id': 1})
+                    chunk = [o for o in chunk if o not in have]
+
+                for obj in self._get_objects(chunk, fields).itervalues():
+                    nlevel.extend(obj.get('trees', []))
+                    nlevel.extend(obj.get('blobs', []))
+                    if 'delta' in obj:
+                        nlevel.append(obj['delta']['base'])
+                    yield obj
+            level = nlevel
+
+    def _changed_objects(self, atid, btid, seen):
+        """
+            yield the objects of the tree ``btid`` that are not in the tree ``atid``
+            and not in ``seen``, and add them to ``seen``. trees are compared by id
+            level by level like ``diff_trees`` so shared subtrees are not read.
+            the objects of ``atid`` that are read are added to ``seen``
+        """
+        empty = {'_id': None, 'trees': [], 'blobs': []}
+        a = self._get_object(atid) if atid else empty
+        b = self._get_object(btid)
+        if a['_id'] == b['_id']:
+            return
+
+        if b['_id'] not in seen:
+            seen.add(b['_id'])
+            yield b
+
+        def new_blob(obj):
+            if obj['_id'] not in seen:
+                seen.add(obj['_id'])
+                yield obj
+                if 'delta' in obj:
+                    for o in self._new_objects([obj['delta']['base']], seen):
+                        yield o
+
+        stack = [(a, b)]
+        while stack:
+            ta, tb = stack.pop()
+            objs = self._get_objects(tree_pair_ids(ta, tb))
+            seen.update(i for i in ta['trees'] + ta['blobs'] if i in objs)
+            for item in diff_tree_pair(ta, tb, objs):
+                if item[0] == 'pair':
+                    _, l, r = item
+                    if r['_id'] not in seen:
+                        seen.add(r['_id'])
+                        yield r
+                    stack.append((l, r))
+                elif item[0] == 'subtree':
+                    _, tree, kind = item
+                    if kind == ADDED:
+                        for o in self._new_objects([tree['_id']], seen):
+                            yield o
+                else:
+                    change, kind = item[1]
+                    if kind == 'blob' and change.new is not None:
+                        for o in new_blob(objs[change.new]):
+                            yield o
+
+    def _transfer(self, target, tip):
+        """
+            copy the commits of ``tip`` that ``target``, another engine, is missing
+            and the objects they need. the cost scales with the new commits and
+            objects. return the number of commits copied
+        """
+        missing = self._missing_commits(tip, target._get_commits)
+
+        objs = []
+        for obj in self._new_objects([c['tid'] for c in missing], set(), target=target):
+            objs.append(obj)
+            if len(objs) == self.batch_size:
+                target._put_objects(objs)
+                objs = []
+        target._put_objects(objs)
+
+        target._put_commits(missing)
+        return len(missing)
+
+    def _missing_commits(self, tip, known):
+        """
+            return the commits reachable from ``tip`` that are not ``known``, oldest
+            first. ``known`` takes a list of ids and returns the known ones.
+            first parent chains are walked ``batch_size`` commits at a time and
+            stop at the first known commit. other parents of merges are walked
+            the same way
+        """
+        missing = {}
+        tips = [tip]
+        while tips:
+            commits = self.walk_commits(start=tips.pop()['_id'])
+            while True:
+                batch = list(islice(commits, self.batch_size))
+                chain = list(takewhile(lambda c: c['_id'] not in missing, batch))
+                have = known([c['_id'] for c in chain])
+                new = list(takewhile(lambda c: c['_id'] not in have, chain))
+                for c in new:
+                    missing[c['_id']] = c
+                    tips.extend(self._get_commits(self._parent_ids(c)[1:]).values())
+
+                if len(new) < self.batch_size:
+                    break
+
+        #a parent's generation is always lower than its children's
+        return sorted(missing.values(), key=lambda c: c['generation'])
+
+    def _commit(self, branch, msg, tid, parents, rebase):
+        """
+            insert a commit of the tree ``tid`` and move ``branch`` to it if it still
+            points at ``parents[0]``. otherwise the commit is removed and retried on the
+            branch's new commit with the tree returned by ``rebase(parent, tip, tid)``.
+            return the commit id and the committed tree id
+        """
+        commits = self.adapter.get_collection('commits')
+        while True:
+            p = self._get_commit(parents[0]) if parents else None
+            others = self._get_commits(parents[1:])
+            commit = self._new_commit(msg, tid, p, [others[o] for o in parents[1:]])
+            cid = commits.insert(commit)
+            if self.update_ref(branch, cid, expected=p['_id'] if p else None):
+                break
+
+            commits.remove({'_id': cid})
+            tip = self._resolve_commit(branch)
+            tid = rebase(p, tip, tid)
+            parents = [tip['_id']] + parents[1:]
+
+        self._record_history(commit, p['tid'] if p else None)
+        return cid, tid
+
+    def _new_commit(self, msg, tid, p, others):
+        """
+            return a commit document for the tree ``tid`` with the parent commit ``p``
+            and the other parents ``others`` of a merge
+        """
+        return self._commit_doc(msg, tid, p, others, self._skips(p))
+
+    def _commit_doc(self, msg, tid, p, others, skips):
+        if p:
+            pid = p['_id']
+            generation = max(c.get('generation', 0) for c in [p] + others) + 1
+            ancestors = [pid] + p.get('ancestors', [])[:self.ancestry_depth - 1]
+            merge_gen = generation if others else p.get('merge_gen', 0)
+        else:
+            pid = None
+            generation = 1
+            ancestors = []
+            merge_gen = 0
+
+        commit = {'pid': pid,
+                  'tid': tid,
+                  'msg': msg,
+                  'author': 'foo',
+                  'generation': generation,
+                  'ancestors': ancestors,
+                  'skips': skips,
+                  'merge_gen': merge_gen,
+                  'timestamp': datetime.utcnow()}
+        if others:
+            commit['pids'] = [pid] + [c['_id'] for c in others]
+        return commit
+
+    def _apply_blobs(self, root_tid, blobs):
+        """
+            return the id of the committed tree ``root_tid`` with ``blobs``, a dict of
+            path: (parent, blob), added. only the trees above the blobs are read.
+            the changed blobs are stored, delta encoded against the version they replace
+        """
+        root = self._get_object(root_tid) if root_tid else None
+        if root is None:
+            root = {'_id': None, 'name': '/', 'kind': 'tree', 'trees': [], 'blobs': []}
+
+        found = self._resolve_paths(root, blobs.keys())
+        changed = []
+        for path, (parent, blob) in blobs.iteritems():
+            old = found.get(path)
+            oid = old['_id'] if old and old['kind'] == 'blob' else None
+            if oid != blob['_id']:
+                changed.append((parent, blob, oid))
+
+        if not changed:
+            return root['_id']
+
+        self._put_blobs(changed)
+        return self._rewrite_trees([(parent, oid, blob['_id']) for parent, blob, oid in changed], found)
+
+    def _buffer_commit(self, branch, msg, blobs):
+        """
+            add a commit of ``blobs`` on top of the buffered commits of ``branch``.
+            flush when ``flush_size`` commits are buffered or the oldest is older than
+            ``flush_interval``. return the commit id
+        """
+        pending = self._pending
+        if pending is None:
+            pending = self._pending = {'objects': OrderedDict(),
+                                       'commits': OrderedDict(),
+                                       'branches': OrderedDict(),
+                                       'time': time.time()}
+
+        b = pending['branches'].get(branch)
+        if b is None:
+            tip = self._resolve_commit(branch)
+            base = tip['_id'] if tip else None
+            b = pending['branches'][branch] = {'base': base, 'tip': base, 'changes': []}
+
+        change = (ObjectId(), msg, blobs)
+        if not self._build_pending(b, [change], skip_empty=True):
+            #the branch already has these blobs
+            return b['tip']
+
+        b['changes'].append(change)
+
+        if len(pending['commits']) >= self.flush_size or \
+                time.time() - pending['time'] >= self.flush_interval:
+            self.flush()
+        return change[0]
+
+    def _build_pending(self, b, changes, skip_empty=False):
+        """
+            build the trees and commits of ``changes``, a list of (commit id, msg,
+            blobs), on the buffered branch ``b`` and add them to the buffer. if
+            ``skip_empty`` a change that leaves the tree as it is makes no commit.
+            return the number of commits built
+        """
+        pending = self._pending
+        n = 0
+        self._buffering = True
+        try:
+            for cid, msg, blobs in changes:
+                p = self._get_commit(b['tip'])
+                tid = self._apply_blobs(p['tid'] if p else None, blobs)
+                if skip_empty and p and tid == p['tid']:
+                    continue
+
+                n += 1
+                commit = self._new_commit(msg, tid, p, [])
+                commit['_id'] = cid
+                pending['commits'][cid] = commit
+                b['tip'] = cid
+        finally:
+            self._buffering = False
+        return n
+
+    def _insert_pending(self):
+        """
+            bulk insert the buffered objects
+        """
+        objs = self._pending['objects']
+        n = self.batch_size
+        values = objs.values()
+        objs.clear()
+        for i in range(0, len(values), n):
+            self._put_objects(values[i:i + n])
+
+    def _put_commits(self, commits):
+        """
+            bulk insert ``commits``, oldest first, copied from another database and
+            record their path history
+        """
+        col = self.adapter.get_collection('commits')
+        for i in range(0, len(commits), self.batch_size):
+            col.insert(commits[i:i + self.batch_size])
+
+        for c in commits:
+            p = self._get_commit(c['pid'])
+            self._record_history(c, p['tid'] if p else None)
+
+    def _is_ancestor(self, cid, tip):
+        """
+            is the commit ``cid`` ``tip`` or one of its ancestors. only commits with
+            a higher generation than ``cid`` are visited and first parent chains
+            without merges above ``cid`` are jumped along with the skip lists
+        """
+        commit = self._get_commit(cid)
+        if commit is None or tip is None:
+            return False
+
+        g = commit['generation']
+        seen = set()
+        stack = [tip]
+        while stack:
+            c = stack.pop()
+            if c['_id'] == cid:
+                return True
+            if c['generation'] <= g or c['_id'] in seen:
+                continue
+
+            seen.add(c['_id'])
+            if c.get('merge_gen', 0) <= g:
+                if self._first_parent_ids(c, [g]).get(g) == cid:
+                    return True
+            else:
+                stack.extend(self._get_commits(self._parent_ids(c)).values())
+        return False
+
+    def _ahead_behind(self, a, b):
+        """
+            return the number of commits reachable from ``a`` and not ``b`` and from
+            ``b`` and not ``a``. commits are visited highest generation first and the
+            walk stops when every pending commit is reachable from both
+        """
+        for x, y, swap in ((a, b, False), (b, a, True)):
+            #a first parent chain without merges has consecutive generations
+            g = y['generation']
+            if x.get('merge_gen', 0) <= g and self._first_parent_ids(x, [g]).get(g) == y['_id']:
+                n = x['generation'] - g
+                return (0, n) if swap else (n, 0)
+
+        flags = {a['_id']: 1}
+        flags[b['_id']] = flags.get(b['_id'], 0) | 2
+        heap = [(-a['generation'], a['_id'])]
+        if b['_id'] != a['_id']:
+            heap.append((-b['generation'], b['_id']))
+        heapq.heapify(heap)
+
+        counts = {1: 0, 2: 0, 3: 0}
+        pending = sum(1 for _, cid in heap if flags[cid] != 3)
+        while heap and pending:
+            _, cid = heapq.heappop(heap)
+            f = flags[cid]
+            counts[f] += 1
+            if f != 3:
+                pending -= 1
+
+            for p in self._get_commits(self._parent_ids(self._get_commit(cid))).itervalues():
+                old = flags.get(p['_id'])
+                if old is None:
+                    flags[p['_id']] = f
+                    heapq.heappush(heap, (-p['generation'], p['_id']))
+                    if f != 3:
+                        pending += 1
+                elif old | f != old:
+                    flags[p['_id']] = old | f
+                    if old | f == 3:
+                        pending -= 1
+        return counts[1], counts[2]
+
+    def _skips(self, parent):
+        """
+            return the skip list of a child of ``parent``. [id, generation] of the
+            first parent ancestors at distance 1, 2, 4, 8 ...
+        """
+        if parent is None:
+            return []
+
+        skips = [[parent['_id'], parent['generation']]]
+        c = parent
+        while True:
+            s = next_skip(skips, c)
+            if s is None:
+                return skips
+
+            skips.append(s)
+            c = self._get_commit(s[0])
+
+    def _merge_base(self, a, b):
+        """
+            return the common ancestor of the commits ``a`` and ``b`` with the
+            highest generation or None. commits are visited highest generation first
+            so a commit is reached from all its descendants before it is visited
+            and the walk stops at the first commit reached from both sides
+        """
+        flags = {a['_id']: 1}
+        flags[b['_id']] = flags.get(b['_id'], 0) | 2
+        heap = [(-a['generation'], a['_id'])]
+        if b['_id'] != a['_id']:
+            heap.append((-b['generation'], b['_id']))
+        heapq.heapify(heap)
+
+        while heap:
+            _, cid = heapq.heappop(heap)
+            f = flags[cid]
+            if f == 3:
+                return self._get_commit(cid)
+
+            for p in self._get_commits(self._parent_ids(self._get_commit(cid))).itervalues():
+                if p['_id'] not in flags:
+                    flags[p['_id']] = f
+                    heapq.heappush(heap, (-p['generation'], p['_id']))
+                else:
+                    flags[p['_id']] |= f
+
+    def _merge_tree(self, path, base, ours, theirs, conflicts):
+        """
+            three way merge of the trees ``base``, ``ours`` and ``theirs`` (ids or None)
+            at ``path``. subtrees changed on one side only are taken whole, trees
+            changed on both sides are merged recursively and blobs changed on both
+            sides are merged key by key. conflicts are appended to ``conflicts``.
+            only the children that differ between the sides are fetched.
+            return the id of the merged tree
+        """
+        if ours == theirs or base == theirs:
+            return ours
+        if base == ours:
+            return theirs
+
+        ids = [i for i in (base, ours, theirs) if i]
+        trees = self._get_objects(ids, {'trees': 1, 'blobs': 1})
+
+        def child_ids(tid):
+            if tid is None:
+                return set()
+            return set(trees[tid]['trees'] + trees[tid]['blobs'])
+
+        bids, oids, tids = child_ids(base), child_ids(ours), child_ids(theirs)
+
+        #a child shared by ours and theirs is kept. one shared with base is
+        #unchanged on that side so the other side's version, if any, wins
+        shared = oids & tids
+        cids = (bids | oids | tids) - shared - (bids & oids) - (bids & tids)
+        children = self._get_objects(list(cids), {'name': 1, 'kind': 1})
+
+        def entries(tids):
+            return dict((children[c]['name'], children[c]) for c in tids if c in children)
+
+        sides = [entries(bids), entries(oids), entries(tids)]
+        merged = {'name': path, 'kind': 'tree', 'trees': [], 'blobs': []}
+        if shared:
+            for key in ('trees', 'blobs'):
+                merged[key] = [c for c in trees[ours][key] if c in shared]
+        blobs = []
+        for name in sorted(set(sides[0]) | set(sides[1]) | set(sides[2])):
+            b, o, t = [side.get(name) for side in sides]
+            bid, oid, tid = [x['_id'] if x else None for x in (b, o, t)]
+            if oid == tid or bid == tid:
+                obj = o
+            elif bid == oid:
+                obj = t
+            elif o and t and o['kind'] == 'tree' and t['kind'] == 'tree':
+                bid = bid if b and b['kind'] == 'tree' else None
+                merged['trees'].append(self._merge_tree(name, bid, oid, tid, conflicts))
+                continue
+            elif o and t and o['kind'] == 'blob' and t['kind'] == 'blob':
+                blobs.append((name, bid if b and b['kind'] == 'blob' else None, oid, tid))
+                continue
+            else:
+                conflicts.append((name, None))
+                continue
+
+            if obj:
+                merged['blobs' if obj['kind'] == 'blob' else 'trees'].append(obj['_id'])
+
+        if blobs:
+            merged['blobs'].extend(self._merge_blobs(blobs, conflicts))
+
+        return self._put_tree(merged)
+
+    def _merge_blobs(self, blobs, conflicts):
+        """
+            merge a list of (path, base, ours, theirs) blob ids key by key. the blobs
+            are fetched with one query. return the ids of the merged blobs
+        """
+        ids = [i for item in blobs for i in item[1:] if i]
+        objs = dict((o['_id'], o) for o in self._expand_blobs(self._get_objects(ids).values()))
+        content = lambda oid: blob_content(objs[oid]) if oid else {}
+
+        merged = []
+        for path, b, o, t in blobs:
+            doc, cs = merge_documents(content(b), content(o), content(t))
+            conflicts.extend((path, c) for c in cs)
+
+            blob = self._create_blob(parent_path(path), path.split('/')[-1], doc)
+            merged.append(blob)
+
+        self._put_objects(merged)
+        return [blob['_id'] for blob in merged]
+
+    def _parent_ids(self, commit):
+        return commit.get('pids') or ([commit['pid']] if commit['pid'] else [])
+
+    def _reset_working_tree(self, tid, cid):
+        """
+            make the working tree match the committed tree ``tid`` of the commit
+            ``cid``. only the paths that differ are updated in the path index
+        """
+        wtree = self._get_working_tree()
+        tree = self._get_object(tid)
+
+        removed = []
+        entries = {}
+        parents = set()
+        for change, kind in self._diff_trees(wtree, tree):
+            if change.kind == REMOVED:
+                removed.append(change.path)
+            else:
+                entries[change.path] = (change.new, 'blob' if kind == 'blob' else 'tree')
+
+            path = parent_path(change.path)
+            while path != '/' and path not in parents:
+                parents.add(path)
+                path = parent_path(path)
+
+        #trees changed on both sides are not reported by the diff
+        for path, obj in self._resolve_paths(tree, list(parents)).iteritems():
+            if path != '/':
+                entries[path] = (obj['_id'], 'tree')
+
+        paths = self.adapter.get_collection('paths')
+        for i in range(0, len(removed), self.batch_size):
+            paths.remove({'_id': {'$in': removed[i:i + self.batch_size]}})
+        self._set_path_ids([(p, oid, kind) for p, (oid, kind) in entries.iteritems()])
+
+        objects = self.adapter.get_collection('objects')
+        objects.update({'_id': wtree['_id']}, {'$set': {'trees': tree['trees'],
+                                                        'blobs': tree['blobs'],
+                                                        'cid': cid}})
+
+    def _set_remote_ref(self, name, cid):
+        col = self.adapter.get_collection('refs')
+        col.update({'name': name, 'kind': 'remote'}, {'$set': {'cid': cid}}, upsert=True)
+
+    def _sweep(self, dry_run):
+        """
+            remove the unmarked content addressed objects, scanning them in ``_id``
+            order ``batch_size`` at a time
+        """
+        objects = self.adapter.get_collection('objects')
+        marks = self.adapter.get_collection('gc')
+        report = {'reachable': 0, 'unreachable': 0, 'bytes': 0}
+
+        last = ''
+        while True:
+            ids = [o['_id'] for o in objects.find({'_id': {'$gt': last}}, {'_id': 1})
+                                            .sort('_id', 1).limit(self.batch_size)]
+            if not ids:
+                break
+            last = ids[-1]
+
+            marked = set(m['_id'] for m in marks.find({'_id': {'$in': ids}}))
+            garbage = [i for i in ids if i not in marked]
+            report['reachable'] += len(marked)
+            report['unreachable'] += len(garbage)
+            if garbage:
+                q = {'_id': {'$in': garbage}}
+                report['bytes'] += sum(len(BSON.encode(o)) for o in objects.find(q))
+                if not dry_run:
+                    objects.remove(q)
+        return report
+
+    def _path_digest(self, path):
+        """
+            the path_sha1 of a blob at ``path``. staging entries and history records
+            are keyed by it so it hashes the whole path
+        """
+        return self._digest(path)
+
+    def _create_index(self, collection, key, unique):
+        col = self.adapter.get_collection(collection)
+        col.create_index(key, unique=unique)
+
+    def _index_key(self, collection, key):
+        return 'index:{}.{}'.format(collection, key)
+
+    def _resolve_commit(self, ref):
+        """
+            return the commit for a branch or remote ref name or commit id. None is HEAD
+        """
+        if ref is None:
+            ref = self._get_head()['ref']
+
+        if isinstance(ref, (str, unicode)):
+            r = self._get_ref(ref)
+            if r is None:
+                col = self.adapter.get_collection('refs')
+                r = col.find_one({'name': ref, 'kind': 'remote'})
+            if r is None:
+                raise NoBranchError(ref)
+            ref = r['cid']
+
+        return self._get_commit(ref)
+
+    def _reachable_deltas(self, root, bids):
+        """
+            return the delta encoded blobs among ``bids``, the blob ids reachable from
+            the tree ``root``. only ids are read until the reachable ones are known
+        """
+        objects = self.adapter.get_collection('objects')
+        q = reachable_query(root, bids, self.batch_size, {'delta': {'$exists': True}})
+        ids = [o['_id'] for o in objects.find(q, {'_id': 1}) if o['_id'] in bids]
+        objs = self._get_objects(ids)
+        return [objs[oid] for oid in ids if oid in objs]
+
+    def _reachable_blobs(self, root):
+        """
+            return the set of blob ids reachable from the tree ``root``. trees are
+            fetched one level at a time and the result is cached by tree id
+        """
+        bids = self.reachable_cache.get(root['_id'])
+        if bids is None:
+            bids = set(root['blobs'])
+            level = root['trees']
+            fields = {'trees': 1, 'blobs': 1}
+            while level:
+                nlevel = []
+                for t in self._get_objects(level, fields).itervalues():
+                    bids.update(t['blobs'])
+                    nlevel.extend(t['trees'])
+                level = nlevel
+
+            bids = frozenset(bids)
+            self.reachable_cache[root['_id']] = bids
+        return bids
+
+    def _format_log(self, commit):
+        template = '''commit {}
+Author: {}
+Date: {}
+
+    {}\n'''
+        a = commit['author']
+        d = self._commit_time(commit)
+        s = commit['_id']
+        m = commit['msg']
+        return template.format(s, a, d.strftime('%a %b %d %H:%M %Y'), m)
+
+    def _commit_time(self, commit):
+        """
+            return the naive utc time of ``commit``
+        """
+        t = commit.get('timestamp')
+        if t is None:
+            t = self._utc(commit['_id'].generation_time)
+        return t
+
+    def _utc(self, t):
+        if t is not None and t.tzinfo is not None:
+            t = t.astimezone(utc).replace(tzinfo=None)
+        return t
+
+    def _commit_cache_default(self):
+        return LRUCache(self.commit_cache_size)
+
+    def _reachable_cache_default(self):
+        return LRUCache(self.reachable_cache_size, sizeof=len)
+
+    def _version_cache_default(self):
+        return LRUCache(self.version_cache_size)
+
     @property
     def ncollections(self):
         return len(self.adapter.collection_names(include_system_collections=False))
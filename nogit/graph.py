@@ -0,0 +1,221 @@
+#===============================================================================
+# Copyright 2014 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#===============================================================================
+"""
+    the io free steps of walking the object and commit graphs. GitEngine and
+    AsyncGitEngine fetch the documents and call these with the results
+"""
+
+#============= enthought library imports =======================
+#============= standard library imports ========================
+import re
+from copy import deepcopy
+#============= local library imports  ==========================
+from nogit.differ import Change, ADDED, REMOVED, CHANGED, patch_document
+from nogit.query import project
+
+#keys the engine adds to every blob document. delta encoded blobs also carry
+#``delta``, {base: predecessor id, depth: chain length, changes: [(path, kind, new)]}
+BLOB_KEYS = ('_id', 'name', 'kind', 'path_sha1', 'sha1', 'delta')
+
+
+def blob_content(blob):
+    """
+        return ``blob`` without the keys added by the engine
+    """
+    return dict((k, v) for k, v in blob.iteritems() if k not in BLOB_KEYS)
+
+
+#paths
+def parent_path(path):
+    args = path.split('/')
+    if len(args) > 2:
+        return '/'.join(args[:-1])
+    return '/'
+
+
+def tree_paths(paths):
+    """
+        return the set of ``paths`` and all their ancestors including the root
+    """
+    tpaths = set(['/'])
+    for path in paths:
+        while path != '/' and path not in tpaths:
+            tpaths.add(path)
+            path = parent_path(path)
+    return tpaths
+
+
+def path_names(path):
+    """
+        return (name, last) for each object from the child of the root down to
+        ``path``. only the last may be a blob
+    """
+    args = path.rstrip('/').split('/')
+    n = len(args)
+    return [('/'.join(args[:i]), i == n) for i in range(2, n + 1)]
+
+
+def path_levels(paths):
+    """
+        return the lists of ``paths`` and their ancestors, without the root, one
+        per depth shallowest first
+    """
+    depths = {}
+    for path in tree_paths(paths) - set(['/']):
+        depths.setdefault(path.count('/'), []).append(path)
+    return [depths[d] for d in sorted(depths)]
+
+
+def level_ids(names, found):
+    """
+        return the set of child ids of the trees in ``found``, path: object, that
+        are the parents of ``names``
+    """
+    ids = set()
+    for path in names:
+        parent = found.get(parent_path(path))
+        if parent and parent['kind'] != 'blob':
+            ids.update(parent['trees'])
+            ids.update(parent['blobs'])
+    return ids
+
+
+def reachable_query(root, bids, batch_size, *conditions):
+    """
+        return the query for the blobs matching all ``conditions`` limited to the
+        tree ``root`` whose reachable blob ids are ``bids``. if there are more than
+        ``batch_size`` the query is limited by path and its results must be
+        filtered by ``bids``
+    """
+    if len(bids) <= batch_size:
+        q = {'_id': {'$in': list(bids)}}
+    else:
+        q = {'kind': 'blob'}
+        if root['name'] != '/':
+            q['name'] = {'$regex': '^{}/'.format(re.escape(root['name']))}
+
+    q['$and'] = list(conditions)
+    return q
+
+
+#deltas
+def delta_bases(blobs, objs, cache):
+    """
+        return the ids of the bases of the delta encoded ``blobs`` that are not in
+        ``objs``, the fetched objects by id, or ``cache``, the reconstructed versions
+    """
+    bases = set(b['delta']['base'] for b in blobs if 'delta' in b)
+    return [oid for oid in bases if oid not in objs and oid not in cache]
+
+
+def expand_deltas(blobs, objs, cache, fields=None):
+    """
+        return ``blobs`` with the delta encoded ones replaced by their full
+        documents, limited to ``fields`` if given. ``objs`` holds the delta
+        encoded blobs and their bases by id and ``cache`` the reconstructed
+        versions, which are added to it
+    """
+
+    def content(oid):
+        c = cache.get(oid)
+        if c is None:
+            obj = objs[oid]
+            if 'delta' in obj:
+                c = patch_document(content(obj['delta']['base']), obj['delta']['changes'])
+            else:
+                c = blob_content(obj)
+            cache[oid] = c
+        return c
+
+    expanded = []
+    for b in blobs:
+        if 'delta' in b:
+            doc = deepcopy(content(b['_id']))
+            doc.update((k, b[k]) for k in BLOB_KEYS if k in b and k != 'delta')
+            b = project(doc, fields) if fields else doc
+        expanded.append(b)
+    return expanded
+
+
+#tree diffs
+def tree_pair_ids(ta, tb):
+    """
+        return the ids of the children of the trees ``ta`` and ``tb`` that are
+        not shared
+    """
+    ida = ta['trees'] + ta['blobs']
+    idb = tb['trees'] + tb['blobs']
+    same = set(ida) & set(idb)
+    return [i for i in ida + idb if i not in same]
+
+
+def diff_tree_pair(ta, tb, objs):
+    """
+        compare the children of ``ta`` and ``tb`` by name. ``objs`` holds the
+        children in ``tree_pair_ids`` by id. return, in name order,
+        ('pair', left, right) for trees to compare next, ('change', (Change, kind))
+        and ('subtree', tree, kind) for trees added or removed with their contents
+    """
+    ida = ta['trees'] + ta['blobs']
+    idb = tb['trees'] + tb['blobs']
+    same = set(ida) & set(idb)
+    left = dict((objs[i]['name'], objs[i]) for i in ida if i in objs and i not in same)
+    right = dict((objs[i]['name'], objs[i]) for i in idb if i in objs and i not in same)
+
+    items = []
+    for name in sorted(set(left) | set(right)):
+        l = left.get(name)
+        r = right.get(name)
+        if l and r and l['kind'] != 'blob' and r['kind'] != 'blob':
+            items.append(('pair', l, r))
+        elif l and r and l['kind'] == r['kind']:
+            items.append(('change', (Change(name, CHANGED, l['_id'], r['_id']), 'blob')))
+        else:
+            if l:
+                items.append(('change', (Change(name, REMOVED, l['_id'], None), l['kind'])))
+                if l['kind'] != 'blob':
+                    items.append(('subtree', l, REMOVED))
+            if r:
+                items.append(('change', (Change(name, ADDED, None, r['_id']), r['kind'])))
+                if r['kind'] != 'blob':
+                    items.append(('subtree', r, ADDED))
+    return items
+
+
+def subtree_change(obj, kind):
+    """
+        return the (Change, object kind) of ``obj`` below a tree that was added or
+        removed, ``kind``
+    """
+    if kind == ADDED:
+        return Change(obj['name'], kind, None, obj['_id']), obj['kind']
+    return Change(obj['name'], kind, obj['_id'], None), obj['kind']
+
+
+#skip lists
+def next_skip(skips, commit):
+    """
+        return the next [id, generation] of the skip list ``skips`` or None if it is
+        complete. ``commit`` is the commit of its last entry. entry i of a skip list
+        is entry i - 1 of the skip list of entry i - 1, so entries are at distance
+        1, 2, 4, 8 ...
+    """
+    s = commit.get('skips') or []
+    i = len(skips) - 1
+    if len(s) > i:
+        return s[i]
+
+#============= EOF =============================================
@@ -0,0 +1,454 @@
+#===============================================================================
+# Copyright 2014 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#===============================================================================
+
+#============= enthought library imports =======================
+from traits.api import HasTraits, Str
+from bson.objectid import ObjectId
+from pymongo.errors import CollectionInvalid, DuplicateKeyError
+
+#============= standard library imports ========================
+import threading
+from collections import OrderedDict
+from itertools import count
+#============= local library imports  ==========================
+from nogit.query import RE_TYPE, copy_doc, lookup, match, project, is_operator_dict, \
+    set_path, get_path, unset_path
+
+#databases are shared by name so that two adapters with the same
+#database_name see the same data, like two clients of one mongod
+_databases = {}
+
+
+def apply_update(doc, document):
+    """
+        apply an update ``document`` to ``doc`` in place.
+        a document without operators replaces everything but the _id
+    """
+    if not any(k.startswith('$') for k in document):
+        oid = doc.get('_id')
+        doc.clear()
+        doc.update(copy_doc(document))
+        if oid is not None:
+            doc['_id'] = oid
+        return
+
+    for op, args in document.iteritems():
+        for path, value in args.iteritems():
+            if op == '$set':
+                set_path(doc, path, copy_doc(value))
+            elif op == '$unset':
+                unset_path(doc, path)
+            elif op == '$inc':
+                set_path(doc, path, get_path(doc, path, 0) + value)
+            elif op in ('$push', '$addToSet'):
+                vs = get_path(doc, path)
+                if vs is None:
+                    vs = []
+                    set_path(doc, path, vs)
+                if isinstance(value, dict) and '$each' in value:
+                    value = value['$each']
+                else:
+                    value = [value]
+                for vi in value:
+                    if op == '$push' or vi not in vs:
+                        vs.append(copy_doc(vi))
+            elif op == '$pull':
+                vs = get_path(doc, path)
+                if isinstance(vs, list):
+                    if isinstance(value, dict):
+                        vs[:] = [vi for vi in vs if not (isinstance(vi, dict) and match(value, vi))]
+                    else:
+                        vs[:] = [vi for vi in vs if vi != value]
+            elif op == '$pop':
+                vs = get_path(doc, path)
+                if vs:
+                    vs.pop(0 if value < 0 else -1)
+            else:
+                raise ValueError('unsupported update operator {}'.format(op))
+
+
+def _hashable(v):
+    if isinstance(v, dict):
+        return tuple(sorted((k, _hashable(vi)) for k, vi in v.iteritems()))
+    elif isinstance(v, list):
+        return tuple(_hashable(vi) for vi in v)
+    return v
+
+
+class MemoryIndex(object):
+    """
+        hash index of a single (possibly dotted) field. list values are
+        indexed element by element like a mongo multikey index
+    """
+
+    def __init__(self, key, unique=False):
+        self.key = key
+        self.unique = unique
+        self._map = {}
+
+    def keys_for(self, doc):
+        ks = set()
+        for v in lookup(doc, self.key):
+            ks.add(_hashable(v))
+            if isinstance(v, list):
+                ks.update(_hashable(vi) for vi in v)
+        if not ks:
+            ks.add(None)
+        return ks
+
+    def check(self, doc, oid=None):
+        if self.unique:
+            for k in self.keys_for(doc):
+                if self._map.get(k, set()) - set([oid]):
+                    raise DuplicateKeyError('duplicate key {}: {}'.format(self.key, k))
+
+    def add(self, doc):
+        for k in self.keys_for(doc):
+            self._map.setdefault(k, set()).add(doc['_id'])
+
+    def discard(self, doc):
+        for k in self.keys_for(doc):
+            s = self._map.get(k)
+            if s is not None:
+                s.discard(doc['_id'])
+                if not s:
+                    del self._map[k]
+
+    def candidates(self, cond):
+        """
+            return the set of ids that may match ``cond`` or None if the
+            condition can not be answered by this index
+        """
+        if is_operator_dict(cond):
+            if '$in' in cond:
+                vs = cond['$in']
+            elif '$eq' in cond:
+                vs = [cond['$eq']]
+            else:
+                return
+        elif isinstance(cond, (dict, RE_TYPE)) or cond is None:
+            return
+        else:
+            vs = [cond]
+
+        ids = set()
+        for v in vs:
+            if isinstance(v, RE_TYPE):
+                return
+            ids.update(self._map.get(_hashable(v), ()))
+        return ids
+
+
+class MemoryCursor(object):
+    def __init__(self, collection, spec, fields):
+        self._collection = collection
+        self._spec = spec
+        self._fields = fields
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        if isinstance(key, (list, tuple)):
+            self._sort = list(key)
+        else:
+            self._sort = [(key, direction)]
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return len(list(self._docs()))
+        return len(self._collection._select(self._spec))
+
+    def _docs(self):
+        docs = self._collection._select(self._spec)
+        if self._sort:
+            for key, direction in reversed(self._sort):
+                docs.sort(key=lambda d: lookup(d, key)[:1], reverse=direction < 0)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return docs
+
+    def __iter__(self):
+        fields = self._fields
+        for d in self._docs():
+            yield project(d, fields)
+
+
+class MemoryCollection(object):
+    """
+        dict backed collection supporting the subset of the pymongo
+        collection api used by the engine. like mongo each write is atomic
+        so threads can share a collection
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.RLock()
+        self._docs = OrderedDict()
+        self._seq = {}
+        self._counter = count()
+        self._indexes = {}
+
+    #indexes
+    def create_index(self, keys, unique=False, **kw):
+        if isinstance(keys, (list, tuple)):
+            keys = keys[0][0]
+        if keys == '_id':
+            return '_id_'
+
+        idx = MemoryIndex(keys, unique)
+        for d in self._docs.itervalues():
+            idx.check(d, d['_id'])
+            idx.add(d)
+        self._indexes[keys] = idx
+        return '{}_1'.format(keys)
+
+    ensure_index = create_index
+
+    def index_information(self):
+        info = {'_id_': {'key': [('_id', 1)]}}
+        for k, idx in self._indexes.iteritems():
+            info['{}_1'.format(k)] = {'key': [(k, 1)], 'unique': idx.unique}
+        return info
+
+    def drop_index(self, name):
+        key = name[:-2] if name.endswith('_1') else name
+        self._indexes.pop(key, None)
+
+    def drop_indexes(self):
+        self._indexes = {}
+
+    #crud
+    def insert(self, doc_or_docs, **kw):
+        with self._lock:
+            if isinstance(doc_or_docs, list):
+                return [self._insert_one(d) for d in doc_or_docs]
+            return self._insert_one(doc_or_docs)
+
+    def find(self, spec=None, fields=None, **kw):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        return MemoryCursor(self, spec or {}, fields)
+
+    def find_one(self, spec=None, fields=None, **kw):
+        for d in self.find(spec, fields).limit(1):
+            return d
+
+    def update(self, spec, document, upsert=False, multi=False, **kw):
+        with self._lock:
+            return self._update(spec, document, upsert, multi)
+
+    def _update(self, spec, document, upsert, multi):
+        docs = self._select(spec)
+        if not multi:
+            docs = docs[:1]
+
+        for d in docs:
+            nd = copy_doc(d)
+            apply_update(nd, document)
+            nd['_id'] = d['_id']
+            self._unindex(d)
+            try:
+                for idx in self._indexes.itervalues():
+                    idx.check(nd, d['_id'])
+            except DuplicateKeyError:
+                self._index(d)
+                raise
+            self._docs[d['_id']] = nd
+            self._index(nd)
+
+        if docs:
+            return {'ok': 1.0, 'n': len(docs), 'updatedExisting': True}
+        elif upsert:
+            nd = dict((k, v) for k, v in spec.iteritems()
+                      if not k.startswith('$') and not is_operator_dict(v))
+            apply_update(nd, document)
+            oid = self._insert_one(nd)
+            return {'ok': 1.0, 'n': 1, 'updatedExisting': False, 'upserted': oid}
+        return {'ok': 1.0, 'n': 0, 'updatedExisting': False}
+
+    def remove(self, spec=None, multi=True, **kw):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        with self._lock:
+            docs = self._select(spec or {})
+            if not multi:
+                docs = docs[:1]
+            for d in docs:
+                self._unindex(d)
+                del self._docs[d['_id']]
+                del self._seq[d['_id']]
+        return {'ok': 1.0, 'n': len(docs)}
+
+    def count(self):
+        return len(self._docs)
+
+    def drop(self):
+        with self._lock:
+            self._docs = OrderedDict()
+            self._seq = {}
+            for idx in self._indexes.itervalues():
+                idx._map = {}
+
+    #private
+    def _insert_one(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+
+        oid = doc['_id']
+        if oid in self._docs:
+            raise DuplicateKeyError('duplicate key _id: {}'.format(oid))
+
+        d = copy_doc(doc)
+        for idx in self._indexes.itervalues():
+            idx.check(d)
+
+        self._docs[oid] = d
+        self._seq[oid] = next(self._counter)
+        self._index(d)
+        return oid
+
+    def _index(self, doc):
+        for idx in self._indexes.itervalues():
+            idx.add(doc)
+
+    def _unindex(self, doc):
+        for idx in self._indexes.itervalues():
+            idx.discard(doc)
+
+    def _candidates(self, spec):
+        """
+            use the _id or a secondary index to narrow the documents to scan.
+            return (ids, True if the _id condition was used). ids is None for a full scan
+        """
+        if '_id' in spec:
+            cond = spec['_id']
+            if is_operator_dict(cond):
+                if '$in' in cond and len(cond) == 1:
+                    seen = set()
+                    return [oid for oid in cond['$in']
+                            if oid in self._docs and not (oid in seen or seen.add(oid))], True
+            elif not isinstance(cond, (dict, RE_TYPE)):
+                return ([cond] if cond in self._docs else []), True
+
+        best = self._index_candidates(spec)
+        if best is not None:
+            if len(best) > 1:
+                best = sorted(best, key=self._seq.get)
+            return list(best), False
+        return None, False
+
+    def _index_candidates(self, spec):
+        """
+            return the smallest candidate id set offered by a secondary index
+        """
+        best = None
+        for key, cond in spec.iteritems():
+            if key == '$and':
+                for si in cond:
+                    ids = self._index_candidates(si)
+                    if ids is not None and (best is None or len(ids) < len(best)):
+                        best = ids
+                continue
+
+            idx = self._indexes.get(key)
+            if idx is not None:
+                ids = idx.candidates(cond)
+                if ids is not None and (best is None or len(ids) < len(best)):
+                    best = ids
+        return best
+
+    def _select(self, spec):
+        """
+            return the stored documents matching ``spec`` in insertion order
+        """
+        with self._lock:
+            return self._select_docs(spec)
+
+    def _select_docs(self, spec):
+        docs = self._docs
+        ids, by_id = self._candidates(spec)
+        if ids is None:
+            return [d for d in docs.itervalues() if match(spec, d)]
+
+        if by_id:
+            #the _id condition was answered by the candidates
+            spec = dict(spec)
+            spec.pop('_id')
+        return [docs[oid] for oid in ids if oid in docs and match(spec, docs[oid])]
+
+
+class MemoryAdapter(HasTraits):
+    """
+        pure python, in-process replacement for MongoAdapter. no server is
+        required and all data lives in dicts for the life of the process
+    """
+    database_name = Str('nogit')
+
+    def __init__(self, *args, **kw):
+        super(MemoryAdapter, self).__init__(*args, **kw)
+        self.connect()
+
+    def drop_database(self):
+        _databases.pop(self.database_name, None)
+        self.connect()
+
+    def connect(self):
+        self._db = _databases.setdefault(self.database_name, {})
+
+    def create_collection(self, name):
+        if name in self._db:
+            raise CollectionInvalid('collection {} already exists'.format(name))
+        return self._get_collection(name)
+
+    def collection_names(self, include_system_collections=True):
+        return list(self._db.keys())
+
+    def get_collection(self, *args):
+        return self._get_collection(*args)
+
+    def _get_collection(self, collection):
+        try:
+            col = self._db[collection]
+        except KeyError:
+            col = self._db[collection] = MemoryCollection(collection)
+        return col
+
+    def get_last(self, collection):
+        """
+            return the last document in collection
+        """
+        c = self._get_collection(collection)
+        r = c.find().sort('_id', -1).limit(1)
+        try:
+            return list(r)[0]
+        except IndexError:
+            return
+
+#============= EOF =============================================
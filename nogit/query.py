@@ -0,0 +1,265 @@
+#===============================================================================
+# Copyright 2014 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#===============================================================================
+
+"""
+    mongo style query matching and projection of documents in python. used by
+    the in-memory database and by the engines for documents the database cannot
+    query, e.g. reconstructed delta encoded blobs
+"""
+
+#============= enthought library imports =======================
+#============= standard library imports ========================
+import re
+#============= local library imports  ==========================
+
+RE_TYPE = type(re.compile(''))
+CONTAINERS = (dict, list)
+_missing = object()
+#field operators ``match`` evaluates. $and, $or and $nor combine queries
+CONDITION_OPERATORS = ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$exists',
+                       '$regex', '$options', '$not', '$all', '$size', '$elemMatch')
+
+
+def copy_doc(v):
+    """
+        copy dicts and lists. all other values are treated as immutable
+    """
+    if isinstance(v, dict):
+        return dict((k, copy_doc(vi) if isinstance(vi, CONTAINERS) else vi)
+                    for k, vi in v.iteritems())
+    elif isinstance(v, list):
+        return [copy_doc(vi) if isinstance(vi, CONTAINERS) else vi for vi in v]
+    return v
+
+
+def lookup(doc, path):
+    """
+        return a list of the values found at dotted ``path``.
+        lists are traversed like mongo does
+    """
+    values = [doc]
+    for key in path.split('.'):
+        nvalues = []
+        for v in values:
+            if isinstance(v, dict):
+                if key in v:
+                    nvalues.append(v[key])
+            elif isinstance(v, list):
+                if key.isdigit() and int(key) < len(v):
+                    nvalues.append(v[int(key)])
+                else:
+                    for vi in v:
+                        if isinstance(vi, dict) and key in vi:
+                            nvalues.append(vi[key])
+        values = nvalues
+    return values
+
+
+def _comparable(a, b):
+    num = (int, long, float)
+    if isinstance(a, num) and isinstance(b, num):
+        return True
+    if isinstance(a, basestring) and isinstance(b, basestring):
+        return True
+    return type(a) == type(b)
+
+
+def _equals(value, cond):
+    if isinstance(cond, RE_TYPE):
+        return isinstance(value, basestring) and bool(cond.search(value))
+    if value == cond:
+        return True
+    if isinstance(value, list) and not isinstance(cond, list):
+        return any(_equals(vi, cond) for vi in value)
+    return False
+
+
+def _compare(op, value, cond):
+    if isinstance(value, list):
+        return any(_compare(op, vi, cond) for vi in value)
+    if not _comparable(value, cond):
+        return False
+    if op == '$gt':
+        return value > cond
+    elif op == '$gte':
+        return value >= cond
+    elif op == '$lt':
+        return value < cond
+    else:
+        return value <= cond
+
+
+def is_operator_dict(cond):
+    return isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond)
+
+
+def _match_condition(values, cond):
+    if not is_operator_dict(cond):
+        if cond is None:
+            return not values or any(v is None for v in values)
+        return any(_equals(v, cond) for v in values)
+
+    for op, arg in cond.iteritems():
+        if op == '$eq':
+            r = any(_equals(v, arg) for v in values)
+        elif op == '$ne':
+            r = not any(_equals(v, arg) for v in values)
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            r = any(_compare(op, v, arg) for v in values)
+        elif op == '$in':
+            r = any(_equals(v, a) for v in values for a in arg)
+        elif op == '$nin':
+            r = not any(_equals(v, a) for v in values for a in arg)
+        elif op == '$exists':
+            r = bool(values) == bool(arg)
+        elif op == '$regex':
+            flags = 0
+            for o in cond.get('$options', ''):
+                flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}.get(o, 0)
+            reg = arg if isinstance(arg, RE_TYPE) else re.compile(arg, flags)
+            r = any(_equals(v, reg) for v in values)
+        elif op == '$options':
+            continue
+        elif op == '$not':
+            r = not _match_condition(values, arg)
+        elif op == '$all':
+            r = all(any(_equals(v, a) for v in values) for a in arg)
+        elif op == '$size':
+            r = any(isinstance(v, list) and len(v) == arg for v in values)
+        elif op == '$elemMatch':
+            r = any(isinstance(v, list) and
+                    any(match(arg, vi) if isinstance(vi, dict) else _match_condition([vi], arg)
+                        for vi in v)
+                    for v in values)
+        else:
+            raise ValueError('unsupported query operator {}'.format(op))
+
+        if not r:
+            return False
+    return True
+
+
+def match(spec, doc):
+    """
+        return True if ``doc`` matches the mongo style query ``spec``
+    """
+    for key, cond in spec.iteritems():
+        if key == '$and':
+            if not all(match(si, doc) for si in cond):
+                return False
+        elif key == '$or':
+            if not any(match(si, doc) for si in cond):
+                return False
+        elif key == '$nor':
+            if any(match(si, doc) for si in cond):
+                return False
+        elif not _match_condition(lookup(doc, key), cond):
+            return False
+    return True
+
+
+def unsupported_operators(spec):
+    """
+        return the sorted operators of the query ``spec`` that ``match`` cannot
+        evaluate
+    """
+    ops = set()
+
+    def check_condition(cond):
+        if not is_operator_dict(cond):
+            return
+        for op, arg in cond.iteritems():
+            if op not in CONDITION_OPERATORS:
+                ops.add(op)
+            elif op == '$not':
+                check_condition(arg)
+            elif op == '$elemMatch' and isinstance(arg, dict):
+                if is_operator_dict(arg):
+                    check_condition(arg)
+                else:
+                    check_spec(arg)
+
+    def check_spec(spec):
+        for key, cond in spec.iteritems():
+            if key in ('$and', '$or', '$nor'):
+                for si in cond:
+                    check_spec(si)
+            elif key.startswith('$'):
+                ops.add(key)
+            else:
+                check_condition(cond)
+
+    check_spec(spec)
+    return sorted(ops)
+
+
+def set_path(doc, path, value):
+    keys = path.split('.')
+    for k in keys[:-1]:
+        doc = doc.setdefault(k, {})
+    doc[keys[-1]] = value
+
+
+def get_path(doc, path, default=None):
+    for k in path.split('.'):
+        if not isinstance(doc, dict) or k not in doc:
+            return default
+        doc = doc[k]
+    return doc
+
+
+def unset_path(doc, path):
+    keys = path.split('.')
+    for k in keys[:-1]:
+        doc = doc.get(k)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(keys[-1], None)
+
+
+def project(doc, fields):
+    """
+        apply a projection (dict or list of field names) to ``doc``
+    """
+    if fields is None:
+        return copy_doc(doc)
+
+    if isinstance(fields, (list, tuple)):
+        fields = dict((f, 1) for f in fields)
+
+    include_id = fields.get('_id', 1)
+    fs = dict((k, v) for k, v in fields.iteritems() if k != '_id')
+    if not fs and fields.get('_id'):
+        return {'_id': doc['_id']} if '_id' in doc else {}
+    elif fs and any(fs.values()):
+        r = {}
+        for path in fs:
+            v = get_path(doc, path, _missing)
+            if v is not _missing:
+                set_path(r, path, copy_doc(v))
+    else:
+        r = copy_doc(doc)
+        for path in fs:
+            unset_path(r, path)
+
+    if include_id and '_id' in doc:
+        r['_id'] = doc['_id']
+    elif not include_id:
+        r.pop('_id', None)
+    return r
+
+
+#============= EOF =============================================
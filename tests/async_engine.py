@@ -0,0 +1,119 @@
+__author__ = 'ross'
+
+import unittest
+
+try:
+    import trollius
+except ImportError:
+    trollius = None
+
+
+@unittest.skipIf(trollius is None, 'trollius is not installed')
+class AsyncEngineTestCase(unittest.TestCase):
+    """
+        run the async engine against a database shared with a GitEngine
+    """
+
+    def setUp(self):
+        from nogit.async_adapter import AsyncMemoryAdapter
+        from nogit.async_engine import AsyncGitEngine
+        from nogit.git_engine import GitEngine
+
+        adapter = AsyncMemoryAdapter(database_name='nogit_async')
+        self.sync = GitEngine(adapter=adapter.adapter)
+        self.sync.drop_database()
+        self.sync.init()
+        self.engine = AsyncGitEngine(adapter=adapter)
+        self.loop = trollius.get_event_loop()
+
+    def run_coroutine(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def read(self, stream):
+        return self.run_coroutine(stream.to_list())
+
+    def test_add_commit(self):
+        engine = self.engine
+        self.run_coroutine(engine.add('/minnabluff', 'project', {'project': 'minnabluff'}))
+        self.run_coroutine(engine.add('/minnabluff/51000', '51000-01A', {'isotopes': {'Ar40': 10}}))
+        c1 = self.run_coroutine(engine.commit('first'))
+        self.assertIsNone(self.run_coroutine(engine.commit('empty')))
+
+        self.run_coroutine(engine.add('/minnabluff/51000', '51000-01A',
+                                      {'isotopes': {'Ar40': 22, 'Ar39': 23}}))
+        self.run_coroutine(engine.add('/minnabluff/51001', '51001-01A', {'isotopes': {'Ar40': 1}}))
+        c2 = self.run_coroutine(engine.commit('second'))
+
+        #the commits are those the synchronous engine would have made
+        self.assertEqual(self.sync._get_commit(c2)['pid'], c1)
+        path = '/minnabluff/51000/51000-01A'
+        self.assertEqual(self.sync.get_object(path, c2)['isotopes']['Ar39'], 23)
+        self.assertEqual([h['cid'] for h in self.sync.history(path)], [c2, c1])
+
+        blob = self.run_coroutine(engine.get_object(path, 'master'))
+        self.assertEqual(blob['isotopes']['Ar40'], 22)
+        self.assertEqual(self.run_coroutine(engine.diff(path, c1, c2)),
+                         list(self.sync.diff(path, c1, c2)))
+        self.assertEqual(self.run_coroutine(engine.diff('/', c1, c2)),
+                         list(self.sync.diff('/', c1, c2)))
+
+        self.assertEqual(self.read(engine.log()), list(self.sync.log()))
+        self.assertEqual(self.read(engine.log(limit=1, skip=1)), list(self.sync.log(limit=1, skip=1)))
+        self.assertEqual(self.read(engine.walk_tree()), list(self.sync.walk_tree('master')))
+        self.assertEqual(self.read(engine.walk_tree(c1, return_object=True, blobs_only=True)),
+                         list(self.sync.walk_tree(self.sync._get_object(self.sync._get_commit(c1)['tid']),
+                                                  return_object=True, blobs_only=True)))
+
+        q = {'isotopes.Ar40': {'$gt': 5}}
+        self.assertEqual(sorted(b['name'] for b in self.read(engine.find(q))), [path])
+        self.assertEqual(len(self.read(engine.find(q, ref=c1, path_prefix='/minnabluff/51001'))), 0)
+
+    def test_concurrent_commits(self):
+        engine = self.engine
+        base = self.run_coroutine(engine.commit_blobs([('/bench', 'base', {'n': 0})], 'base'))
+
+        coros = [engine.commit_blobs([('/bench/{}'.format(i), 'blob', {'n': i})], 'commit {}'.format(i))
+                 for i in range(10)]
+        cids = self.run_coroutine(trollius.gather(*coros))
+
+        #the coroutines interleave and lose the compare and swap to each other
+        self.assertEqual(len(set(cids)), 10)
+        self.assertEqual(self.sync.ahead_behind('master', base), (10, 0))
+        self.assertEqual(len(self.read(engine.walk_tree(blobs_only=True))), 11)
+
+    def test_delta_reads(self):
+        #delta encoded blobs written by the synchronous engine read the same
+        sync = self.sync
+        sync.delta_interval = 3
+        path = '/minnabluff/51000/51000-01A'
+        doc = {'isotopes': dict(('Ar{}'.format(i), i) for i in range(36, 41))}
+        cids = []
+        for i in range(4):
+            doc['isotopes']['Ar40'] = i
+            cids.append(sync.commit_blobs([('/minnabluff/51000', '51000-01A', doc)], 'v{}'.format(i)))
+
+        engine = self.engine
+        for cid in cids:
+            self.assertEqual(self.run_coroutine(engine.get_object(path, cid)), sync.get_object(path, cid))
+        self.assertEqual(self.run_coroutine(engine.diff(path, cids[1], cids[3])),
+                         list(sync.diff(path, cids[1], cids[3])))
+
+        q = {'isotopes.Ar40': 2}
+        self.assertEqual(self.read(engine.find(q, ref=cids[2])), list(sync.find(q, ref=cids[2])))
+        self.assertEqual(self.read(engine.find(q)), [])
+
+    def test_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from nogit.async_adapter import AsyncAdapter
+
+        self.engine.adapter = AsyncAdapter(adapter=self.sync.adapter,
+                                           executor=ThreadPoolExecutor(4))
+        self.run_coroutine(trollius.gather(*[self.engine.commit_blobs([('/bench', 'blob{}'.format(i),
+                                                                         {'n': i})], 'commit')
+                                              for i in range(8)]))
+        self.assertEqual(len(list(self.sync.walk_commits())), 8)
+        self.assertEqual(len(self.read(self.engine.walk_tree(blobs_only=True))), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
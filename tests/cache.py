@@ -0,0 +1,36 @@
+__author__ = 'ross'
+
+import unittest
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_maxsize(self):
+        from nogit.cache import LRUCache
+
+        cache = LRUCache(2)
+        cache['a'], cache['b'] = 1, 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertNotIn('b', cache)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+    def test_sizeof(self):
+        from nogit.cache import LRUCache
+
+        cache = LRUCache(4, sizeof=len)
+        cache['a'], cache['b'] = frozenset([1, 2]), frozenset([3, 4])
+
+        #larger than the whole cache. not cached
+        cache['c'] = frozenset(range(5))
+        self.assertEqual((len(cache), cache.size), (2, 4))
+
+        cache['d'] = frozenset([5])
+        self.assertEqual((len(cache), cache.size), (2, 3))
+        self.assertNotIn('a', cache)
+
+        cache.pop('d')
+        self.assertEqual(cache.size, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,8 +30,8 @@ class EngineTestCase(unittest.TestCase):
         self.engine.add('/', 'file1', 'version1')
         self.engine.add('/', 'file2', 'version1')
 
-        idx=self.engine.get_index()
-        self.assertEqual(len(idx['blobs']), 2)
+        idx=list(self.engine.get_index())
+        self.assertEqual(len(idx), 2)
 
         wtree=self.engine.get_working_tree()
         self.assertEqual(len(wtree['blobs']), 2)
@@ -0,0 +1,81 @@
+__author__ = 'ross'
+
+import unittest
+
+from pymongo.errors import CollectionInvalid, DuplicateKeyError
+
+
+class MemoryAdapterTestCase(unittest.TestCase):
+    def setUp(self):
+        from nogit.memory_adapter import MemoryAdapter
+
+        self.adapter = MemoryAdapter(database_name='nogit_memory_test')
+        self.adapter.drop_database()
+        self.col = self.adapter.get_collection('objects')
+
+    def test_create_collection(self):
+        self.adapter.create_collection('commits')
+        self.assertRaises(CollectionInvalid, self.adapter.create_collection, 'commits')
+        self.assertIn('commits', self.adapter.collection_names())
+
+    def test_insert_find(self):
+        doc = {'name': 'a', 'isotopes': {'Ar40': 10}}
+        oid = self.col.insert(doc)
+        self.assertEqual(doc['_id'], oid)
+
+        #returned documents are copies
+        r = self.col.find_one({'_id': oid})
+        r['isotopes']['Ar40'] = 1
+        self.assertEqual(self.col.find_one(oid)['isotopes']['Ar40'], 10)
+
+        self.assertEqual(self.col.find_one({'isotopes.Ar40': {'$gt': 5}})['name'], 'a')
+        self.assertIsNone(self.col.find_one({'isotopes.Ar40': {'$lt': 5}}))
+        self.assertRaises(DuplicateKeyError, self.col.insert, {'_id': oid})
+
+    def test_in_sort_limit(self):
+        ids = self.col.insert([{'name': 'a', 'v': 3},
+                               {'name': 'b', 'v': 1},
+                               {'name': 'c', 'v': 2}])
+        names = [d['name'] for d in self.col.find({'_id': {'$in': ids[1:]}})]
+        self.assertEqual(names, ['b', 'c'])
+
+        #repeated ids match once
+        names = [d['name'] for d in self.col.find({'_id': {'$in': [ids[1], ids[1]]}})]
+        self.assertEqual(names, ['b'])
+
+        names = [d['name'] for d in self.col.find().sort('v', -1).limit(2)]
+        self.assertEqual(names, ['a', 'c'])
+        self.assertEqual(self.adapter.get_last('objects')['name'], 'c')
+
+        r = self.col.find_one({'name': 'a'}, {'v': 1})
+        self.assertEqual(sorted(r.keys()), ['_id', 'v'])
+        self.assertEqual(self.col.find_one({'name': 'a'}, {'_id': 1}), {'_id': ids[0]})
+        self.assertNotIn('_id', self.col.find_one({'name': 'a'}, {'_id': 0}))
+
+    def test_update(self):
+        self.col.insert({'name': 'a', 'blobs': []})
+        self.col.update({'name': 'a'}, {'$set': {'kind': 'tree'}, '$push': {'blobs': 1}})
+        r = self.col.find_one({'name': 'a'})
+        self.assertEqual(r['kind'], 'tree')
+        self.assertEqual(r['blobs'], [1])
+
+        r = self.col.update({'name': 'b'}, {'$set': {'kind': 'tree'}}, upsert=True)
+        self.assertFalse(r['updatedExisting'])
+        self.assertEqual(self.col.find_one({'name': 'b'})['kind'], 'tree')
+
+    def test_index(self):
+        self.col.create_index('name', unique=True)
+        self.col.insert({'name': 'a'})
+        self.assertRaises(DuplicateKeyError, self.col.insert, {'name': 'a'})
+
+        self.col.insert({'name': 'b'})
+        self.col.update({'name': 'b'}, {'$set': {'name': 'c'}})
+        self.assertIsNone(self.col.find_one({'name': 'b'}))
+        self.assertIsNotNone(self.col.find_one({'name': 'c'}))
+
+        self.col.remove({'name': 'c'})
+        self.assertEqual(self.col.count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+__author__ = 'ross'
+
+import threading
+import unittest
+
+from tests import pychron_engine
+
+
+class MemoryPychronEngineTestCase(pychron_engine.PychronEngineTestCase):
+    """
+        run the pychron engine tests against the in-memory adapter
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        from nogit.git_engine import GitEngine
+        from nogit.memory_adapter import MemoryAdapter
+
+        engine = GitEngine(adapter=MemoryAdapter())
+        cls.engine = engine
+        engine.drop_database()
+
+        engine.adapter.connect()
+
+    def test_concurrent_writers(self):
+        from nogit.git_engine import GitEngine
+        from nogit.memory_adapter import MemoryAdapter
+
+        engine = self._new_engine('nogit_concurrent_writers')
+        base = engine.commit_blobs([('/bench', 'base', {'n': 0})], 'base')
+
+        def worker(i):
+            e = GitEngine(adapter=MemoryAdapter(database_name='nogit_concurrent_writers'))
+            for j in range(20):
+                e.commit_blobs([('/bench/worker{}'.format(i), 'blob{}'.format(j), {'n': j})],
+                               'commit {}'.format(j))
+
+        ts = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+
+        #no commit or blob was lost to a race
+        self.assertEqual(engine.ahead_behind('master', base), (80, 0))
+        tip = engine._resolve_commit('master')
+        blobs = list(engine.walk_tree(engine._get_object(tip['tid']), blobs_only=True))
+        self.assertEqual(len(blobs), 81)
+
+
+if __name__ == '__main__':
+    unittest.main()
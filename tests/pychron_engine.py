@@ -1,7 +1,12 @@
-from nogit.errors import NoBranchError
+from nogit.differ import Change
+from nogit.errors import NoBranchError, BundleError, NonFastForwardError, MergeConflictError, \
+    UniqueIndexError, UnsupportedQueryError
 
 __author__ = 'ross'
 
+import os
+import shutil
+import tempfile
 import unittest
 
 
@@ -18,7 +23,99 @@ class PychronEngineTestCase(unittest.TestCase):
         engine.adapter.connect()
 
     def setUp(self):
+        #every test starts from the repository test_add_blob builds
+        self.engine.drop_database()
         self.engine.init()
+        self._add_fixture(self.engine)
+
+    def _add_fixture(self, engine):
+        """
+            commit the four versions of the minnabluff project made by test_add_blob
+        """
+        def sample(**isotopes):
+            return {'identifier': '51000', 'aliquot': '01', 'step': 'A', 'isotopes': isotopes}
+
+        engine.add('/minnabluff', 'project', {'project': 'minnabluff', 'location': 'Antarctica'})
+        engine.add('/minnabluff/51000', '51000-01A', sample(Ar40=10))
+        engine.commit('first comiit')
+        engine.add('/minnabluff/51000', '51000-01A', sample(Ar40=22))
+        engine.commit('second commit')
+        engine.add('/minnabluff/51000', '51000-01A', sample(Ar40=22, Ar39=23))
+        engine.commit('third commit')
+        engine.add('/minnabluff/51000', '51000-01B', sample(Ar40=22, Ar39=23))
+        engine.commit('fourth commit')
+
+    def test_history(self):
+        c4, c3, c2, c1 = [c['_id'] for c in self.engine.get_commits()]
+
+        hs = list(self.engine.history('/minnabluff/51000/51000-01A', blobs=True))
+        self.assertEqual([h['cid'] for h in hs], [c3, c2, c1])
+        self.assertEqual([h['blob']['isotopes']['Ar40'] for h in hs], [22, 22, 10])
+        self.assertEqual(hs[-1]['action'], 'added')
+
+        hs = list(self.engine.history('/minnabluff/project', ref='master'))
+        self.assertEqual([h['cid'] for h in hs], [c1])
+
+        self.assertEqual(len(list(self.engine.log(path='/minnabluff/51000/51000-01A'))), 3)
+
+        self.engine.rebuild_history()
+        hs = list(self.engine.history('/minnabluff/51000/51000-01B'))
+        self.assertEqual([h['cid'] for h in hs], [c4])
+
+    def test_history_head(self):
+        #without a ref history follows HEAD, not every branch
+        engine = self._new_engine('nogit_history_head')
+        path = '/minnabluff/51000/51000-01A'
+        engine.add('/minnabluff/51000', '51000-01A', {'age': 1})
+        c1 = engine.commit('first')
+        engine.branch('feature', c1)
+        engine.checkout('feature')
+        engine.add('/minnabluff/51000', '51000-01A', {'age': 2})
+        f = engine.commit('feature')
+        engine.checkout('master')
+
+        self.assertEqual([h['cid'] for h in engine.history(path)], [c1])
+        self.assertEqual(len(list(engine.log(path=path))), len(list(engine.log())))
+        self.assertEqual([h['cid'] for h in engine.history(path, ref='feature')], [f, c1])
+
+        #paths whose parent and name concatenate to the same string
+        engine.add('/minnabluff/5100', '01A', {'age': 3})
+        engine.commit('5100')
+        engine.add('/minnabluff/51000', '1A', {'age': 4})
+        engine.commit('51000')
+        self.assertEqual(engine.field_history('/minnabluff/5100/01A', 'age')['value'], [3])
+        self.assertEqual(engine.field_history('/minnabluff/51000/1A', 'age')['value'], [4])
+
+    def test_field_history(self):
+        c4, c3, c2, c1 = [c['_id'] for c in self.engine.get_commits()]
+
+        cols = self.engine.field_history('/minnabluff/51000/51000-01A', 'isotopes.Ar40')
+        self.assertEqual(cols['cid'], [c1, c2, c3])
+        self.assertEqual(cols['value'], [10, 22, 22])
+
+        cols = self.engine.field_history('/minnabluff/51000/51000-01A', 'isotopes.Ar39')
+        self.assertEqual(cols['value'], [None, None, 23])
+
+    def test_indexes(self):
+        objects = self.engine.adapter.get_collection('objects')
+        self.assertIn('name_1', objects.index_information())
+
+        self.engine.create_index('isotopes.Ar40')
+        self.assertIn('isotopes.Ar40_1', objects.index_information())
+        keys = [i['key'] for i in self.engine.get_indexes()]
+        self.assertEqual(keys, ['isotopes.Ar40'])
+
+        q = {'isotopes.Ar40': 22}
+        self.assertEqual(len(list(self.engine.find(q))), 2)
+
+        self.engine.drop_index('isotopes.Ar40')
+        self.assertNotIn('isotopes.Ar40_1', objects.index_information())
+        self.assertEqual(len(list(self.engine.get_indexes())), 0)
+        self.engine.drop_index('isotopes.Ar40')
+
+        #versions of a blob share field values so a unique index would drop them
+        self.assertRaises(UniqueIndexError, self.engine.create_index, 'identifier', unique=True)
+        self.assertNotIn('identifier_1', objects.index_information())
 
     def test_init(self):
         self.engine.init()
@@ -27,57 +124,729 @@ class PychronEngineTestCase(unittest.TestCase):
         self.assertGreaterEqual(n, 5)
 
     def test_add_blob(self):
-        self.engine.add('/minnabluff', 'project', {'project':'minnabluff','location':'Antarctica'})
-        self.engine.add('/minnabluff/51000', '51000-01A', {'identifier':'51000','aliquot':'01','step':'A',
-                                                           'isotopes':{'Ar40':10}})
+        engine = self._new_engine('nogit_add_blob')
+        engine.add('/minnabluff', 'project', {'project':'minnabluff','location':'Antarctica'})
+        engine.add('/minnabluff/51000', '51000-01A', {'identifier':'51000','aliquot':'01','step':'A',
+                                                      'isotopes':{'Ar40':10}})
 
-        idx=self.engine.get_index()
-        self.assertEqual(len(idx['blobs']), 2)
+        idx=list(engine.get_index())
+        self.assertEqual(len(idx), 2)
 
-        wtree=self.engine.get_working_tree()
+        wtree=engine.get_working_tree()
         self.assertEqual(len(wtree['blobs']), 0)
 
         self.assertEqual(len(wtree['trees']), 1)
-        c1=self.engine.commit('first comiit')
+        c1=engine.commit('first comiit')
 
-        self.engine.add('/minnabluff/51000', '51000-01A', {'identifier': '51000', 'aliquot': '01', 'step': 'A',
-                                                           'isotopes': {'Ar40': 22}})
-        c2=self.engine.commit('second commit')
+        engine.add('/minnabluff/51000', '51000-01A', {'identifier': '51000', 'aliquot': '01', 'step': 'A',
+                                                      'isotopes': {'Ar40': 22}})
+        c2=engine.commit('second commit')
 
-        d=self.engine.diff('/minnabluff/51000/51000-01A', c1, c2)
-        ls,rs=self.engine.extract_diff(d)
+        d=list(engine.diff('/minnabluff/51000/51000-01A', c1, c2))
+        self.assertEqual(d, [Change('isotopes.Ar40', 'changed', 10, 22)])
 
-        self.assertEqual(ls[0],'"Ar40": 10')
-        self.assertEqual(rs[0],'"Ar40": 22')
+        engine.add('/minnabluff/51000', '51000-01A', {'identifier': '51000', 'aliquot': '01', 'step': 'A',
+                                                      'isotopes': {'Ar40':22, 'Ar39': 23}})
 
-        self.engine.add('/minnabluff/51000', '51000-01A', {'identifier': '51000', 'aliquot': '01', 'step': 'A',
-                                                           'isotopes': {'Ar40':22, 'Ar39': 23}})
+        c3 = engine.commit('third commit')
+        d = list(engine.diff('/minnabluff/51000/51000-01A', c1, c3))
+        self.assertEqual(d, [Change('isotopes.Ar39', 'added', None, 23),
+                             Change('isotopes.Ar40', 'changed', 10, 22)])
 
-        c3 = self.engine.commit('third commit')
-        d = self.engine.diff('/minnabluff/51000/51000-01A', c1, c3)
-        ls, rs = self.engine.extract_diff(d)
-
-        self.assertEqual(ls[0], '"Ar40": 10')
-        self.assertEqual(rs[0], '"Ar40": 22')
-        self.assertEqual(rs[1], '"Ar39": 23')
-
-        d = self.engine.diff('/minnabluff/51000/51000-01A', c2, c3)
-        ls, rs = self.engine.extract_diff(d)
-        self.assertEqual(rs[0], '"Ar40": 22')
-        self.assertEqual(rs[1], '"Ar39": 23')
+        d = list(engine.diff('/minnabluff/51000/51000-01A', c2, c3))
+        self.assertEqual(d, [Change('isotopes.Ar39', 'added', None, 23)])
 
         #add new file to the tree
-        self.engine.add('/minnabluff/51000', '51000-01B', {'identifier': '51000', 'aliquot': '01', 'step': 'A',
-                                                           'isotopes': {'Ar40': 22, 'Ar39': 23}})
-        c4 = self.engine.commit('fourth commit')
+        engine.add('/minnabluff/51000', '51000-01B', {'identifier': '51000', 'aliquot': '01', 'step': 'A',
+                                                      'isotopes': {'Ar40': 22, 'Ar39': 23}})
+        c4 = engine.commit('fourth commit')
 
         #test diff of trees for two commits
-        #show files and directories added and deleted
-        #flatten tree starting at path
-        #use ndiff to identify added/sub
-        d=self.engine.diff('/minnabluff/51000', c1, c4)
-        ls, rs = self.engine.extract_diff(d)
-        self.assertEqual(rs[0], '/minnabluff/51000/51000-01B')
+        #show files and directories added, deleted and changed
+        d=engine.diff('/minnabluff/51000', c1, c4)
+        self.assertEqual([(c.path, c.kind) for c in d],
+                         [('/minnabluff/51000/51000-01A', 'changed'),
+                          ('/minnabluff/51000/51000-01B', 'added')])
+
+        d=engine.diff('/', c1, c4)
+        self.assertEqual(len(list(d)), 2)
+
+    def test_add_many(self):
+        items = [('/minnabluff/{}'.format(i), '{}-01{}'.format(i, s),
+                  {'identifier': str(i), 'aliquot': '01', 'step': s, 'isotopes': {'Ar40': i}})
+                 for i in range(51000, 51005) for s in 'AB']
+
+        a = self._new_engine('nogit_add_many_a')
+        for item in items:
+            a.add(*item)
+
+        b = self._new_engine('nogit_add_many_b')
+        b.batch_size = 3
+        b.add_many(iter(items))
+
+        self.assertEqual(len(list(b.get_index())), 10)
+        self.assertEqual(list(a.walk_tree()), list(b.walk_tree()))
+
+        #identical trees hash to identical commits trees
+        ca = a._get_commit(a.commit('add many'))
+        cb = b._get_commit(b.commit('add many'))
+        self.assertEqual(ca['tid'], cb['tid'])
+
+    def _new_engine(self, name):
+        from nogit.git_engine import GitEngine
+
+        engine = GitEngine(adapter=self.engine.adapter.__class__(database_name=name))
+        engine.drop_database()
+        engine.init()
+        return engine
+
+    def test_bundle(self):
+        from nogit.bundle import BundleReader
+
+        c4, c3, c2, c1 = [c['_id'] for c in self.engine.get_commits()]
+        root = tempfile.mkdtemp()
+        try:
+            full = os.path.join(root, 'full.bundle')
+            part = os.path.join(root, 'part.bundle')
+            self.assertEqual(self.engine.bundle('master', full), 4)
+            self.assertEqual(self.engine.bundle('master', part, since=c2), 2)
+
+            with BundleReader(full) as reader:
+                self.assertEqual(reader.header['tip'], c4)
+                self.assertEqual(reader.get(c1)['msg'], self.engine._get_commit(c1)['msg'])
+                self.assertIsNone(reader.get('missing'))
+                n = len(reader)
+            with BundleReader(part) as reader:
+                self.assertLess(len(reader), n)
+                self.assertNotIn(c1, reader)
+
+            engine = self._new_engine('nogit_bundle')
+            self.assertRaises(BundleError, engine.unbundle, part)
+
+            result = engine.unbundle(full)
+            self.assertEqual((result['commits'], result['refs']), (4, ['master']))
+            self.assertEqual([c['_id'] for c in engine.get_commits()], [c4, c3, c2, c1])
+
+            path = '/minnabluff/51000/51000-01A'
+            self.assertEqual(engine.get_object(path, c3), self.engine.get_object(path, c3))
+            self.assertEqual([h['cid'] for h in engine.history(path)],
+                             [h['cid'] for h in self.engine.history(path)])
+
+            #already imported
+            self.assertEqual(engine.unbundle(part)['commits'], 0)
+        finally:
+            shutil.rmtree(root)
+
+    def test_bundle_since(self):
+        from nogit.bundle import BundleReader
+
+        engine = self._new_engine('nogit_bundle_since')
+        for i in range(20):
+            engine.add('/minnabluff/{}'.format(51000 + i), '{}-01A'.format(51000 + i), {'age': i})
+        c1 = engine.commit('samples')
+        engine.add('/minnabluff/51000', '51000-01A', {'age': 100})
+        c2 = engine.commit('age')
+
+        root = tempfile.mkdtemp()
+        try:
+            full = os.path.join(root, 'full.bundle')
+            part = os.path.join(root, 'part.bundle')
+            engine.bundle(c1, full)
+
+            #only the changed path is read, not the 20 subtrees of the base
+            fetched = []
+            get_objects = engine._get_objects
+
+            def counted(oids, fields=None):
+                fetched.extend(oids)
+                return get_objects(oids, fields)
+
+            engine._get_objects = counted
+            self.assertEqual(engine.bundle('master', part, since=c1), 1)
+            self.assertLess(len(fetched), 10)
+            with BundleReader(part) as reader:
+                #commit, root, /minnabluff, /minnabluff/51000 and the blob
+                self.assertEqual(len(reader), 5)
+
+            other = self._new_engine('nogit_bundle_since_b')
+            other.unbundle(full)
+            other.unbundle(part)
+            path = '/minnabluff/51000/51000-01A'
+            self.assertEqual(other.get_object(path, c2)['age'], 100)
+            self.assertEqual(list(other.walk_tree(other._get_object(other._get_commit(c2)['tid']))),
+                             list(engine.walk_tree('master')))
+        finally:
+            shutil.rmtree(root)
+
+    def test_concurrent_commit(self):
+        engine = self._new_engine('nogit_concurrent_commit')
+        engine.add('/minnabluff/51000', '51000-01A', {'age': 1, 'j': 1})
+        c1 = engine.commit('first')
+
+        self.assertFalse(engine.update_ref('master', None, expected='stale'))
+        self.assertEqual(engine._get_ref('master')['cid'], c1)
+
+        #another writer commits while a change is staged
+        engine.add('/minnabluff/51000', '51000-01A', {'age': 2, 'j': 1})
+        c2 = engine.commit_blobs([('/minnabluff/51001', '51001-01A', {'age': 3}),
+                                  ('/minnabluff/51000', '51000-01B', {'age': 4})], 'writer')
+        self.assertEqual(engine._get_commit(c2)['pid'], c1)
+        self.assertEqual(engine.get_object('/minnabluff/51000/51000-01A', c2)['age'], 1)
+
+        #the staged change is rebased onto the writer's commit
+        c3 = engine.commit('rebased')
+        self.assertEqual(engine._get_commit(c3)['pid'], c2)
+        self.assertEqual([engine.get_object(p, c3)['age'] for p in ('/minnabluff/51000/51000-01A',
+                                                                     '/minnabluff/51000/51000-01B',
+                                                                     '/minnabluff/51001/51001-01A')],
+                         [2, 4, 3])
+        self.assertIn('/minnabluff/51001/51001-01A', list(engine.walk_tree()))
+
+        engine.add('/minnabluff/51000', '51000-01A', {'age': 5, 'j': 1})
+        engine.commit_blobs([('/minnabluff/51000', '51000-01A', {'age': 6, 'j': 1})], 'writer')
+        n = engine.adapter.get_collection('commits').count()
+        self.assertRaises(MergeConflictError, engine.commit, 'conflict')
+        self.assertEqual(engine.adapter.get_collection('commits').count(), n)
+
+    def test_content_address(self):
+        c4, c3, c2, c1 = [c['_id'] for c in self.engine.get_commits()]
+
+        #unchanged blobs and trees are shared between commits
+        a = self.engine.get_object('/minnabluff/project', c1)
+        b = self.engine.get_object('/minnabluff/project', c4)
+        self.assertEqual(a['_id'], b['_id'])
+        self.assertNotEqual(self.engine.get_object('/minnabluff/51000', c1)['_id'],
+                            self.engine.get_object('/minnabluff/51000', c4)['_id'])
+
+        objects = self.engine.adapter.get_collection('objects')
+        n = objects.count()
+        self.engine.add('/minnabluff', 'project', {'project': 'minnabluff', 'location': 'Antarctica'})
+        self.assertEqual(objects.count(), n)
+        self.assertEqual(len(list(self.engine.get_index())), 0)
+
+    def test_colliding_paths(self):
+        #'/minnabluff/5100' + '01A' and '/minnabluff/51000' + '1A' join to the same string
+        engine = self._new_engine('nogit_colliding_paths')
+        engine.add('/minnabluff/5100', '01A', {'age': 1})
+        engine.add('/minnabluff/51000', '1A', {'age': 1})
+        self.assertEqual(sorted(e['path'] for e in engine.get_index()),
+                         ['/minnabluff/5100/01A', '/minnabluff/51000/1A'])
+        c = engine.commit('samples')
+
+        a = engine.get_object('/minnabluff/5100/01A', c)
+        b = engine.get_object('/minnabluff/51000/1A', c)
+        self.assertNotEqual(a['_id'], b['_id'])
+        self.assertEqual(b['name'], '/minnabluff/51000/1A')
+        self.assertEqual(list(engine.walk_tree('master', blobs_only=True)),
+                         ['/minnabluff/5100/01A', '/minnabluff/51000/1A'])
+
+    def test_delta_storage(self):
+        engine = self._new_engine('nogit_delta_storage')
+        engine.delta_interval = 3
+
+        doc = {'identifier': '51000', 'isotopes': dict(('Ar{}'.format(i), i) for i in range(36, 41))}
+        cids = []
+        for i in range(5):
+            doc['isotopes']['Ar40'] = i
+            engine.add('/minnabluff/51000', '51000-01A', doc)
+            cids.append(engine.commit('version {}'.format(i)))
+
+        objects = engine.adapter.get_collection('objects')
+        blobs = list(objects.find({'kind': 'blob'}).sort('name'))
+        depths = sorted(b['delta']['depth'] if 'delta' in b else 0 for b in blobs)
+        self.assertEqual(depths, [0, 0, 1, 1, 2])
+
+        engine.version_cache.clear()
+        path = '/minnabluff/51000/51000-01A'
+        blob = engine.get_object(path, cids[2])
+        self.assertNotIn('delta', blob)
+        self.assertEqual(blob['isotopes'], {'Ar36': 36, 'Ar37': 37, 'Ar38': 38,
+                                            'Ar39': 39, 'Ar40': 2})
+
+        self.assertEqual(engine.field_history(path, 'isotopes.Ar40')['value'], range(5))
+        self.assertEqual([b['isotopes']['Ar40'] for b in engine.find({'isotopes.Ar40': 4})], [4])
+        self.assertRaises(UnsupportedQueryError, list, engine.find({'isotopes.Ar40': {'$mod': [2, 0]}}))
+
+        #more reachable blobs than batch_size. only reachable delta ids are read
+        engine.add('/minnabluff/51001', '51001-01A', {'identifier': '51001'})
+        engine.commit('51001')
+        engine.batch_size = 1
+        self.assertEqual([b['isotopes']['Ar40'] for b in engine.find({'isotopes.Ar40': 4})], [4])
+        self.assertEqual(list(engine.find({'isotopes.Ar40': 2})), [])
+        engine.batch_size = 1000
+        self.assertEqual([b['identifier'] for b in engine.find({'isotopes.Ar40': 2}, ref=cids[2],
+                                                               fields={'identifier': 1})],
+                         ['51000'])
+        self.assertEqual(list(engine.diff(path, cids[1], cids[2])),
+                         [Change('isotopes.Ar40', 'changed', 1, 2)])
+
+        #commit_blobs is delta encoded with and without group commit
+        engine = self._new_engine('nogit_delta_commit_blobs')
+        engine.delta_interval = 3
+        for group in (0, 1):
+            engine.group_commit = bool(group)
+            for i in range(3):
+                doc['isotopes']['Ar40'] = 10 * group + i
+                engine.commit_blobs([('/minnabluff/51000', '51000-0{}A'.format(group), doc)], 'v')
+        engine.flush()
+
+        objects = engine.adapter.get_collection('objects')
+        depths = sorted(b['delta']['depth'] if 'delta' in b else 0 for b in objects.find({'kind': 'blob'}))
+        self.assertEqual(depths, [0, 0, 1, 1, 2, 2])
+
+        engine.version_cache.clear()
+        tip = engine._resolve_commit('master')['_id']
+        self.assertEqual([engine.get_object('/minnabluff/51000/51000-0{}A'.format(group), tip)['isotopes']['Ar40']
+                          for group in (0, 1)], [2, 12])
+
+    def test_diff_paths(self):
+        c4, c3, c2, c1 = [c['_id'] for c in self.engine.get_commits()]
+
+        paths = ['/minnabluff/project',
+                 '/minnabluff/51000/51000-01A',
+                 '/minnabluff/51000/51000-01B']
+        d = dict(self.engine.diff_paths(paths, c1, c4))
+        self.assertEqual(d['/minnabluff/project'], [])
+        self.assertEqual(d['/minnabluff/51000/51000-01A'],
+                         [Change('isotopes.Ar39', 'added', None, 23),
+                          Change('isotopes.Ar40', 'changed', 10, 22)])
+        self.assertEqual(len(d['/minnabluff/51000/51000-01B']), 4)
+
+        d = list(self.engine.diff_prefix('/minnabluff', c2, c3))
+        self.assertEqual(d, [('/minnabluff/51000/51000-01A',
+                              [Change('isotopes.Ar39', 'added', None, 23)])])
+
+        #a tree replaced by a blob is a delete plus an add
+        engine = self._new_engine('nogit_diff_paths')
+        engine.add('/minnabluff/51000', '51000-01A', {'age': 1})
+        c1 = engine.commit('tree')
+        blob = engine._create_blob('/minnabluff', '51000', {'age': 2})
+        engine._put_objects([blob])
+        tid = engine._put_tree({'name': '/minnabluff', 'kind': 'tree', 'trees': [], 'blobs': [blob['_id']]})
+        c2 = engine.commit_tree('blob', engine._put_tree({'name': '/', 'kind': 'tree',
+                                                          'trees': [tid], 'blobs': []}))
+        oid = engine.get_object('/minnabluff/51000/51000-01A', c1)['_id']
+        self.assertEqual(list(engine.diff_paths(['/minnabluff/51000'], c1, c2)),
+                         [('/minnabluff/51000', [Change('/minnabluff/51000/51000-01A', 'removed', oid, None),
+                                                 Change('age', 'added', None, 2)])])
+        self.assertEqual(list(engine.diff_paths(['/minnabluff/51000'], c2, c1)),
+                         [('/minnabluff/51000', [Change('age', 'removed', 2, None),
+                                                 Change('/minnabluff/51000/51000-01A', 'added', None, oid)])])
+
+    def test_find(self):
+        c4, c3, c2, c1 = [c['_id'] for c in self.engine.get_commits()]
+
+        q = {'isotopes.Ar40': {'$gt': 20}}
+        names = sorted(b['name'] for b in self.engine.find(q))
+        self.assertEqual(names, ['/minnabluff/51000/51000-01A', '/minnabluff/51000/51000-01B'])
+        self.assertEqual(len(list(self.engine.find(q, ref=c1))), 0)
+        self.assertEqual(len(list(self.engine.find({'identifier': '51000'}, ref=c1))), 1)
+
+        q = {'project': 'minnabluff'}
+        self.assertEqual(len(list(self.engine.find(q))), 1)
+        self.assertEqual(len(list(self.engine.find(q, path_prefix='/minnabluff/51000'))), 0)
+
+        #predicate first, filtered by the reachable set
+        batch_size = self.engine.batch_size
+        self.engine.batch_size = 1
+        try:
+            q = {'isotopes.Ar40': {'$gt': 20}}
+            self.assertEqual(len(list(self.engine.find(q, path_prefix='/minnabluff/51000'))), 2)
+            self.assertEqual(len(list(self.engine.find(q, ref=c2))), 1)
+        finally:
+            self.engine.batch_size = batch_size
+
+        #the reachable cache is bounded by the number of blob ids it holds
+        from nogit.cache import LRUCache
+
+        reachable_cache = self.engine.reachable_cache
+        self.engine.reachable_cache = LRUCache(2, sizeof=len)
+        try:
+            q = {'isotopes.Ar40': {'$gt': 20}}
+            self.assertEqual(len(list(self.engine.find(q))), 2)
+            self.assertEqual(len(self.engine.reachable_cache), 0)
+        finally:
+            self.engine.reachable_cache = reachable_cache
+
+    def test_gc(self):
+        engine = self._new_engine('nogit_gc')
+        engine.delta_interval = 3
+
+        path = '/minnabluff/51000/51000-01A'
+        doc = {'identifier': '51000', 'isotopes': {'Ar39': 1, 'Ar40': 1}}
+        engine.add('/minnabluff/51000', '51000-01A', doc)
+        c1 = engine.commit('first')
+
+        #the second version is superseded before it is committed
+        for i in (2, 3):
+            doc['isotopes']['Ar40'] = i
+            engine.add('/minnabluff/51000', '51000-01A', doc)
+
+        objects = engine.adapter.get_collection('objects')
+        n = objects.count()
+        report = engine.gc(dry_run=True)
+        self.assertEqual(objects.count(), n)
+        self.assertGreater(report['unreachable'], 0)
+        self.assertGreater(report['bytes'], 0)
+
+        #the frontier is walked batch_size ids at a time
+        engine.batch_size = 1
+        self.assertEqual(engine.gc(dry_run=True), report)
+        engine.batch_size = 1000
+
+        self.assertEqual(engine.gc(), report)
+        self.assertEqual(objects.count(), n - report['unreachable'])
+        self.assertEqual(engine.gc()['unreachable'], 0)
+
+        c2 = engine.commit('second')
+        engine.version_cache.clear()
+        self.assertEqual(engine.get_object(path, c1)['isotopes']['Ar40'], 1)
+        self.assertEqual(engine.get_object(path, c2)['isotopes']['Ar40'], 3)
+        self.assertIn(path, list(engine.walk_tree()))
+
+    def test_get_object(self):
+        c4, c3, c2, c1 = [c['_id'] for c in self.engine.get_commits()]
+
+        obj = self.engine.get_object('/minnabluff/51000/51000-01A', c1)
+        self.assertEqual(obj['isotopes']['Ar40'], 10)
+        obj = self.engine.get_object('/minnabluff/51000/51000-01A', c4)
+        self.assertEqual(obj['isotopes']['Ar39'], 23)
+
+        obj = self.engine.get_object('/minnabluff/51000', c4)
+        self.assertEqual(obj['kind'], 'tree')
+        self.assertIsNone(self.engine.get_object('/minnabluff/51000/51000-01B', c1))
+
+    def test_group_commit(self):
+        from nogit.git_engine import GitEngine
+
+        engine = self._new_engine('nogit_group_commit')
+        base = engine.commit_blobs([('/bench', 'base', {'n': 0})], 'base')
+
+        engine.group_commit = True
+        engine.flush_size = 5
+        engine.flush_interval = 3600
+        cids = [engine.commit_blobs([('/bench/{}'.format(i % 2), 'blob{}'.format(i), {'n': i})],
+                                    'commit {}'.format(i)) for i in range(12)]
+
+        #two full batches were written, the rest is buffered
+        self.assertEqual(engine._get_ref('master')['cid'], cids[9])
+        self.assertEqual(engine.adapter.get_collection('commits').count(), 11)
+        self.assertEqual(engine.flush(), 2)
+        self.assertEqual(engine._get_ref('master')['cid'], cids[11])
+        self.assertEqual(engine.flush(), 0)
+
+        #unchanged blobs make no commit, like without group commit
+        self.assertEqual(engine.commit_blobs([('/bench/1', 'blob11', {'n': 11})], 'again'), cids[11])
+        self.assertEqual(engine.flush(), 0)
+        c = engine.commit_blobs([('/bench/0', 'blob12', {'n': 12})], 'buffered')
+        self.assertEqual(engine.commit_blobs([('/bench/0', 'blob12', {'n': 12})], 'again'), c)
+        self.assertEqual(engine.flush(), 1)
+
+        #another writer moves the branch while commits are buffered
+        engine.commit_blobs([('/bench/0', 'blob0', {'n': 100})], 'buffered')
+        other = GitEngine(adapter=engine.adapter)
+        c = other.commit_blobs([('/bench/1', 'blob1', {'n': 200})], 'other')
+        engine.commit_blobs([('/bench/1', 'blob3', {'n': 300})], 'buffered')
+        self.assertEqual(engine.flush(), 2)
+
+        self.assertEqual(engine.ahead_behind('master', base), (16, 0))
+        self.assertTrue(engine.is_ancestor(c, 'master'))
+        tip = engine._resolve_commit('master')
+        self.assertEqual([engine.get_object('/bench/{}/blob{}'.format(i % 2, i), tip['_id'])['n']
+                          for i in range(4)], [100, 200, 2, 300])
+        self.assertEqual(len(list(engine.history('/bench/0/blob0'))), 2)
+        self.assertEqual(engine.adapter.get_collection('history').count(), 17)
+
+    def test_log(self):
+        from datetime import datetime, timedelta
+
+        self.assertEqual(len(list(self.engine.log())), 4)
+
+        page = list(self.engine.log(limit=3))
+        self.assertEqual(len(page), 3)
+        self.assertEqual(list(self.engine.log(skip=1, limit=2)), page[1:])
+
+        c4, c3, c2, c1 = [c['_id'] for c in self.engine.get_commits()]
+        page = list(self.engine.log(start=c3))
+        self.assertEqual(len(page), 2)
+        self.assertIn(str(c2), page[0])
+
+        now = datetime.utcnow()
+        self.assertEqual(len(list(self.engine.log(since=now + timedelta(hours=1)))), 0)
+        self.assertEqual(len(list(self.engine.log(until=now - timedelta(hours=1)))), 0)
+        self.assertEqual(len(list(self.engine.log(since=now - timedelta(hours=1), until=now))), 4)
+
+    def test_log_until(self):
+        from datetime import datetime, timedelta
+
+        engine = self._new_engine('nogit_log_until')
+        cs = []
+        for i in range(5):
+            engine.add('/minnabluff/51000', '51000-01A', {'age': i})
+            cs.append(engine.commit('c{}'.format(i)))
+
+        engine.branch('feature', cs[2])
+        engine.checkout('feature')
+        engine.add('/minnabluff/51001', '51001-01A', {'age': 1})
+        f = engine.commit('f')
+        engine.checkout('master')
+
+        t = datetime(2014, 1, 1)
+        commits = engine.adapter.get_collection('commits')
+        for i, cid in enumerate(cs):
+            commits.update({'_id': cid}, {'$set': {'timestamp': t + timedelta(hours=i)}})
+        commits.update({'_id': f}, {'$set': {'timestamp': t + timedelta(hours=3.5)}})
+        engine.commit_cache.clear()
+
+        #the newer commit on feature is skipped, the walk starts at c3
+        self.assertEqual(engine._seek_until('master', t + timedelta(hours=3.5))['_id'], cs[3])
+        page = list(engine.log(until=t + timedelta(hours=3.5)))
+        self.assertEqual(len(page), 4)
+        self.assertIn(str(cs[3]), page[0])
+        self.assertEqual(len(list(engine.log(until=t + timedelta(hours=3.5), ref='feature'))), 4)
+        self.assertEqual(len(list(engine.log(until=t - timedelta(hours=1)))), 0)
+
+    def test_merge(self):
+        engine = self._new_engine('nogit_merge')
+        engine.add('/minnabluff/51000', '51000-01A', {'age': 1, 'j': 1, 'isotopes': {'Ar40': 1}})
+        engine.add('/minnabluff/51001', '51001-01A', {'age': 2})
+        c1 = engine.commit('first')
+
+        engine.branch('feature')
+        engine.add('/minnabluff/51000', '51000-01A', {'age': 1, 'j': 2, 'isotopes': {'Ar40': 1}})
+        engine.add('/minnabluff/51002', '51002-01A', {'age': 3})
+        c2 = engine.commit('feature')
+
+        engine.checkout('master')
+        self.assertNotIn('/minnabluff/51002/51002-01A', list(engine.walk_tree()))
+        engine.add('/minnabluff/51000', '51000-01A', {'age': 4, 'j': 1, 'isotopes': {'Ar40': 5}})
+        c3 = engine.commit('master')
+        self.assertEqual(engine._get_commit(c3)['pid'], c1)
+        self.assertEqual(engine._merge_base(engine._get_commit(c2),
+                                            engine._get_commit(c3))['_id'], c1)
+
+        cm = engine.merge('feature')
+        commit = engine._get_commit(cm)
+        self.assertEqual(commit['pids'], [c3, c2])
+        self.assertEqual(commit['generation'], 3)
+
+        blob = engine.get_object('/minnabluff/51000/51000-01A', cm)
+        self.assertEqual((blob['age'], blob['j'], blob['isotopes']), (4, 2, {'Ar40': 5}))
+        self.assertEqual(engine.get_object('/minnabluff/51002/51002-01A', cm)['age'], 3)
+        self.assertIn('/minnabluff/51002/51002-01A', list(engine.walk_tree()))
+        self.assertIsNone(engine.merge('feature'))
+
+        #the path index was updated incrementally
+        paths = engine.adapter.get_collection('paths')
+        index = sorted((p['_id'], p['oid']) for p in paths.find())
+        engine.rebuild_path_index()
+        self.assertEqual(sorted((p['_id'], p['oid']) for p in paths.find()), index)
+
+        #feature fast forwards to the merge
+        engine.checkout('feature')
+        self.assertEqual(engine.merge('master'), cm)
+
+        engine.add('/minnabluff/51001', '51001-01A', {'age': 5})
+        engine.commit('feature 2')
+        engine.checkout('master')
+        engine.add('/minnabluff/51001', '51001-01A', {'age': 6})
+        engine.commit('master 2')
+        with self.assertRaises(MergeConflictError) as ctx:
+            engine.merge('feature')
+        self.assertEqual(ctx.exception.conflicts, [('/minnabluff/51001/51001-01A', 'age')])
+
+        #only the children that differ between the sides are fetched
+        engine = self._new_engine('nogit_merge_fetch')
+        for i in range(20):
+            engine.add('/minnabluff/{}'.format(51000 + i), '{}-01A'.format(51000 + i), {'i': i})
+        base = engine._get_commit(engine.commit('samples'))
+        engine.branch('feature')
+        engine.add('/minnabluff/51000', '51000-01A', {'i': 100})
+        theirs = engine._get_commit(engine.commit('feature'))
+        engine.checkout('master')
+        engine.add('/minnabluff/51001', '51001-01A', {'i': 101})
+        ours = engine._get_commit(engine.commit('master'))
+
+        calls = []
+        get_objects = engine._get_objects
+
+        def counted(oids, fields=None):
+            calls.append(len(oids))
+            return get_objects(oids, fields)
+
+        engine._get_objects = counted
+        conflicts = []
+        tid = engine._merge_tree('/', base['tid'], ours['tid'], theirs['tid'], conflicts)
+        self.assertEqual(conflicts, [])
+        self.assertEqual(calls, [3, 3, 3, 2])
+
+        del engine._get_objects
+        cm = engine.merge('feature')
+        self.assertEqual(engine._get_commit(cm)['tid'], tid)
+        self.assertEqual(engine.get_object('/minnabluff/51000/51000-01A', cm)['i'], 100)
+        self.assertEqual(engine.get_object('/minnabluff/51001/51001-01A', cm)['i'], 101)
+        self.assertEqual(engine.get_object('/minnabluff/51019/51019-01A', cm)['i'], 19)
+
+    def test_path_index(self):
+        paths = self.engine.adapter.get_collection('paths')
+        before = sorted((p['_id'], p['oid']) for p in paths.find())
+        self.assertEqual(len(before), 6)
+
+        self.engine.rebuild_path_index()
+        after = sorted((p['_id'], p['oid']) for p in paths.find())
+        self.assertEqual(before, after)
+
+        tree = self.engine.get_working_tree()
+        self.assertEqual(dict(before)['/'], tree['_id'])
+
+    def test_put_object(self):
+        from pymongo.errors import DuplicateKeyError
+
+        engine = self._new_engine('nogit_put_object')
+        engine.adapter.get_collection('objects').create_index('identifier', unique=True)
+        a, b = [engine._create_blob('/minnabluff/51000', '51000-01A', {'identifier': '51000', 'age': i})
+                for i in (1, 2)]
+        engine._put_objects([a])
+        engine._put_objects([a])
+        engine._put_object(a)
+
+        #only an existing object with the same id is a duplicate to ignore
+        self.assertRaises(DuplicateKeyError, engine._put_objects, [b])
+        self.assertRaises(DuplicateKeyError, engine._put_object, b)
+
+    def test_reachability(self):
+        engine = self._new_engine('nogit_reachability')
+        cs = []
+        for i in range(40):
+            engine.add('/minnabluff/51000', '51000-01A', {'age': i})
+            cs.append(engine.commit('c{}'.format(i)))
+
+        skips = engine._get_commit(cs[39])['skips']
+        self.assertEqual([g for _, g in skips], [39, 38, 36, 32, 24, 8])
+        self.assertEqual(skips[3][0], cs[31])
+
+        engine.branch('feature', cs[20])
+        engine.checkout('feature')
+        fs = []
+        for i in range(3):
+            engine.add('/minnabluff/51001', '51001-01A', {'age': i})
+            fs.append(engine.commit('f{}'.format(i)))
+
+        engine.checkout('master')
+        for i in range(2):
+            engine.add('/minnabluff/51002', '51002-01A', {'age': i})
+            m = engine.commit('m{}'.format(i))
+
+        self.assertEqual(engine.ahead_behind(m, fs[2]), (21, 3))
+        self.assertEqual(engine.ahead_behind(cs[39], cs[5]), (34, 0))
+        self.assertEqual(engine.ahead_behind(cs[5], cs[39]), (0, 34))
+        self.assertFalse(engine.is_ancestor(fs[1], 'master'))
+
+        engine.merge('feature')
+        self.assertTrue(engine.is_ancestor(cs[0], 'master'))
+        self.assertTrue(engine.is_ancestor(fs[0], 'master'))
+        self.assertTrue(engine.is_ancestor(cs[20], 'feature'))
+        self.assertFalse(engine.is_ancestor('master', cs[0]))
+        self.assertFalse(engine.is_ancestor(fs[1], cs[39]))
+        self.assertEqual(engine.ahead_behind('master', 'feature'), (22, 0))
+
+        self.assertEqual(engine.branches_containing(cs[10]), ['master', 'feature'])
+        self.assertEqual(engine.branches_containing(cs[30]), ['master'])
+        self.assertEqual(len(list(engine.history('/minnabluff/51000/51000-01A', ref='master'))), 40)
+
+    def test_remote(self):
+        a = self._new_engine('nogit_remote_a')
+        b = self._new_engine('nogit_remote_b')
+
+        a.add('/minnabluff/51000', '51000-01A', {'age': 1})
+        a.add('/minnabluff/51001', '51001-01A', {'age': 2})
+        a.commit('first')
+        a.add('/minnabluff/51000', '51000-01B', {'age': 3})
+        c2 = a.commit('second')
+
+        b.pull(a)
+        self.assertEqual(b._get_ref('master')['cid'], c2)
+        self.assertEqual(list(b.walk_tree()), list(a.walk_tree()))
+        self.assertEqual([r['name'] for r in b.get_remote_refs()], ['origin/master'])
+
+        b.add('/minnabluff/51000', '51000-01A', {'age': 4})
+        c3 = b.commit('third')
+
+        #only the new blob and the three trees above it are sent
+        objects = a.adapter.get_collection('objects')
+        n = objects.count()
+        self.assertEqual(b.push(a), 1)
+        self.assertEqual(objects.count(), n + 4)
+        self.assertEqual(a._get_ref('master')['cid'], c3)
+        self.assertEqual(a.get_object('/minnabluff/51000/51000-01A', c3)['age'], 4)
+        self.assertEqual(b.push(a), 0)
+
+        a.add('/minnabluff/51001', '51001-01A', {'age': 5})
+        c4 = a.commit('fourth')
+        b.add('/minnabluff/51001', '51001-01A', {'age': 6})
+        b.commit('fifth')
+        self.assertRaises(NonFastForwardError, b.push, a)
+        self.assertRaises(MergeConflictError, b.pull, a)
+        self.assertEqual(b.fetch(a), {'origin/master': c4})
+        self.assertEqual([o['age'] for o in b.find({'age': 5}, ref='origin/master')], [5])
+
+        #pushing a merge sends the merged in commits
+        a.add('/minnabluff/51002', '51002-01A', {'age': 7})
+        a.commit('sixth')
+        b.add('/minnabluff/51001', '51001-01A', {'age': 5})
+        b.commit('seventh')
+        cm = b.pull(a)
+        self.assertEqual(b.push(a), 3)
+        self.assertEqual(a._get_ref('master')['cid'], cm)
+
+    def test_walk_commits(self):
+        commits = self.engine.get_commits()
+        self.assertEqual([c['generation'] for c in commits], [4, 3, 2, 1])
+        self.assertEqual(commits[0]['ancestors'], [c['_id'] for c in commits[1:]])
+        self.assertEqual(commits[1]['pid'], commits[2]['_id'])
+
+        engine = self._new_engine('nogit_walk_commits')
+        engine.ancestry_depth = 2
+        for i in range(5):
+            engine.add('/minnabluff', 'project', {'project': 'minnabluff', 'version': i})
+            engine.commit('commit {}'.format(i))
+
+        engine.commit_cache.clear()
+        msgs = [c['msg'] for c in engine.walk_commits()]
+        self.assertEqual(msgs, ['commit {}'.format(i) for i in range(4, -1, -1)])
+
+    def test_walk_tree(self):
+        top = list(self.engine.walk_tree())
+        self.assertEqual(top, ['/minnabluff',
+                               '/minnabluff/51000',
+                               '/minnabluff/51000/51000-01A',
+                               '/minnabluff/51000/51000-01B',
+                               '/minnabluff/project'])
+
+        blobs = list(self.engine.walk_tree(blobs_only=True))
+        self.assertEqual(len(blobs), 3)
+
+        objs = list(self.engine.walk_tree(return_object=True, blobs_only=True))
+        self.assertEqual(objs[0]['isotopes']['Ar40'], 22)
+
+        #one query per level, not per tree
+        engine = self._new_engine('nogit_walk_tree')
+        for i in range(20):
+            engine.add('/minnabluff/{}'.format(51000 + i), '{}-01A'.format(51000 + i), {'i': i})
+        engine.commit('samples')
+
+        calls = []
+        get_objects = engine._get_objects
+
+        def counted(oids, fields=None):
+            calls.append(len(oids))
+            return get_objects(oids, fields)
+
+        engine._get_objects = counted
+        names = list(engine.walk_tree('master'))
+        self.assertEqual(len(names), 41)
+        self.assertEqual(names[:3], ['/minnabluff', '/minnabluff/51000', '/minnabluff/51000/51000-01A'])
+        self.assertEqual(calls, [1, 20, 20])
 
 if __name__ == '__main__':
     unittest.main()